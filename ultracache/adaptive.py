@@ -0,0 +1,120 @@
+"""Adaptive timeouts. With
+
+    ULTRACACHE = {
+        "adaptive-timeouts": {
+            "enabled": True,
+            "min": 60,
+            "max": 86400,
+            "factor": 2,
+            "min-samples": 10
+        }
+    }
+
+fragments and cached_get views are cached with a timeout derived from the
+observed lifetime of earlier entries with the same name instead of the
+timeout they declare. A miss on a key this process set before its expiry
+means the entry was invalidated, or evicted, after living that long. A miss
+after the expiry means the entry lived out its timeout. The timeout becomes
+factor times the average lifetime within the min and max bounds, so entries
+that always expire or are rarely invalidated get longer timeouts and
+volatile entries shorter ones. The declared timeout is used until min-samples
+lifetimes have been observed for a name.
+
+History is kept per process and costs no cache calls. Lifetimes, expiries,
+invalidations and the chosen timeouts are reported as metrics."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from ultracache import metrics
+
+
+def _conf():
+    try:
+        return settings.ULTRACACHE["adaptive-timeouts"]
+    except (AttributeError, KeyError):
+        return {}
+
+
+class AdaptiveTimeouts(object):
+    """Lifetime history and timeouts per kind and name."""
+
+    def __init__(self):
+        conf = _conf()
+        self.minimum = conf.get("min", 60)
+        self.maximum = conf.get("max", 86400)
+        self.factor = conf.get("factor", 2)
+        self.min_samples = conf.get("min-samples", 10)
+        # Weight of a new lifetime in the moving average. The first 1 /
+        # weight lifetimes are simply averaged.
+        self.weight = conf.get("weight", 0.1)
+        # Number of keys whose set time is remembered
+        self.max_keys = conf.get("max-keys", 10000)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.keys = OrderedDict()
+            # Number of lifetimes and their moving average per name
+            self.names = {}
+
+    def observe(self, kind, name, lifetime):
+        with self.lock:
+            count, average = self.names.get((kind, name), (0, 0.0))
+            count += 1
+            weight = max(1.0 / count, self.weight)
+            self.names[(kind, name)] = (
+                count, average + weight * (lifetime - average)
+            )
+        metrics.observe(kind, name, "lifetime_seconds", lifetime)
+
+    def get_timeout(self, kind, name, timeout):
+        count, average = self.names.get((kind, name), (0, 0.0))
+        if count < self.min_samples:
+            return timeout
+        return int(min(self.maximum, max(self.minimum, average * self.factor)))
+
+    def miss(self, kind, name, cache_key, timeout):
+        """Learn from a miss on cache_key and return the timeout to set it
+        with."""
+        now = time.time()
+        with self.lock:
+            entry = self.keys.pop(cache_key, None)
+        if entry is not None:
+            set_time, previous = entry
+            if now - set_time >= previous:
+                metrics.incr(kind, name, "expiries")
+                self.observe(kind, name, previous)
+            else:
+                metrics.incr(kind, name, "invalidations")
+                self.observe(kind, name, now - set_time)
+
+        timeout = self.get_timeout(kind, name, timeout)
+        with self.lock:
+            self.keys[cache_key] = (now, timeout)
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        metrics.observe(kind, name, "timeout_seconds", timeout)
+        return timeout
+
+
+_policy = None
+
+
+def get_policy():
+    global _policy
+    if _policy is None:
+        _policy = AdaptiveTimeouts()
+    return _policy
+
+
+def get_timeout(kind, name, cache_key, timeout):
+    """Return the timeout to set cache_key with after a miss. Timeouts of
+    None, meaning forever, are not adapted."""
+    if (timeout is None) or not _conf().get("enabled", False):
+        return timeout
+    return get_policy().miss(kind, name, cache_key, timeout)
@@ -0,0 +1,115 @@
+"""Cost aware admission. With
+
+    ULTRACACHE = {
+        "admission": {
+            "enabled": True,
+            "min-cost": 1.0,
+            "min-samples": 5,
+            "names": {
+                "header": {"min-cost": 0.1},
+                "footer": {"admit": False}
+            }
+        }
+    }
+
+fragments and cached_get views are only cached if rendering them costs at
+least min-cost milliseconds per kilobyte of output, on average over the
+misses seen by this process for their name. Cheap entries are rendered on
+every request instead of taking up cache memory and registry entries, and
+are not looked up either once enough samples show they are not worth caching.
+Names are fragment names or the dotted names of views. A name can override
+min-cost or be always or never admitted. Admissions and rejections are
+reported as metrics."""
+
+import threading
+
+from django.conf import settings
+
+from ultracache import metrics
+
+
+def _conf():
+    try:
+        return settings.ULTRACACHE["admission"]
+    except (AttributeError, KeyError):
+        return {}
+
+
+class Admission(object):
+    """Render time and size history and admission decisions per kind and
+    name."""
+
+    def __init__(self):
+        conf = _conf()
+        self.min_cost = conf.get("min-cost", 1.0)
+        self.min_samples = conf.get("min-samples", 5)
+        # Weight of a new sample in the moving averages. The first 1 / weight
+        # samples are simply averaged.
+        self.weight = conf.get("weight", 0.1)
+        self.overrides = conf.get("names", {})
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # Number of samples and average render seconds and bytes per name
+            self.names = {}
+
+    def get_cost(self, kind, name):
+        """Return the average render milliseconds per kilobyte or None if
+        there are too few samples."""
+        count, seconds, size = self.names.get((kind, name), (0, 0.0, 0.0))
+        if count < self.min_samples:
+            return None
+        return seconds * 1000 / (max(size, 1.0) / 1024)
+
+    def is_rejected(self, kind, name):
+        """Return true if entries named name are not worth caching."""
+        override = self.overrides.get(name, {})
+        if "admit" in override:
+            return not override["admit"]
+        cost = self.get_cost(kind, name)
+        if cost is None:
+            return False
+        return cost < override.get("min-cost", self.min_cost)
+
+    def admit(self, kind, name, render_seconds, size):
+        """Record a miss and return true if its result must be cached."""
+        with self.lock:
+            count, seconds, average_size = self.names.get(
+                (kind, name), (0, 0.0, 0.0)
+            )
+            count += 1
+            weight = max(1.0 / count, self.weight)
+            self.names[(kind, name)] = (
+                count,
+                seconds + weight * (render_seconds - seconds),
+                average_size + weight * (size - average_size)
+            )
+        if self.is_rejected(kind, name):
+            metrics.incr(kind, name, "rejected")
+            return False
+        metrics.incr(kind, name, "admitted")
+        return True
+
+
+_policy = None
+
+
+def get_policy():
+    global _policy
+    if _policy is None:
+        _policy = Admission()
+    return _policy
+
+
+def is_rejected(kind, name):
+    if not _conf().get("enabled", False):
+        return False
+    return get_policy().is_rejected(kind, name)
+
+
+def admit(kind, name, render_seconds, size):
+    if not _conf().get("enabled", False):
+        return True
+    return get_policy().admit(kind, name, render_seconds, size)
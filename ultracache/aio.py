@@ -0,0 +1,46 @@
+"""Cache access for the async code paths. The async cache API is used where
+Django provides it, otherwise the blocking call runs in the default executor
+within a copy of the current context. Database queries and template
+rendering run through asgiref's sync_to_async."""
+
+import asyncio
+import functools
+
+from django.core.cache import cache
+
+from ultracache.utils import contextvars
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking function in the default executor."""
+    call = functools.partial(func, *args, **kwargs)
+    if contextvars is not None:
+        call = functools.partial(contextvars.copy_context().run, call)
+    return await asyncio.get_event_loop().run_in_executor(None, call)
+
+
+async def sync(func, *args, **kwargs):
+    """Run a function that may query the database or render templates in the
+    thread Django runs synchronous code in. Django versions without asgiref
+    can't serve async views, so the function is called directly there."""
+    call = functools.partial(func, *args, **kwargs)
+    if sync_to_async is None:
+        return call()
+    return await sync_to_async(call, thread_sensitive=True)()
+
+
+async def aget(key, default=None):
+    if hasattr(cache, "aget"):
+        return await cache.aget(key, default)
+    return await run(cache.get, key, default)
+
+
+async def aset(key, value, timeout):
+    if hasattr(cache, "aset"):
+        return await cache.aset(key, value, timeout)
+    return await run(cache.set, key, value, timeout)
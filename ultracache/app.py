@@ -6,4 +6,5 @@ class UltracacheAppConfig(AppConfig):
     verbose_name = "Ultracache"
 
     def ready(self):
-        from ultracache import signals
+        from ultracache import refresh, signals
+        refresh.check()
@@ -0,0 +1,122 @@
+"""Request scoped collector of what ultracache did while rendering a request.
+Collection only happens if request._ultracache_debug is set, which is done
+by UltraCacheDebugMiddleware or the debug toolbar panel."""
+
+import json
+import logging
+
+from django.conf import settings
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+from ultracache.metrics import aggregator
+
+
+logger = logging.getLogger("ultracache.debug")
+
+
+class Collector(object):
+    """Keep a list of entries in the order their rendering started. Depth
+    reflects the nesting of fragments."""
+
+    def __init__(self):
+        self.entries = []
+        self.depth = 0
+
+    def start(self, kind, name, cache_key):
+        entry = {
+            "kind": kind,
+            "name": name,
+            "key": cache_key,
+            "depth": self.depth,
+            "hit": None,
+            "objects": [],
+            "render_seconds": 0.0,
+            "saved_seconds": 0.0
+        }
+        self.entries.append(entry)
+        self.depth += 1
+        return entry
+
+    def stop(self, entry, hit, objects, render_seconds=0.0):
+        self.depth -= 1
+        entry["hit"] = hit
+        unique = []
+        seen = set()
+        for tu in objects:
+            if tu not in seen:
+                seen.add(tu)
+                unique.append(tu)
+        entry["objects"] = unique
+        entry["render_seconds"] = render_seconds
+        if hit:
+            # Estimate from the mean render time seen by the aggregator, if
+            # metrics are enabled.
+            count, total, maximum = aggregator.get_observation(
+                entry["kind"], entry["name"], "render_seconds"
+            )
+            if count:
+                entry["saved_seconds"] = total / count
+
+    def summary(self):
+        hits = [e for e in self.entries if e["hit"]]
+        return {
+            "hits": len(hits),
+            "misses": len(self.entries) - len(hits),
+            "render_seconds": sum(
+                e["render_seconds"] for e in self.entries if e["depth"] == 0
+            ),
+            "saved_seconds": sum(e["saved_seconds"] for e in hits),
+            "entries": self.entries
+        }
+
+
+def get_collector(request):
+    return getattr(request, "_ultracache_debug", None)
+
+
+class UltraCacheDebugMiddleware(MiddlewareMixin):
+    """Report the collected entries in a JSON response header or to the
+    ultracache.debug logger, depending on the setting
+
+        ULTRACACHE = {"debug": {"output": "header", "max-header-size": 4096}}
+
+    The header reveals cache keys and tracked objects so it is only added if
+    DEBUG is on and the client address is in INTERNAL_IPS. Reports that
+    exceed max-header-size are logged and the header only carries the
+    totals."""
+
+    def __init__(self, *args, **kwargs):
+        super(UltraCacheDebugMiddleware, self).__init__(*args, **kwargs)
+        try:
+            conf = settings.ULTRACACHE["debug"]
+        except (AttributeError, KeyError):
+            conf = {}
+        self.output = conf.get("output", "header")
+        self.max_header_size = conf.get("max-header-size", 4096)
+
+    def process_request(self, request):
+        if (self.output == "log") or (
+            settings.DEBUG
+            and request.META.get("REMOTE_ADDR", None) in settings.INTERNAL_IPS
+        ):
+            request._ultracache_debug = Collector()
+
+    def process_response(self, request, response):
+        collector = get_collector(request)
+        if collector is None:
+            return response
+        summary = collector.summary()
+        data = json.dumps(summary, sort_keys=True, default=str)
+        if (self.output == "log") or (len(data) > self.max_header_size):
+            logger.debug("%s %s", request.get_full_path(), data)
+        if self.output != "log":
+            if len(data) > self.max_header_size:
+                summary["entries"] = []
+                summary["truncated"] = True
+                data = json.dumps(summary, sort_keys=True, default=str)
+            response["X-Ultracache-Debug"] = data
+        return response
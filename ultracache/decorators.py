@@ -1,30 +1,76 @@
+import asyncio
 import hashlib
+import time
 import types
 from functools import wraps
 
-from django.http import HttpResponse
+from django.http import Http404
 from django.core.cache import cache
-from django.utils.decorators import available_attrs
 from django.views.generic.base import TemplateResponseMixin
 from django.conf import settings
 
-from ultracache.utils import cache_meta, get_current_site_pk
+from ultracache import adaptive, admission, aio, esi, metrics
+from ultracache.debug import get_collector
+from ultracache.utils import TrackingScope, cache_meta, canonical_path, \
+    compile_expression, defer_placeholders, get_current_site_pk, \
+    get_status_timeout, get_tracked, is_cacheable, make_snapshot, \
+    not_modified, render_response_placeholders, restore_snapshot
+
+
+def _render(response):
+    """Render a template response only once and return its content. Reading
+    rendered_content would render it again later on."""
+    if hasattr(response, "render") \
+        and not getattr(response, "is_rendered", True):
+        response.render()
+    return getattr(response, "content", None)
+
+
+# Cached in place of a response when a view raises Http404
+NOT_FOUND = {"not_found": True}
+
+
+def _get_timeout(response, content, timeout):
+    """Return the timeout to cache response with or False if it must not be
+    cached."""
+    if (content is None) or not is_cacheable(response):
+        return False
+    return get_status_timeout(response.status_code, timeout)
+
+
+def _from_cache(request, cached):
+    if cached.get("not_found", False):
+        raise Http404
+    return restore_snapshot(request, cached)
 
 
 def cached_get(timeout, *params):
 
+    # request.get_full_path is implicitly added it no other request path is
+    # provided. get_full_path includes the querystring and is the more
+    # conservative approach but makes it trivially easy for a request to bust
+    # through the cache.
+    add_full_path = not set(params).intersection(set((
+        "request.get_full_path()", "request.path", "request.path_info"
+    )))
+
+    # Compile the custom variables once instead of on every request
+    evaluators = [compile_expression(param) for param in params]
+
     def decorator(view_func):
-        @wraps(view_func, assigned=available_attrs(view_func))
-        def _wrapped_view(view_or_request, *args, **kwargs):
+        # Name under which metrics are reported
+        metric_name = "%s.%s" % (
+            view_func.__module__,
+            getattr(view_func, "__qualname__", view_func.__name__)
+        )
 
-            # The type of the request gets muddled when using a function based
-            # decorator. We must use a function based decorator so it can be
-            # used in urls.py.
-            request = getattr(view_or_request, "request", view_or_request)
+        def get_cache_key(view_or_request, request, kwargs):
+            """Return the cache key or None if the request must not be
+            cached."""
 
             # If request not GET or HEAD never cache
             if request.method.lower() not in ("get", "head"):
-                return view_func(view_or_request, *args, **kwargs)
+                return None
 
             # If request contains messages never cache
             l = 0
@@ -33,19 +79,20 @@ def cached_get(timeout, *params):
             except (AttributeError, TypeError):
                 pass
             if l:
-                return view_func(view_or_request, *args, **kwargs)
+                return None
+
+            # The fragment view renders the page to refill its fragments
+            if getattr(request, "_ultracache_esi", False):
+                return None
 
             # Compute a cache key
             li = [str(view_or_request.__class__), view_func.__name__]
 
-            # request.get_full_path is implicitly added it no other request
-            # path is provided. get_full_path includes the querystring and is
-            # the more conservative approach but makes it trivially easy for a
-            # request to bust through the cache.
-            if not set(params).intersection(set((
-                "request.get_full_path()", "request.path", "request.path_info"
-            ))):
-                li.append(request.get_full_path())
+            if add_full_path:
+                li.append(canonical_path(request, metric_name))
+
+            if esi.is_esi(request):
+                li.append("esi")
 
             if "django.contrib.sites" in settings.INSTALLED_APPS:
                 li.append(get_current_site_pk(request))
@@ -55,35 +102,214 @@ def cached_get(timeout, *params):
                 li.append("{},{}".format(key, kwargs[key]))
 
             # Extend cache key with custom variables
-            for param in params:
-                if not isinstance(param, bytes):
-                    param = str(param)
-                li.append(eval(param))
+            for evaluator in evaluators:
+                li.append(evaluator(request=request))
 
             hashed = hashlib.md5(":".join([str(l) for l in li]).encode("utf-8")).hexdigest()
-            cache_key = "ucache-get-%s" % hashed
-            cached = cache.get(cache_key, None)
+            return "ucache-get-%s" % hashed
+
+        @wraps(view_func)
+        def _wrapped_view(view_or_request, *args, **kwargs):
+
+            # The type of the request gets muddled when using a function based
+            # decorator. We must use a function based decorator so it can be
+            # used in urls.py.
+            request = getattr(view_or_request, "request", view_or_request)
+
+            cache_key = get_cache_key(view_or_request, request, kwargs)
+            if cache_key is None:
+                return view_func(view_or_request, *args, **kwargs)
+
+            collector = get_collector(request)
+            if collector is not None:
+                entry = collector.start("view", metric_name, cache_key)
+
+            # Views that are not worth caching are not looked up
+            cached = None
+            if not admission.is_rejected("view", metric_name):
+                cached = cache.get(cache_key, None)
             if cached is None:
-                # The get view as outermost caller may bluntly set _ultracache
-                request._ultracache = []
-                response = view_func(view_or_request, *args, **kwargs)
-                content = getattr(response, "rendered_content", None) \
-                    or getattr(response, "content", None)
-                if content is not None:
-                    headers = getattr(response, "_headers", {})
-                    cache.set(
-                        cache_key,
-                        {"content": content, "headers": headers},
-                        timeout
+                # An outer caller like the middleware may already be tracking
+                # objects.
+                start_index = len(get_tracked(request, True))
+                # Fragments in the view register the same path as the view
+                path = request._ultracache_path = \
+                    canonical_path(request, metric_name)
+                # ultracache_nocache blocks are stored as placeholders and
+                # rendered by the outermost cache
+                render_placeholders = defer_placeholders(request)
+                t0 = time.perf_counter()
+                try:
+                    response = view_func(view_or_request, *args, **kwargs)
+                    content = _render(response)
+                except Http404:
+                    # Absorb repeated expensive lookups that find nothing.
+                    # Objects tracked before the lookup failed invalidate
+                    # the entry.
+                    key_timeout = get_status_timeout(404, timeout)
+                    if key_timeout is not False:
+                        cache.set(cache_key, NOT_FOUND, key_timeout)
+                        cache_meta(
+                            request, cache_key, start_index, key_timeout, path
+                        )
+                    if collector is not None:
+                        collector.stop(
+                            entry, False, get_tracked(request)[start_index:],
+                            time.perf_counter() - t0
+                        )
+                    raise
+                finally:
+                    if render_placeholders:
+                        request._ultracache_placeholders = False
+                t1 = time.perf_counter()
+                key_timeout = _get_timeout(response, content, timeout)
+                if (key_timeout is not False) and admission.admit(
+                    "view", metric_name, t1 - t0, len(content)
+                ):
+                    if response.status_code == 200:
+                        key_timeout = adaptive.get_timeout(
+                            "view", metric_name, cache_key, key_timeout
+                        )
+                    value = make_snapshot(response, content)
+                    cache.set(cache_key, value, key_timeout)
+                    t2 = time.perf_counter()
+                    cache_meta(
+                        request, cache_key, start_index, key_timeout, path
                     )
-                    cache_meta(request, cache_key)
+                    metrics.miss(
+                        "view", metric_name, t1 - t0, len(content),
+                        time.perf_counter() - t2
+                    )
+                    response = not_modified(
+                        request, value["etag"], value["last_modified"],
+                        value["headers"]
+                    ) or response
+                elif content is not None:
+                    # Nothing was stored
+                    metrics.miss("view", metric_name, t1 - t0, 0, 0)
+                if collector is not None:
+                    collector.stop(
+                        entry, False, get_tracked(request)[start_index:],
+                        t1 - t0
+                    )
+                if render_placeholders:
+                    response = render_response_placeholders(request, response)
             else:
-                response = HttpResponse(cached["content"])
-                # Headers has a non-obvious format
-                for k, v in cached["headers"].items():
-                    response[v[0]] = v[1]
+                metrics.hit("view", metric_name)
+
+                # Set tuples in _ultracache manually so outer callers are
+                # aware of contained objects.
+                objs = cache.get(cache_key + "-objs", [])
+                li = get_tracked(request)
+                if li is not None:
+                    li.extend(objs)
+                if collector is not None:
+                    collector.stop(entry, True, objs)
+
+                response = _from_cache(request, cached)
+
+            return response
+
+        @wraps(view_func)
+        async def _wrapped_async_view(view_or_request, *args, **kwargs):
+            request = getattr(view_or_request, "request", view_or_request)
+
+            # The key may need the current site from the database
+            cache_key = await aio.sync(
+                get_cache_key, view_or_request, request, kwargs
+            )
+            if cache_key is None:
+                return await view_func(view_or_request, *args, **kwargs)
+
+            collector = get_collector(request)
+            if collector is not None:
+                entry = collector.start("view", metric_name, cache_key)
+
+            cached = None
+            if not admission.is_rejected("view", metric_name):
+                cached = await aio.aget(cache_key, None)
+            if cached is None:
+                # Concurrent views on one event loop track their objects in a
+                # scope of their own.
+                path = request._ultracache_path = \
+                    canonical_path(request, metric_name)
+                render_placeholders = defer_placeholders(request)
+                t0 = time.perf_counter()
+                try:
+                    with TrackingScope(request) as scope:
+                        response = await view_func(
+                            view_or_request, *args, **kwargs
+                        )
+                        content = await aio.sync(_render, response)
+                except Http404:
+                    # Absorb repeated expensive lookups that find nothing.
+                    # Objects tracked before the lookup failed invalidate
+                    # the entry.
+                    key_timeout = get_status_timeout(404, timeout)
+                    if key_timeout is not False:
+                        await aio.aset(cache_key, NOT_FOUND, key_timeout)
+                        await aio.run(
+                            cache_meta, request, cache_key, scope.start_index,
+                            key_timeout, path,
+                            scope.objects
+                        )
+                    if collector is not None:
+                        collector.stop(
+                            entry, False, scope.objects,
+                            time.perf_counter() - t0
+                        )
+                    raise
+                finally:
+                    if render_placeholders:
+                        request._ultracache_placeholders = False
+                t1 = time.perf_counter()
+                key_timeout = _get_timeout(response, content, timeout)
+                if (key_timeout is not False) and admission.admit(
+                    "view", metric_name, t1 - t0, len(content)
+                ):
+                    if response.status_code == 200:
+                        key_timeout = adaptive.get_timeout(
+                            "view", metric_name, cache_key, key_timeout
+                        )
+                    value = make_snapshot(response, content)
+                    await aio.aset(cache_key, value, key_timeout)
+                    t2 = time.perf_counter()
+                    await aio.run(
+                        cache_meta, request, cache_key, scope.start_index,
+                        key_timeout, path, scope.objects
+                    )
+                    metrics.miss(
+                        "view", metric_name, t1 - t0, len(content),
+                        time.perf_counter() - t2
+                    )
+                    response = not_modified(
+                        request, value["etag"], value["last_modified"],
+                        value["headers"]
+                    ) or response
+                elif content is not None:
+                    # Nothing was stored
+                    metrics.miss("view", metric_name, t1 - t0, 0, 0)
+                if collector is not None:
+                    collector.stop(entry, False, scope.objects, t1 - t0)
+                if render_placeholders:
+                    response = render_response_placeholders(request, response)
+            else:
+                metrics.hit("view", metric_name)
+
+                # Set tuples manually so outer callers are aware of
+                # contained objects.
+                objs = await aio.aget(cache_key + "-objs", [])
+                li = get_tracked(request)
+                if li is not None:
+                    li.extend(objs)
+                if collector is not None:
+                    collector.stop(entry, True, objs)
+
+                response = _from_cache(request, cached)
 
             return response
 
+        if asyncio.iscoroutinefunction(view_func):
+            return _wrapped_async_view
         return _wrapped_view
     return decorator
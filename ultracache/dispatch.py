@@ -0,0 +1,243 @@
+"""Pluggable dispatch of invalidation events off the save path. The signal
+handlers hand (content type id, primary key, event) tuples to the dispatcher
+set in
+
+    ULTRACACHE = {
+        "invalidation": {
+            "dispatcher": "ultracache.dispatch.ThreadPoolDispatcher",
+            "workers": 4,
+            "queue-size": 1000,
+            "overflow": "block"
+        }
+    }
+
+A dispatcher is any object with dispatch and join methods. If the dotted name
+resolves to a class it is instantiated without arguments. The default
+SynchronousDispatcher invalidates immediately, which is also what tests
+usually want.
+
+Dispatchers other than the synchronous one only dispatch once the current
+transaction commits. Otherwise a request could cache the old state of an
+object after the invalidation."""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+try:
+    from django.utils.module_loading import import_string as importer
+except ImportError:
+    from django.utils.module_loading import import_by_path as importer
+
+
+logger = logging.getLogger("ultracache.invalidation")
+
+
+def _conf():
+    try:
+        return settings.ULTRACACHE["invalidation"]
+    except (AttributeError, KeyError):
+        return {}
+
+
+def process(ctid, pk, event, queued=None):
+    """Invalidate and log a failure instead of raising it in a worker."""
+    from ultracache.signals import invalidate_object
+    try:
+        invalidate_object(ctid, pk, event, queued)
+    except Exception:
+        logger.exception(
+            "Invalidation of %s %s %s failed", ctid, pk, event
+        )
+
+
+class SynchronousDispatcher(object):
+    """Invalidate immediately inside the save."""
+
+    def dispatch(self, ctid, pk, event):
+        from ultracache.signals import invalidate_object
+        invalidate_object(ctid, pk, event)
+
+    def join(self):
+        pass
+
+
+class ThreadPoolDispatcher(object):
+    """Process events in worker threads. Events for one object always go to
+    the same worker so they are processed in order. Each worker has a
+    bounded queue. When it is full the save blocks until there is room, or
+    with overflow set to "sync" invalidates synchronously which may reorder
+    events for that object."""
+
+    def __init__(self):
+        conf = _conf()
+        self.workers = conf.get("workers", 4)
+        self.queue_size = conf.get("queue-size", 1000)
+        self.overflow = conf.get("overflow", "block")
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queues = []
+
+    def start(self):
+        # Threads do not survive a fork so start them lazily per process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queues = []
+            for n in range(self.workers):
+                q = queue.Queue(self.queue_size)
+                thread = threading.Thread(
+                    target=self.work, args=(q,),
+                    name="ultracache-invalidation-%s" % n
+                )
+                thread.daemon = True
+                thread.start()
+                self.queues.append(q)
+            self.pid = os.getpid()
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            try:
+                process(*item)
+            finally:
+                q.task_done()
+
+    def dispatch(self, ctid, pk, event):
+        self.start()
+        item = (ctid, pk, event, time.time())
+        q = self.queues[hash((ctid, str(pk))) % len(self.queues)]
+        if self.overflow == "sync":
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                process(*item)
+        else:
+            q.put(item)
+
+    def join(self):
+        """Wait until all queued events are processed."""
+        for q in self.queues:
+            q.join()
+
+
+class AsyncioDispatcher(object):
+    """Process events on an event loop running in a background thread.
+    Blocking cache and purger calls run in the loop's default executor.
+    Events for one object wait for each other so they are processed in
+    order. At most queue-size events are pending. Beyond that the save
+    blocks until an event is processed, or with overflow set to "sync"
+    invalidates synchronously which may reorder events for that object."""
+
+    def __init__(self):
+        conf = _conf()
+        self.overflow = conf.get("overflow", "block")
+        self.semaphore = threading.BoundedSemaphore(conf.get("queue-size", 1000))
+        self.lock = threading.Lock()
+        self.pid = None
+        self.loop = None
+        # Per object locks and pending futures are only touched by the loop
+        self.locks = {}
+        self.counts = {}
+        self.futures = set()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=self.loop.run_forever, name="ultracache-invalidation"
+            )
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    async def handle(self, item):
+        key = (item[0], str(item[1]))
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.counts[key] = self.counts.get(key, 0) + 1
+        try:
+            async with lock:
+                await self.loop.run_in_executor(
+                    None, functools.partial(process, *item)
+                )
+        finally:
+            self.counts[key] -= 1
+            if not self.counts[key]:
+                del self.counts[key]
+                del self.locks[key]
+            self.semaphore.release()
+
+    def dispatch(self, ctid, pk, event):
+        item = (ctid, pk, event, time.time())
+        if self.overflow == "sync":
+            if not self.semaphore.acquire(blocking=False):
+                process(*item)
+                return
+        else:
+            self.semaphore.acquire()
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.handle(item), self.loop)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.discard)
+
+    def discard(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def join(self):
+        """Wait until all pending events are processed."""
+        with self.lock:
+            futures = list(self.futures)
+        concurrent.futures.wait(futures)
+
+
+class CeleryDispatcher(object):
+    """Send events to the ultracache.tasks.invalidate task. Bounds and
+    ordering are up to the broker and workers. Route the task to a single
+    queue consumed by one worker process to keep events for an object in
+    order."""
+
+    def dispatch(self, ctid, pk, event):
+        from ultracache.tasks import invalidate
+        invalidate.delay(ctid, pk, event, time.time())
+
+    def join(self):
+        pass
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        dispatcher = importer(
+            _conf().get("dispatcher", "ultracache.dispatch.SynchronousDispatcher")
+        )
+        if isinstance(dispatcher, type):
+            dispatcher = dispatcher()
+        _dispatcher = dispatcher
+    return _dispatcher
+
+
+def dispatch(ctid, pk, event):
+    dispatcher = get_dispatcher()
+    if isinstance(dispatcher, SynchronousDispatcher):
+        dispatcher.dispatch(ctid, pk, event)
+    else:
+        transaction.on_commit(
+            lambda: dispatcher.dispatch(ctid, pk, event)
+        )
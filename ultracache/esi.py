@@ -0,0 +1,98 @@
+"""Edge Side Includes mode. With
+
+    ULTRACACHE = {
+        "esi": {"enabled": True}
+    }
+
+an ultracache tag rendered for a reverse caching proxy that advertises ESI
+support emits an esi:include tag pointing at the esi_fragment view instead of
+its content. Objects in the fragment are registered against the fragment URL,
+so invalidation purges only the fragment and not the pages containing it.
+The fragment view renders the containing page if the fragment is not in the
+cache anymore.
+
+The proxy advertises support with a Surrogate-Capability header, eg. in
+Varnish's vcl_recv
+
+    set req.http.Surrogate-Capability = "varnish=ESI/1.0";
+
+and must process ESI on HTML responses. Fragment URLs are signed with
+SECRET_KEY. The fragment view is only meant to be called by the proxy and
+rejects URLs it did not emit."""
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import force_bytes, force_text
+from django.utils.html import escape
+from django.utils.http import urlquote, urlsafe_base64_decode, \
+    urlsafe_base64_encode
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
+
+# Only template fragments may be served by key
+KEY_PREFIX = "template.cache."
+
+
+def _conf():
+    try:
+        return settings.ULTRACACHE["esi"]
+    except (AttributeError, KeyError):
+        return {}
+
+
+def is_esi(request):
+    """Return true if fragments must be emitted as esi:include tags for
+    request."""
+    if not _conf().get("enabled", False):
+        return False
+    if getattr(request, "_ultracache_esi", False):
+        return True
+    return "ESI/1.0" in request.META.get("HTTP_SURROGATE_CAPABILITY", "")
+
+
+def get_signature(cache_key, path):
+    return salted_hmac(
+        "ultracache.esi", "%s\n%s" % (cache_key, path)
+    ).hexdigest()
+
+
+def is_valid(cache_key, path, signature):
+    """Return true if signature was made by get_src for cache_key and path."""
+    return constant_time_compare(signature, get_signature(cache_key, path))
+
+
+def encode_key(cache_key):
+    """Return cache_key as a token that is safe in a URL path. Fragment
+    names may contain quotes and other characters proxies handle
+    inconsistently."""
+    return force_text(urlsafe_base64_encode(force_bytes(cache_key))).rstrip("=")
+
+
+def decode_key(token):
+    """Return the cache key encoded by encode_key or None if token is not
+    valid."""
+    try:
+        return force_text(
+            urlsafe_base64_decode(force_text(token) + "=" * (-len(token) % 4))
+        )
+    except (ValueError, TypeError):
+        return None
+
+
+def get_src(cache_key, path):
+    """Return the signed fragment URL for cache_key. path is the page the
+    fragment is rendered by if it is not in the cache anymore."""
+    url = reverse(
+        _conf().get("url-name", "ultracache-esi"),
+        kwargs={"key": encode_key(cache_key)}
+    )
+    return "%s?sig=%s&path=%s" % (
+        url, get_signature(cache_key, path), urlquote(path)
+    )
+
+
+def include(src):
+    return '<esi:include src="%s" />' % escape(src)
+
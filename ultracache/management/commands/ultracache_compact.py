@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ultracache.registry import compact
+
+
+class Command(BaseCommand):
+    help = "Garbage collect the registries: drop references to cache keys " \
+        "that have expired and rewrite the compacted values."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of registries to read per round trip. Defaults to 500."
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", default=False,
+            help="Report what would be reclaimed without writing."
+        )
+
+    def handle(self, *args, **options):
+        stats = compact(
+            batch_size=options["batch_size"], dry_run=options["dry_run"]
+        )
+        self.stdout.write(
+            "Scanned %(registries)d registries with %(keys)d keys. Dropped "
+            "%(dropped_keys)d keys, %(deleted_registries)d registries "
+            "deleted." % stats
+        )
+        self.stdout.write(
+            "%d bytes reclaimed (%d before, %d after)%s" % (
+                stats["bytes_reclaimed"], stats["bytes_before"],
+                stats["bytes_after"], " (dry run)" if options["dry_run"] else ""
+            )
+        )
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+SORT_FIELDS = ("keys", "paths", "seconds", "events")
+
+
+class Command(BaseCommand):
+    help = "Summarise the invalidation records written to the " \
+        "ultracache.invalidation logger and list the worst offenders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("logfiles", nargs="+", help="Log files to read.")
+        parser.add_argument(
+            "--sort", default="keys", choices=SORT_FIELDS,
+            help="Field to rank models by. Defaults to keys."
+        )
+        parser.add_argument(
+            "--limit", type=int, default=10,
+            help="Number of models to list. Defaults to 10."
+        )
+
+    def handle(self, *args, **options):
+        summary = {}
+        for logfile in options["logfiles"]:
+            try:
+                fp = open(logfile, "r")
+            except IOError as e:
+                raise CommandError(str(e))
+            with fp:
+                for line in fp:
+                    # Log formatters may prefix the JSON record
+                    try:
+                        record = json.loads(line[line.index("{"):])
+                    except ValueError:
+                        continue
+                    if "model" not in record:
+                        continue
+                    di = summary.setdefault(record["model"], {
+                        "events": 0, "keys": 0, "paths": 0,
+                        "registry_bytes": 0, "seconds": 0.0, "max_keys": 0
+                    })
+                    di["events"] += 1
+                    di["keys"] += record.get("keys", 0)
+                    di["paths"] += record.get("paths", 0)
+                    di["registry_bytes"] += record.get("registry_bytes", 0)
+                    di["seconds"] += record.get("delete_seconds", 0) \
+                        + record.get("purge_seconds", 0)
+                    di["max_keys"] = max(di["max_keys"], record.get("keys", 0))
+
+        ranked = sorted(
+            summary.items(), key=lambda item: item[1][options["sort"]],
+            reverse=True
+        )[:options["limit"]]
+
+        self.stdout.write("%-40s %8s %10s %10s %10s %12s %10s" % (
+            "model", "events", "keys", "max keys", "paths", "bytes", "seconds"
+        ))
+        for model, di in ranked:
+            self.stdout.write("%-40s %8d %10d %10d %10d %12d %10.3f" % (
+                model, di["events"], di["keys"], di["max_keys"], di["paths"],
+                di["registry_bytes"], di["seconds"]
+            ))
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from xml.etree import ElementTree
+from urllib.parse import urlparse
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ultracache.refresh import get_client, warm
+
+
+# Combined and common log formats
+ACCESS_LOG_RE = re.compile(r"\"GET (\S+) HTTP/[\d.]+\"(?: (\d{3}))?")
+
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+
+def to_path(url):
+    """Strip scheme and host so the URL can be requested with the test
+    client."""
+    parsed = urlparse(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    return path
+
+
+def get_host(url):
+    """Return the host of an absolute URL or None."""
+    return urlparse(url).netloc or None
+
+
+class Command(BaseCommand):
+    help = "Warm the cache by rendering URLs through the full request stack " \
+        "so views, fragments and viewsets and their registries are populated."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "urls", nargs="*",
+            help="URLs or paths to warm. Paths require --host or --all-sites."
+        )
+        parser.add_argument(
+            "--file", action="append", default=[],
+            help="File with one URL or path per line."
+        )
+        parser.add_argument(
+            "--sitemap", action="append", default=[],
+            help="Path of a sitemap to render and read URLs from, or a "
+                "sitemap file."
+        )
+        parser.add_argument(
+            "--access-log", action="append", default=[],
+            help="Access log file in common or combined format. Successful "
+                "GET requests are warmed."
+        )
+        parser.add_argument(
+            "--host", action="append", default=[],
+            help="Host header to send. Repeat to warm every URL per site."
+        )
+        parser.add_argument(
+            "--all-sites", action="store_true", default=False,
+            help="Warm every URL for the domain of each site in the sites "
+                "framework."
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=4,
+            help="Number of workers. Defaults to 4."
+        )
+        parser.add_argument(
+            "--processes", action="store_true", default=False,
+            help="Use a process pool instead of a thread pool."
+        )
+        parser.add_argument(
+            "--progress", type=int, default=100,
+            help="Report progress every N URLs. Defaults to 100."
+        )
+
+    def handle(self, *args, **options):
+        hosts = list(options["host"])
+        if options["all_sites"]:
+            from django.contrib.sites.models import Site
+            hosts.extend(Site.objects.values_list("domain", flat=True))
+
+        urls = list(options["urls"])
+        for filename in options["file"]:
+            for line in self.read(filename):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    urls.append(line)
+        for filename in options["access_log"]:
+            for line in self.read(filename):
+                match = ACCESS_LOG_RE.search(line)
+                if match and (match.group(2) in (None, "200")):
+                    urls.append(match.group(1))
+        for sitemap in options["sitemap"]:
+            urls.extend(
+                self.read_sitemap(sitemap, hosts[0] if hosts else None)
+            )
+
+        # Preserve order but request each path only once per host. Without
+        # hosts every URL is requested for its own host.
+        seen = set()
+        jobs = []
+        for url in urls:
+            path = to_path(url)
+            for host in hosts or [self.require_host(url)]:
+                if (host, path) not in seen:
+                    seen.add((host, path))
+                    jobs.append((host, path))
+        if not jobs:
+            raise CommandError("No URLs to warm")
+
+        if options["processes"]:
+            # Forked processes must not share database connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=options["concurrency"])
+        else:
+            executor = ThreadPoolExecutor(max_workers=options["concurrency"])
+
+        statuses = {}
+        failures = []
+        total_seconds = 0.0
+        t0 = time.perf_counter()
+        with executor:
+            results = executor.map(
+                warm, [j[0] for j in jobs], [j[1] for j in jobs]
+            )
+            for n, (host, path, status, seconds) in enumerate(results, 1):
+                statuses[status] = statuses.get(status, 0) + 1
+                total_seconds += seconds
+                if status != 200:
+                    failures.append((host, path, status))
+                if (n % options["progress"] == 0) or (n == len(jobs)):
+                    elapsed = time.perf_counter() - t0
+                    self.stdout.write("%d/%d URLs warmed, %.1f URLs/s" % (
+                        n, len(jobs), n / elapsed if elapsed else 0
+                    ))
+
+        elapsed = time.perf_counter() - t0
+        for host, path, status in failures:
+            self.stderr.write("%s %s%s" % (status, host or "", path))
+        self.stdout.write(
+            "Warmed %d URLs in %.1fs (%.1f URLs/s, mean %.1fms). Status "
+            "codes: %s" % (
+                len(jobs), elapsed, len(jobs) / elapsed if elapsed else 0,
+                total_seconds / len(jobs) * 1000,
+                ", ".join(
+                    "%s: %s" % (k, v) for k, v in sorted(
+                        statuses.items(), key=lambda item: str(item[0])
+                    )
+                )
+            )
+        )
+
+    def require_host(self, url):
+        # The test client's default host is not allowed by a real site
+        host = get_host(url)
+        if host is None:
+            raise CommandError(
+                "No host to request %s with. Pass absolute URLs, --host or "
+                "--all-sites." % url
+            )
+        return host
+
+    def read(self, filename):
+        if filename == "-":
+            return sys.stdin.readlines()
+        try:
+            with open(filename, "r") as fp:
+                return fp.readlines()
+        except IOError as e:
+            raise CommandError(str(e))
+
+    def read_sitemap(self, sitemap, host):
+        """Return URLs from a sitemap file or from a sitemap rendered by the
+        site. Sitemap indexes are followed."""
+        if os.path.isfile(sitemap):
+            content = "".join(self.read(sitemap)).encode("utf-8")
+        else:
+            content = get_client(host or self.require_host(sitemap)).get(
+                to_path(sitemap)
+            ).content
+
+        try:
+            root = ElementTree.fromstring(content)
+        except ElementTree.ParseError as e:
+            raise CommandError("Invalid sitemap %s: %s" % (sitemap, e))
+        urls = []
+        for loc in root.iter(SITEMAP_NS + "loc"):
+            if root.tag == SITEMAP_NS + "sitemapindex":
+                urls.extend(self.read_sitemap(loc.text.strip(), host))
+            else:
+                urls.append(loc.text.strip())
+        return urls
@@ -0,0 +1,196 @@
+"""Pluggable instrumentation. Fragments, views and viewsets report hits,
+misses and timings per name to the backends listed in the setting
+
+    ULTRACACHE = {
+        "metrics": {"backends": ["ultracache.metrics.aggregator"]}
+    }
+
+A backend is any object with incr and observe methods. If the dotted name
+resolves to a class it is instantiated without arguments."""
+
+import re
+import socket
+import threading
+
+from django.conf import settings
+
+try:
+    from django.utils.module_loading import import_string as importer
+except ImportError:
+    from django.utils.module_loading import import_by_path as importer
+
+
+class Aggregator(object):
+    """Low overhead in-process aggregator. Counters are summed and
+    observations keep a count, sum and maximum."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.observations = {}
+
+    def incr(self, kind, name, stat, value=1):
+        key = (kind, name, stat)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, kind, name, stat, value):
+        key = (kind, name, stat)
+        with self.lock:
+            try:
+                li = self.observations[key]
+            except KeyError:
+                self.observations[key] = [1, value, value]
+            else:
+                li[0] += 1
+                li[1] += value
+                if value > li[2]:
+                    li[2] = value
+
+    def get_counter(self, kind, name, stat):
+        return self.counters.get((kind, name, stat), 0)
+
+    def get_observation(self, kind, name, stat):
+        """Return a (count, sum, max) tuple."""
+        return tuple(self.observations.get((kind, name, stat), (0, 0, 0)))
+
+    def hit_ratio(self, kind, name):
+        hits = self.get_counter(kind, name, "hits")
+        total = hits + self.get_counter(kind, name, "misses")
+        return float(hits) / total if total else None
+
+    def as_prometheus(self):
+        """Render the aggregated values in the Prometheus text format.
+        Observations are summaries with a separate gauge for the maximum.
+        The samples of a metric are grouped under its TYPE line."""
+        with self.lock:
+            counters = sorted(
+                (stat, kind, name, value)
+                for (kind, name, stat), value in self.counters.items()
+            )
+            observations = sorted(
+                (stat, kind, name, li)
+                for (kind, name, stat), li in self.observations.items()
+            )
+
+        families = []
+        for stat, kind, name, value in counters:
+            families.append((
+                "ultracache_%s_total" % stat, "counter", kind, name,
+                [("", value)]
+            ))
+        for stat, kind, name, (count, total, maximum) in observations:
+            families.append((
+                "ultracache_%s" % stat, "summary", kind, name,
+                [("_count", count), ("_sum", total)]
+            ))
+        for stat, kind, name, (count, total, maximum) in observations:
+            families.append((
+                "ultracache_%s_max" % stat, "gauge", kind, name,
+                [("", maximum)]
+            ))
+
+        lines = []
+        declared = set()
+        for metric, kind_of_metric, kind, name, samples in families:
+            if metric not in declared:
+                declared.add(metric)
+                lines.append("# TYPE %s %s" % (metric, kind_of_metric))
+            labels = "{kind=\"%s\",name=\"%s\"}" % (kind, _escape(name))
+            for suffix, value in samples:
+                lines.append("%s%s%s %s" % (metric, suffix, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+class Statsd(object):
+    """Send counters and timings to a statsd daemon over UDP. Configure with
+
+        ULTRACACHE = {
+            "metrics": {
+                "backends": ["ultracache.metrics.Statsd"],
+                "statsd": {"host": "localhost", "port": 8125, "prefix": "ultracache"}
+            }
+        }
+    """
+
+    def __init__(self):
+        try:
+            conf = settings.ULTRACACHE["metrics"]["statsd"]
+        except (AttributeError, KeyError):
+            conf = {}
+        self.address = (conf.get("host", "localhost"), conf.get("port", 8125))
+        self.prefix = conf.get("prefix", "ultracache")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, kind, name, stat, value, unit):
+        data = "%s.%s.%s.%s:%s|%s" % (
+            self.prefix, kind, re.sub(r"[^\w\-]", "_", name), stat, value, unit
+        )
+        try:
+            self.socket.sendto(data.encode("utf-8"), self.address)
+        except socket.error:
+            pass
+
+    def incr(self, kind, name, stat, value=1):
+        self.send(kind, name, stat, value, "c")
+
+    def observe(self, kind, name, stat, value):
+        # Timings are reported in milliseconds by convention
+        if stat.endswith("_seconds"):
+            self.send(kind, name, stat[:-8] + "_ms", int(value * 1000), "ms")
+        else:
+            self.send(kind, name, stat, value, "g")
+
+
+def _escape(name):
+    return str(name).replace("\\", "\\\\").replace("\"", "\\\"")
+
+
+aggregator = Aggregator()
+
+_backends = None
+
+
+def get_backends():
+    global _backends
+    if _backends is None:
+        try:
+            paths = settings.ULTRACACHE["metrics"]["backends"]
+        except (AttributeError, KeyError):
+            paths = []
+        backends = []
+        for path in paths:
+            backend = importer(path)
+            if isinstance(backend, type):
+                backend = backend()
+            backends.append(backend)
+        _backends = backends
+    return _backends
+
+
+def incr(kind, name, stat, value=1):
+    for backend in get_backends():
+        backend.incr(kind, name, stat, value)
+
+
+def observe(kind, name, stat, value):
+    for backend in get_backends():
+        backend.observe(kind, name, stat, value)
+
+
+def hit(kind, name):
+    incr(kind, name, "hits")
+
+
+def miss(kind, name, render_time, size, registry_time):
+    """Record a cache miss along with the cost of filling the cache."""
+    if not get_backends():
+        return
+    incr(kind, name, "misses")
+    observe(kind, name, "render_seconds", render_time)
+    observe(kind, name, "stored_bytes", size)
+    observe(kind, name, "registry_write_seconds", registry_time)
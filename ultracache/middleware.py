@@ -0,0 +1,154 @@
+import hashlib
+import re
+
+from django.core.cache import cache
+from django.conf import settings
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+from ultracache import esi
+from ultracache.utils import cache_meta, canonical_path, \
+    defer_placeholders, get_current_site_pk, get_header_meta_key, \
+    get_status_timeout, get_vary_headers, is_cacheable, make_snapshot, \
+    not_modified, render_response_placeholders, restore_snapshot
+
+
+class UltraCacheMiddleware(MiddlewareMixin):
+    """Cache entire GET and HEAD responses. Hits are served from
+    process_request before URL resolution so place this middleware before
+    SessionMiddleware and any other middleware that does work per request.
+    Objects are tracked like they are for the template tag so responses are
+    invalidated when those objects change. Responses are cached per value of
+    the request headers named in their Vary header."""
+
+    def __init__(self, *args, **kwargs):
+        super(UltraCacheMiddleware, self).__init__(*args, **kwargs)
+        try:
+            conf = settings.ULTRACACHE["middleware"]
+        except (AttributeError, KeyError):
+            conf = {}
+        self.timeout = conf.get("timeout", 300)
+        self.include = [re.compile(p) for p in conf.get("include", [])]
+        self.exclude = [re.compile(p) for p in conf.get("exclude", [])]
+
+        # By default requests from users with a session are not cached since
+        # we can't know if the response is personalized.
+        self.anonymous_only = conf.get("anonymous-only", True)
+        vary = conf.get("vary", {})
+        self.vary_cookies = vary.get("cookies", [])
+        self.vary_headers = [
+            get_header_meta_key(h) for h in vary.get("headers", [])
+        ]
+
+    def get_key_parts(self, request):
+        """Return the values that identify request or None if request must
+        not be cached."""
+
+        # If request not GET or HEAD never cache
+        if request.method.lower() not in ("get", "head"):
+            return None
+
+        path = request.path_info
+        if self.include and not any(p.search(path) for p in self.include):
+            return None
+        if any(p.search(path) for p in self.exclude):
+            return None
+
+        if self.anonymous_only \
+            and (settings.SESSION_COOKIE_NAME in request.COOKIES):
+            return None
+
+        li = [request.get_host(), canonical_path(request)]
+        if "django.contrib.sites" in settings.INSTALLED_APPS:
+            li.append(get_current_site_pk(request))
+        for name in self.vary_cookies:
+            li.append(request.COOKIES.get(name, ""))
+        for name in self.vary_headers:
+            li.append(request.META.get(name, ""))
+        if esi.is_esi(request):
+            li.append("esi")
+        return li
+
+    def get_headers_key(self, parts):
+        """Return the key of the Vary headers learned for a URL."""
+        hashed = hashlib.md5(":".join([str(l) for l in parts]).encode("utf-8")).hexdigest()
+        return "ucache-mw-hdr-%s" % hashed
+
+    def get_cache_key(self, request, headers=()):
+        """Return the cache key for request or None if request must not be
+        cached. headers are the request headers the response varies on."""
+        li = self.get_key_parts(request)
+        if li is None:
+            return None
+        li = li + [
+            request.META.get(get_header_meta_key(h), "") for h in headers
+        ]
+        hashed = hashlib.md5(":".join([str(l) for l in li]).encode("utf-8")).hexdigest()
+        return "ucache-mw-%s" % hashed
+
+    def process_request(self, request):
+        parts = self.get_key_parts(request)
+        if parts is None:
+            return None
+
+        # Responses are stored per value of the headers they vary on, eg.
+        # Accept-Encoding if GZipMiddleware comes after this middleware. The
+        # headers are learned from the response like Django's cache
+        # middleware does.
+        headers_key = self.get_headers_key(parts)
+        headers = cache.get(headers_key, None)
+        cached = None
+        if headers is not None:
+            cached = cache.get(self.get_cache_key(request, headers), None)
+        if cached is None:
+            # Start tracking objects. process_response stores the result.
+            request._ultracache = []
+            request._ultracache_middleware_key = headers_key
+            # ultracache_nocache blocks are stored as placeholders and
+            # rendered in process_response.
+            defer_placeholders(request)
+            return None
+
+        return restore_snapshot(request, cached)
+
+    def process_response(self, request, response):
+        headers_key = getattr(request, "_ultracache_middleware_key", None)
+        if headers_key is None:
+            return response
+        del request._ultracache_middleware_key
+        request._ultracache_placeholders = False
+        return render_response_placeholders(
+            request, self.store_response(request, response, headers_key)
+        )
+
+    def store_response(self, request, response, headers_key):
+        """Cache response if it may be shared and return it, or a 304 if the
+        conditional headers of request match it."""
+        timeout = get_status_timeout(response.status_code, self.timeout)
+        # The headers the response varies on are learned into the key
+        if (timeout is False) or not is_cacheable(response, None):
+            return response
+        cache_control = response.get("Cache-Control", "")
+        if ("private" in cache_control) or ("no-store" in cache_control):
+            return response
+
+        # If request contains messages never cache
+        l = 0
+        try:
+            l = len(request._messages)
+        except (AttributeError, TypeError):
+            pass
+        if l:
+            return response
+
+        headers = sorted(set(get_vary_headers(response)))
+        cache_key = self.get_cache_key(request, headers)
+        value = make_snapshot(response, response.content)
+        cache.set_many({headers_key: headers, cache_key: value}, timeout)
+        cache_meta(request, cache_key, timeout=timeout)
+        return not_modified(
+            request, value["etag"], value["last_modified"], value["headers"]
+        ) or response
@@ -4,7 +4,7 @@ Django 1.9 but is backwards compatible with 1.6."""
 
 import inspect
 import hashlib
-import pickle
+import time
 import types
 import collections
 
@@ -15,7 +15,11 @@ from django.template.context import BaseContext
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 
-from ultracache.utils import cache_meta, get_current_site_pk
+from ultracache import metrics
+from ultracache.debug import get_collector
+from ultracache.utils import cache_meta, canonical_path, compile_expression, \
+    get_current_site_pk, get_status_timeout, get_tracked, is_cacheable, \
+    make_snapshot, not_modified, restore_snapshot
 
 try:
     from django.template.base import logger
@@ -81,10 +85,11 @@ def _my_resolve_lookup(self, context):
                             else:
                                 raise
                 elif isinstance(current, Model):
-                    if ("request" in context) and hasattr(context["request"], "_ultracache"):
+                    li = get_tracked(context["request"]) if "request" in context else None
+                    if li is not None:
                         # get_for_model itself is cached
                         ct = ContentType.objects.get_for_model(current.__class__)
-                        context["request"]._ultracache.append((ct.id, current.pk))
+                        li.append((ct.id, current.pk))
 
         except Exception as e:
             template_name = getattr(context, "template_name", None) or "unknown"
@@ -114,12 +119,30 @@ Variable._resolve_lookup = _my_resolve_lookup
 conceptually the same as templates but make it even easier to track objects."""
 try:
     from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
-    from rest_framework.response import Response
     from rest_framework.serializers import Serializer, ListSerializer
     HAS_DRF = True
 except ImportError:
     HAS_DRF = False
 
+# Compiled "evaluate" expressions keyed on the expression string
+_evaluators = {}
+
+
+def get_evaluator(evaluate):
+    """Return a callable taking (viewset, request) for the evaluate setting.
+    String expressions are compiled only once."""
+    if isinstance(evaluate, collections.Callable):
+        return evaluate
+    try:
+        return _evaluators[evaluate]
+    except KeyError:
+        compiled = compile_expression(evaluate, names=("request", "viewset"))
+        evaluator = lambda viewset, request: compiled(
+            request=request, viewset=viewset
+        )
+        _evaluators[evaluate] = evaluator
+        return evaluator
+
 
 def drf_cache(func):
 
@@ -129,49 +152,79 @@ def drf_cache(func):
         do_cache = (dotted_name in viewsets) or (context.__class__ in viewsets) or ("*" in viewsets)
 
         if do_cache:
-            li = [request.get_full_path()]
+            # DRF has already negotiated the renderer. The rendered bytes are
+            # cached so the key must vary on it.
+            li = [
+                canonical_path(request, dotted_name),
+                getattr(request, "accepted_media_type", "")
+            ]
             viewset_settings = viewsets.get(dotted_name, {}) \
                 or viewsets.get(context.__class__, {}) \
                 or viewsets.get("*", {})
             evaluate = viewset_settings.get("evaluate", None)
             if evaluate is not None:
-                if isinstance(evaluate, collections.Callable):
-                    li.append(evaluate(context, request))
-                else:
-                    li.append(eval(evaluate))
+                li.append(get_evaluator(evaluate)(context, request))
 
             if "django.contrib.sites" in settings.INSTALLED_APPS:
                 li.append(get_current_site_pk(request))
 
-            cache_key = hashlib.md5(":".join([str(l) for l in li]).encode("utf-8")).hexdigest()
+            hashed = hashlib.md5(":".join([str(l) for l in li]).encode("utf-8")).hexdigest()
+            cache_key = "ucache-drf-%s" % hashed
+            collector = get_collector(request)
+            if collector is not None:
+                entry = collector.start("viewset", dotted_name, cache_key)
 
             cached = cache.get(cache_key, None)
             if cached is not None:
-                response = Response(pickle.loads(cached["content"]))
+                metrics.hit("viewset", dotted_name)
 
-                # Headers has a non-obvious format
-                for k, v in cached["headers"].items():
-                    response[v[0]] = v[1]
+                # Set tuples in _ultracache manually so outer callers are
+                # aware of contained objects.
+                objs = cache.get(cache_key + "-objs", [])
+                li = get_tracked(request)
+                if li is not None:
+                    li.extend(objs)
+                if collector is not None:
+                    collector.stop(entry, True, objs)
 
-                return response
+                # The content is already rendered so bypass the renderer
+                return restore_snapshot(request, cached)
 
-        if not hasattr(request, "_ultracache"):
-            setattr(request, "_ultracache", [])
-            setattr(request, "_ultracache_cache_key_range", [])
+        start_index = len(get_tracked(request, True))
+        if do_cache:
+            # Fragments in the viewset register the same path as the viewset
+            path = request._ultracache_path = \
+                canonical_path(request, dotted_name)
 
+        t0 = time.perf_counter()
         response = func(context, request, *args, **kwargs)
 
         if do_cache:
-            cache_meta(request, cache_key)
             response = context.finalize_response(request, response, *args, **kwargs)
             response.render()
-            timeout = viewset_settings.get("timeout", 300)
-            headers = getattr(response, "_headers", {})
-            cache.set(
-                cache_key,
-                {"content": pickle.dumps(response.data), "headers": headers},
-                timeout
+            t1 = time.perf_counter()
+            size = 0
+            timeout = get_status_timeout(
+                response.status_code, viewset_settings.get("timeout", 300)
             )
+            registry_time = 0
+            # The key is made of the negotiated media type
+            if (timeout is not False) and is_cacheable(response, ("accept",)):
+                t2 = time.perf_counter()
+                cache_meta(request, cache_key, start_index, timeout, path)
+                registry_time = time.perf_counter() - t2
+                size = len(response.content)
+                value = make_snapshot(response, response.content)
+                cache.set(cache_key, value, timeout)
+                response = not_modified(
+                    request, value["etag"], value["last_modified"],
+                    value["headers"]
+                ) or response
+            metrics.miss("viewset", dotted_name, t1 - t0, size, registry_time)
+            if collector is not None:
+                collector.stop(
+                    entry, False, get_tracked(request)[start_index:], t1 - t0
+                )
             return response
 
         else:
@@ -185,9 +238,12 @@ def _serializer(func):
 
     def wrapped(context, instance):
         request = context.context["request"]
-        if hasattr(request, "_ultracache") and isinstance(instance, Model):
+        # Skip instances already tracked in bulk by a ListSerializer
+        li = get_tracked(request)
+        if (li is not None) and isinstance(instance, Model) \
+            and not getattr(context, "_ultracache_bulk", False):
             ct = ContentType.objects.get_for_model(instance.__class__)
-            request._ultracache.append((ct.id, instance.pk))
+            li.append((ct.id, instance.pk))
         return func(context, instance)
 
     return wrapped
@@ -197,14 +253,46 @@ def _listserializer(func):
     # Helper decorator for ListSerializer
 
     def wrapped(context, data):
-        request = context.context["request"]
-        if hasattr(request, "_ultracache"):
-            iterable = data.all() if isinstance(data, Manager) else data
-            for obj in iterable:
-                if isinstance(obj, Model):
-                    ct = ContentType.objects.get_for_model(obj.__class__)
-                    request._ultracache.append((ct.id, obj.pk))
-        return func(context, data)
+        li = get_tracked(context.context["request"])
+        if li is None:
+            return func(context, data)
+
+        # Evaluate only once. ListSerializer.to_representation iterates over
+        # the result cache of the queryset we pass along.
+        iterable = data.all() if isinstance(data, Manager) else data
+        start_index = len(li)
+
+        # One content type lookup per model
+        ctids = {}
+        for obj in iterable:
+            if isinstance(obj, Model):
+                klass = obj.__class__
+                try:
+                    ctid = ctids[klass]
+                except KeyError:
+                    ctid = ctids[klass] = \
+                        ContentType.objects.get_for_model(klass).id
+                li.append((ctid, obj.pk))
+
+        child = getattr(context, "child", None)
+        if child is not None:
+            child._ultracache_bulk = True
+        try:
+            result = func(context, iterable)
+        finally:
+            if child is not None:
+                child._ultracache_bulk = False
+
+        # Nested serializers repeat related objects for every row
+        seen = set()
+        unique = []
+        for tu in li[start_index:]:
+            if tu not in seen:
+                seen.add(tu)
+                unique.append(tu)
+        li[start_index:] = unique
+
+        return result
 
     return wrapped
 
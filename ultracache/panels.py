@@ -0,0 +1,32 @@
+"""Panel for django-debug-toolbar. Add it to the setting
+
+    DEBUG_TOOLBAR_PANELS = [
+        ...
+        "ultracache.panels.UltraCachePanel",
+    ]
+"""
+
+from django.utils.translation import ugettext_lazy as _
+from debug_toolbar.panels import Panel
+
+from ultracache.debug import Collector, get_collector
+
+
+class UltraCachePanel(Panel):
+    title = _("Ultracache")
+    template = "ultracache/debug_panel.html"
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        if not stats:
+            return ""
+        return _("%(hits)s hits, %(misses)s misses") % stats
+
+    def process_request(self, request):
+        request._ultracache_debug = Collector()
+
+    def generate_stats(self, request, response):
+        collector = get_collector(request)
+        if collector is not None:
+            self.record_stats(collector.summary())
@@ -0,0 +1,187 @@
+"""Refresh on invalidate. With
+
+    ULTRACACHE = {
+        "refresh": {
+            "enabled": True,
+            "hosts": ["example.com"],
+            "workers": 2,
+            "rate": 10,
+            "queue-size": 1000
+        }
+    }
+
+the paths that contained an invalidated object are rendered again in worker
+threads through the full request stack, so the cache is refilled before the
+next visitor asks for them. Paths are requested for each host, which must be
+in ALLOWED_HOSTS. hosts defaults to the domains of the sites framework. A path that is already queued is not queued
+again. Workers request at most rate paths per second in total. Refreshing is
+best effort: paths are dropped when the queue is full."""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+
+logger = logging.getLogger("ultracache.refresh")
+
+# Test clients per host per worker thread
+_local = threading.local()
+
+
+def _conf():
+    try:
+        return settings.ULTRACACHE["refresh"]
+    except (AttributeError, KeyError):
+        return {}
+
+
+def get_client(host):
+    clients = _local.__dict__.setdefault("clients", {})
+    try:
+        return clients[host]
+    except KeyError:
+        # The test client is only needed once something is refreshed
+        from django.test.client import Client
+        extra = {"HTTP_HOST": host} if host else {}
+        client = clients[host] = Client(**extra)
+        return client
+
+
+def warm(host, path):
+    """Request path through the full request stack. Return a tuple of host,
+    path, status code and duration."""
+    client = get_client(host)
+    t0 = time.perf_counter()
+    try:
+        status = client.get(path).status_code
+    except Exception as e:
+        # Report the exception in place of a status code
+        status = e.__class__.__name__
+    return host, path, status, time.perf_counter() - t0
+
+
+def get_hosts():
+    """Return the configured hosts, else the domains of the sites
+    framework. Without hosts the test client would send its own Host header,
+    which the site rejects."""
+    hosts = _conf().get("hosts", None)
+    if (not hosts) and ("django.contrib.sites" in settings.INSTALLED_APPS):
+        from django.contrib.sites.models import Site
+        hosts = list(Site.objects.values_list("domain", flat=True))
+    if not hosts:
+        raise ImproperlyConfigured(
+            "Refresh on invalidate requires ULTRACACHE[\"refresh\"][\"hosts\"]"
+        )
+    return hosts
+
+
+def check():
+    """Fail at startup if refreshing is enabled without any way to find the
+    hosts."""
+    if _conf().get("enabled", False) and not _conf().get("hosts", None) \
+        and ("django.contrib.sites" not in settings.INSTALLED_APPS):
+        raise ImproperlyConfigured(
+            "Refresh on invalidate requires ULTRACACHE[\"refresh\"][\"hosts\"]"
+        )
+
+
+class Refresher(object):
+    """Request queued paths for each configured host in worker threads."""
+
+    def __init__(self):
+        conf = _conf()
+        self.hosts = get_hosts()
+        self.workers = conf.get("workers", 2)
+        self.rate = conf.get("rate", 10)
+        self.queue = queue.Queue(conf.get("queue-size", 1000))
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pending = set()
+        self.next_time = 0.0
+
+    def start(self):
+        # Threads do not survive a fork so start them lazily per process
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.pending = set()
+            for n in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name="ultracache-refresh-%s" % n
+                )
+                thread.daemon = True
+                thread.start()
+            self.pid = os.getpid()
+
+    def throttle(self):
+        """Sleep until the next request is allowed."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                with self.lock:
+                    self.pending.discard(item)
+                self.throttle()
+                host, path, status, seconds = warm(*item)
+                if status != 200:
+                    logger.warning(
+                        "Refresh of %s%s returned %s", host or "", path, status
+                    )
+            finally:
+                self.queue.task_done()
+
+    def refresh(self, paths):
+        self.start()
+        for path in paths:
+            for host in self.hosts:
+                item = (host, path)
+                with self.lock:
+                    if item in self.pending:
+                        continue
+                    self.pending.add(item)
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    with self.lock:
+                        self.pending.discard(item)
+                    logger.warning(
+                        "Refresh queue is full, dropping %s%s", host or "", path
+                    )
+
+    def join(self):
+        """Wait until all queued paths are refreshed."""
+        self.queue.join()
+
+
+_refresher = None
+
+
+def get_refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = Refresher()
+    return _refresher
+
+
+def refresh(paths):
+    """Queue paths for refreshing once the current transaction commits, so
+    they are not rendered with the old state of the invalidated object."""
+    if paths and _conf().get("enabled", False):
+        refresher = get_refresher()
+        transaction.on_commit(lambda: refresher.refresh(paths))
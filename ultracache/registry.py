@@ -0,0 +1,444 @@
+"""Registries map an object or content type to the cache keys or paths that
+depend on it. Each member is stored as a (member, expiry) tuple where expiry
+is the timestamp at which the cached content expires, or None if it never
+does. Members of paths registries expire after PATH_TIMEOUT instead, because
+the proxy caches pages independently. Expired members are dropped whenever a
+registry is read and modified, and the registry itself expires with its
+longest lived member.
+
+A registry value may not exceed MAX_SIZE. When the head value, which holds
+the newest members, grows beyond it the oldest members are moved to a
+numbered page and the head keeps a list of (page number, expiry) tuples.
+Only once a registry has more than MAX_PAGES pages is the oldest page
+evicted, and with it the cache keys it lists.
+
+Django's cache cannot enumerate keys, so the registries written by
+cache_meta are recorded in a sharded key index. The index makes it possible
+to garbage collect registries: drop references to cache keys that have
+expired and rewrite the compacted values.
+
+The index is best effort. Concurrent writers may lose an entry and entries
+expire after INDEX_TIMEOUT unless compaction finds their registry alive, in
+which case that registry simply expires through its timeout without being
+compacted."""
+
+import math
+import pickle
+import sys
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# The metadata itself can"t be allowed to grow endlessly. This value is the
+# maximum size in bytes of a metadata list. If your caching backend supports
+# compression set a larger value.
+try:
+    MAX_SIZE = settings.ULTRACACHE["max-registry-value-size"]
+except (AttributeError, KeyError):
+    MAX_SIZE = 25000
+
+# The maximum number of overflow pages per registry
+try:
+    MAX_PAGES = settings.ULTRACACHE["max-registry-pages"]
+except (AttributeError, KeyError):
+    MAX_PAGES = 10
+
+try:
+    INDEX = settings.ULTRACACHE["registry-index"]
+except (AttributeError, KeyError):
+    INDEX = True
+
+INDEX_SHARDS = 16
+
+# Timeout of key index entries. Compaction refreshes the entries of the
+# registries it keeps, so run it more often than this.
+INDEX_TIMEOUT = 7 * 86400
+
+# Timeout of members that were registered without one, including members
+# written by versions that did not store expiry.
+REGISTRY_TIMEOUT = 86400
+
+# Timeout of paths registry members. A proxy may cache a page longer than
+# the fragments and views it contains, so paths do not expire with them.
+try:
+    PATH_TIMEOUT = settings.ULTRACACHE["path-registry-timeout"]
+except (AttributeError, KeyError):
+    PATH_TIMEOUT = REGISTRY_TIMEOUT
+
+
+def _size(value):
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def reduce_list_size(li):
+    """Return two lists
+        - the last N items of li whose total size is less than MAX_SIZE
+        - the rest of the original list li
+    """
+    size = sys.getsizeof(li)
+    keep = li
+    toss = []
+    n = len(li)
+    decrement_by = max(n // 10, 10)
+    while (size >= MAX_SIZE) and (n > 0):
+        n = max(n - decrement_by, 0)
+        toss = li[:len(li) - n]
+        keep = li[len(li) - n:]
+        size = sys.getsizeof(keep)
+    return keep, toss
+
+
+def get_capacity():
+    """Return the number of entries that fit in MAX_SIZE as measured by
+    reduce_list_size."""
+    empty = sys.getsizeof([])
+    per_entry = sys.getsizeof([None]) - empty
+    return max((MAX_SIZE - empty - 1) // per_entry, 1)
+
+
+def get_expiry(timeout, now):
+    """Return the expiry timestamp for a cache timeout in seconds."""
+    if timeout is None:
+        return None
+    return now + timeout
+
+
+def get_max_expiry(entries):
+    expiries = [e for m, e in entries]
+    if None in expiries:
+        return None
+    return max(expiries)
+
+
+def get_entries(value, now):
+    """Return the unexpired (member, expiry) tuples of a registry value.
+    Plain members written by earlier versions get the default timeout."""
+    entries = []
+    for entry in value:
+        if not isinstance(entry, tuple):
+            entry = (entry, now + REGISTRY_TIMEOUT)
+        if (entry[1] is None) or (entry[1] >= now):
+            entries.append(entry)
+    return entries
+
+
+def split_head(value, now):
+    """Return the unexpired entries and page references of a registry
+    head."""
+    if isinstance(value, dict):
+        return get_entries(value["entries"], now), \
+            get_entries(value["pages"], now)
+    return get_entries(value or [], now), []
+
+
+def make_head(entries, pages):
+    if pages:
+        return {"entries": entries, "pages": pages}
+    return entries
+
+
+def get_page_key(registry_key, n):
+    return "%s-p%s" % (registry_key, n)
+
+
+def get_members(value):
+    """Return the unexpired members of a registry head. Members in overflow
+    pages are not included, use read_registries for those."""
+    return [m for m, e in split_head(value, time.time())[0]]
+
+
+def add_entry(entries, member, expiry):
+    """Return entries with member added or its expiry extended."""
+    for n, (m, e) in enumerate(entries):
+        if m == member:
+            if (e is None) or ((expiry is not None) and (e >= expiry)):
+                return entries
+            return entries[:n] + entries[n + 1:] + [(member, expiry)]
+    return entries + [(member, expiry)]
+
+
+def get_timeout(entries, now):
+    """Return the timeout that makes a registry live as long as its longest
+    lived member."""
+    if not entries:
+        return None
+    expiry = get_max_expiry(entries)
+    if expiry is None:
+        return None
+    return max(int(math.ceil(expiry - now)), 1)
+
+
+def head_timeout(value, now):
+    """Return the timeout of a head, which must outlive its pages."""
+    entries, pages = split_head(value, now)
+    return get_timeout(entries + pages, now)
+
+
+def paginate(registry_key, entries, pages):
+    """Move the oldest entries to new pages until the head fits MAX_SIZE.
+    Return the head value, a dictionary of new page values, the keys of
+    stored pages evicted because there are more than MAX_PAGES and the
+    entries of new pages that were evicted before being stored."""
+    new_pages = {}
+    capacity = get_capacity()
+    if len(entries) <= capacity:
+        return make_head(entries, pages), new_pages, [], []
+
+    # The head keeps the newest half so it does not overflow again on the
+    # next write. The oldest entries go to the lowest numbered page.
+    split = len(entries) - max(capacity // 2, 1)
+    keep, toss = entries[split:], entries[:split]
+    n = max([p for p, e in pages] or [0])
+    for i in range(0, len(toss), capacity):
+        chunk = toss[i:i + capacity]
+        n += 1
+        new_pages[get_page_key(registry_key, n)] = chunk
+        pages = pages + [(n, get_max_expiry(chunk))]
+    evicted = []
+    evicted_entries = []
+    while len(pages) > MAX_PAGES:
+        page_key = get_page_key(registry_key, pages[0][0])
+        pages = pages[1:]
+        if page_key in new_pages:
+            evicted_entries.extend(new_pages.pop(page_key))
+        else:
+            evicted.append(page_key)
+    return make_head(keep, pages), new_pages, evicted, evicted_entries
+
+
+def read_registries(keys, heads=None):
+    """Return a dictionary of registry key to all its unexpired entries,
+    oldest first, and a dictionary of the pages that were read. Heads are
+    read with one get_many and all their pages with another."""
+    now = time.time()
+    if heads is None:
+        heads = cache.get_many(keys)
+    page_keys = []
+    for key in keys:
+        if key in heads:
+            for n, expiry in split_head(heads[key], now)[1]:
+                page_keys.append(get_page_key(key, n))
+    pages = cache.get_many(page_keys) if page_keys else {}
+    registries = {}
+    for key in keys:
+        if key not in heads:
+            continue
+        entries, refs = split_head(heads[key], now)
+        li = []
+        for n, expiry in refs:
+            li.extend(get_entries(pages.get(get_page_key(key, n), []), now))
+        registries[key] = li + entries
+    return registries, pages
+
+
+def write_registries(registries, now):
+    """Write complete registries, splitting them into a head and pages.
+    Empty registries are deleted. Return the page keys that were written and
+    a dictionary of the entries per registry that did not fit into MAX_PAGES
+    pages."""
+    to_delete = []
+    written = []
+    evicted_entries = {}
+    for key, entries in registries.items():
+        if not entries:
+            to_delete.append(key)
+            continue
+        head, new_pages, evicted, li = paginate(key, entries, [])
+        if li:
+            evicted_entries[key] = li
+        for page_key, page in new_pages.items():
+            cache.set(page_key, page, get_timeout(page, now))
+            written.append(page_key)
+        cache.set(key, head, head_timeout(head, now))
+    if to_delete:
+        try:
+            cache.delete_many(to_delete)
+        except NotImplementedError:
+            for k in to_delete:
+                cache.delete(k)
+    return written, evicted_entries
+
+
+def get_shard_key(registry_key):
+    return "ucache-index-%s" % (
+        zlib.crc32(registry_key.encode("utf-8")) % INDEX_SHARDS
+    )
+
+
+def get_shard_keys():
+    return ["ucache-index-%s" % n for n in range(INDEX_SHARDS)]
+
+
+def add_to_index(registry_keys):
+    """Record newly created registries in the key index. Only registries of
+    cache keys are indexed because paths registries are never compacted.
+    Shards are paged like registries and their entries expire after
+    INDEX_TIMEOUT."""
+    if not (INDEX and registry_keys):
+        return
+    now = time.time()
+    expiry = now + INDEX_TIMEOUT
+    shards = {}
+    for key in registry_keys:
+        shards.setdefault(get_shard_key(key), []).append(key)
+    di = cache.get_many(list(shards.keys()))
+    to_set = {}
+    to_delete = []
+    for shard_key, keys in shards.items():
+        entries, pages = split_head(di.get(shard_key, None), now)
+        present = set(m for m, e in entries)
+        new = [(k, expiry) for k in keys if k not in present]
+        if not new:
+            continue
+        # Entries evicted along with the oldest pages are simply no longer
+        # compacted
+        head, new_pages, evicted, evicted_entries = paginate(
+            shard_key, entries + new, pages
+        )
+        to_set[shard_key] = head
+        to_set.update(new_pages)
+        to_delete.extend(evicted)
+    if to_delete:
+        try:
+            cache.delete_many(to_delete)
+        except NotImplementedError:
+            for k in to_delete:
+                cache.delete(k)
+    if to_set:
+        cache.set_many(to_set, INDEX_TIMEOUT)
+
+
+def get_indexed_keys():
+    """Return the registry keys in the key index."""
+    registries, pages = read_registries(get_shard_keys())
+    keys = []
+    seen = set()
+    for entries in registries.values():
+        for member, expiry in entries:
+            if member not in seen:
+                seen.add(member)
+                keys.append(member)
+    return keys
+
+
+def compact(batch_size=500, dry_run=False):
+    """Scan the indexed registries, drop cache keys that no longer exist and
+    rewrite the compacted values. A registry without live cache keys is
+    deleted. Paths registries are left alone because the proxy may still
+    cache their paths, they expire through their own timeout. Return a
+    dictionary of statistics."""
+    stats = {
+        "registries": 0,
+        "deleted_registries": 0,
+        "keys": 0,
+        "dropped_keys": 0,
+        "bytes_before": 0,
+        "bytes_after": 0
+    }
+    indexed = get_indexed_keys()
+    indexed_set = set(indexed)
+    to_unindex = set()
+
+    for i in range(0, len(indexed), batch_size):
+        batch = indexed[i:i + batch_size]
+        heads = cache.get_many(batch)
+        registries, pages = read_registries(batch, heads)
+
+        # Find which of the referenced cache keys still exist. The cache API
+        # has no multi key exists, so the small objects list stored next to
+        # every registered key is fetched instead of the content.
+        members = []
+        seen = set()
+        for key in batch:
+            for member, expiry in registries.get(key, []):
+                if member not in seen:
+                    seen.add(member)
+                    members.append(member)
+        live = set()
+        for j in range(0, len(members), batch_size):
+            live.update(k[:-len("-objs")] for k in cache.get_many(
+                [m + "-objs" for m in members[j:j + batch_size]]
+            ))
+
+        def stored(key):
+            # The head and page keys of a registry and their size as stored
+            keys = [key] + [k for k in pages if k.startswith(key + "-p")]
+            return keys, sum(_size(heads[k] if k == key else pages[k])
+                for k in keys if (k in heads) or (k in pages))
+
+        dropped = {}
+        to_delete = []
+        for key in batch:
+            if key not in heads:
+                # The registry expired
+                to_unindex.add(key)
+                continue
+
+            entries = registries[key]
+            key_stored, size = stored(key)
+            stats["registries"] += 1
+            stats["keys"] += len(entries)
+            stats["bytes_before"] += size
+            keep = [e for e in entries if e[0] in live]
+            stats["dropped_keys"] += len(entries) - len(keep)
+            if not keep:
+                to_unindex.add(key)
+                to_delete.extend(key_stored)
+                stats["deleted_registries"] += 1
+                continue
+            stats["bytes_after"] += _size(keep)
+            dropped[key] = set(m for m, e in entries) - set(m for m, e in keep)
+
+        if dry_run:
+            continue
+
+        # Re-read just before writing and remove only the dropped keys so
+        # members registered while scanning are not lost.
+        if dropped:
+            now = time.time()
+            fresh, old_pages = read_registries(list(dropped.keys()))
+            written, evicted_entries = write_registries(dict(
+                (key, [e for e in entries if e[0] not in dropped[key]])
+                for key, entries in fresh.items()
+            ), now)
+            to_delete.extend(set(old_pages.keys()) - set(written))
+            # Cache keys that no longer fit must be deleted
+            for key, li in evicted_entries.items():
+                to_delete.extend([m for m, e in li])
+        if to_delete:
+            try:
+                cache.delete_many(to_delete)
+            except NotImplementedError:
+                for k in to_delete:
+                    cache.delete(k)
+
+    # Registries that are still alive stay indexed for another
+    # INDEX_TIMEOUT
+    if indexed and not dry_run:
+        now = time.time()
+        expiry = now + INDEX_TIMEOUT
+        shards, old_pages = read_registries(get_shard_keys())
+        to_write = {}
+        for shard_key, entries in shards.items():
+            li = []
+            seen = set()
+            for member, e in entries:
+                if (member in to_unindex) or (member in seen):
+                    continue
+                seen.add(member)
+                li.append((member, expiry if member in indexed_set else e))
+            to_write[shard_key] = li
+        written, evicted_entries = write_registries(to_write, now)
+        to_delete = set(old_pages.keys()) - set(written)
+        if to_delete:
+            try:
+                cache.delete_many(list(to_delete))
+            except NotImplementedError:
+                for k in to_delete:
+                    cache.delete(k)
+
+    stats["bytes_reclaimed"] = stats["bytes_before"] - stats["bytes_after"]
+    return stats
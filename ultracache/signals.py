@@ -1,10 +1,19 @@
+import json
+import logging
+import pickle
+import time
+
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.db.migrations.recorder import MigrationRecorder
 from django.db.models import Model
 from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
+from django.dispatch import receiver, Signal
+
+from ultracache.dispatch import dispatch
+from ultracache.refresh import refresh
+from ultracache.registry import read_registries
 
 
 try:
@@ -23,6 +32,110 @@ except (AttributeError, KeyError):
     invalidate = True
 
 
+logger = logging.getLogger("ultracache.invalidation")
+
+# Sent after each invalidation event with a record describing its fan-out
+invalidated = Signal(providing_args=["record"])
+
+
+def expire(registry_keys, paths_keys, record):
+    """Expire the cache keys listed in the registries registry_keys and purge
+    the paths listed in the registries paths_keys. Update record with the
+    fan-out."""
+    t0 = time.perf_counter()
+    # Heads are read together and their overflow pages in one more get_many.
+    # Members that have already expired need not be deleted.
+    registries, pages = read_registries(registry_keys + paths_keys)
+    to_delete = []
+    for key in registry_keys:
+        to_delete.extend([m for m, e in registries.get(key, [])])
+    paths = []
+    seen = set()
+    for key in paths_keys:
+        for m, e in registries.get(key, []):
+            if m not in seen:
+                seen.add(m)
+                paths.append(m)
+    keys = to_delete + registry_keys + paths_keys + list(pages.keys())
+    try:
+        cache.delete_many(keys)
+    except NotImplementedError:
+        for k in keys:
+            cache.delete(k)
+    t1 = time.perf_counter()
+
+    # Render the paths again in the background if enabled
+    refresh(paths)
+
+    if purger is not None:
+        for path in paths:
+            purger(path)
+    t2 = time.perf_counter()
+
+    record["keys"] += len(to_delete)
+    record["paths"] += len(paths)
+    # Pickled size of the registry values that were read
+    record["registry_bytes"] += len(
+        pickle.dumps((registries, pages), pickle.HIGHEST_PROTOCOL)
+    )
+    record["delete_seconds"] += t1 - t0
+    record["purge_seconds"] += t2 - t1
+
+
+def make_record(ct, pk, event):
+    return {
+        "timestamp": time.time(),
+        "model": "%s.%s" % (ct.app_label, ct.model),
+        "pk": pk,
+        "event": event,
+        "keys": 0,
+        "paths": 0,
+        "registry_bytes": 0,
+        "delete_seconds": 0.0,
+        "purge_seconds": 0.0,
+        "queued_seconds": 0.0
+    }
+
+
+def report(record):
+    """Send the record to the structured log and the invalidated signal."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record, sort_keys=True, default=str))
+    invalidated.send(sender=None, record=record)
+
+
+def invalidate_object(ctid, pk, event, queued=None):
+    """Expire the cache keys and purge the paths affected by an event. event
+    is one of create, save or delete. queued is the time the event was
+    queued by an asynchronous dispatcher."""
+    # get_for_id itself is cached
+    ct = ContentType.objects.get_for_id(ctid)
+    record = make_record(ct, pk, event)
+    if queued is not None:
+        record["queued_seconds"] = record["timestamp"] - queued
+
+    # Cache keys and paths that track any object of this content type are
+    # always expired and purged.
+    if event == "create":
+        # Expire cache keys that contain objects of this content type and
+        # purge paths in reverse caching proxy that contain objects of this
+        # content type.
+        expire(
+            ["ucache-ct-%s" % ctid, "ucache-any-%s" % ctid],
+            ["ucache-ct-pth-%s" % ctid, "ucache-pth-any-%s" % ctid],
+            record
+        )
+    else:
+        # Expire cache keys and purge paths in reverse caching proxy
+        expire(
+            ["ucache-%s-%s" % (ctid, pk), "ucache-any-%s" % ctid],
+            ["ucache-pth-%s-%s" % (ctid, pk), "ucache-pth-any-%s" % ctid],
+            record
+        )
+
+    report(record)
+
+
 @receiver(post_save)
 def on_post_save(sender, **kwargs):
     """Expire ultracache cache keys affected by this object
@@ -44,44 +157,10 @@ def on_post_save(sender, **kwargs):
                 # during a test run.
                 return
 
-            if kwargs.get("created", False):
-                # Expire cache keys that contain objects of this content type
-                key = "ucache-ct-%s" % ct.id
-                to_delete = cache.get(key, [])
-                if to_delete:
-                    try:
-                        cache.delete_many(to_delete)
-                    except NotImplementedError:
-                        for k in to_delete:
-                            cache.delete(k)
-                cache.delete(key)
-
-                # Purge paths in reverse caching proxy that contain objects of
-                # this content type.
-                key = "ucache-ct-pth-%s" % ct.id
-                if purger is not None:
-                    for path in cache.get(key, []):
-                        purger(path)
-                cache.delete(key)
-
-            else:
-                # Expire cache keys
-                key = "ucache-%s-%s" % (ct.id, obj.pk)
-                to_delete = cache.get(key, [])
-                if to_delete:
-                    try:
-                        cache.delete_many(to_delete)
-                    except NotImplementedError:
-                        for k in to_delete:
-                            cache.delete(k)
-                cache.delete(key)
-
-                # Purge paths in reverse caching proxy
-                key = "ucache-pth-%s-%s" % (ct.id, obj.pk)
-                if purger is not None:
-                    for path in cache.get(key, []):
-                        purger(path)
-                cache.delete(key)
+            dispatch(
+                ct.id, obj.pk,
+                "create" if kwargs.get("created", False) else "save"
+            )
 
 
 @receiver(post_delete)
@@ -105,20 +184,4 @@ def on_post_delete(sender, **kwargs):
                 # during a test run.
                 return
 
-            # Expire cache keys
-            key = "ucache-%s-%s" % (ct.id, obj.pk)
-            to_delete = cache.get(key, [])
-            if to_delete:
-                try:
-                    cache.delete_many(to_delete)
-                except NotImplementedError:
-                    for k in to_delete:
-                        cache.delete(k)
-            cache.delete(key)
-
-            # Invalidate paths in reverse caching proxy
-            key = "ucache-pth-%s-%s" % (ct.id, obj.pk)
-            if purger is not None:
-                for path in cache.get(key, []):
-                    purger(path)
-            cache.delete(key)
+            dispatch(ct.id, obj.pk, "delete")
@@ -1,5 +1,4 @@
-import urllib
-import urlparse
+import urllib.parse
 
 from celery import shared_task
 try:
@@ -39,3 +38,9 @@ def broadcast_purge(path):
     )
     connection.close()
     return True
+
+
+@shared_task(ignore_result=True)
+def invalidate(ctid, pk, event, queued=None):
+    from ultracache.dispatch import process
+    process(ctid, pk, event, queued)
@@ -1,13 +1,25 @@
+import time
+
 from django import template
+from django.template import TemplateSyntaxError
 from django.utils.translation import ugettext as _
 from django.utils.functional import Promise
 from django.templatetags.cache import CacheNode
 from django.template.base import VariableDoesNotExist
+try:
+    from django.template.base import TokenType
+    TOKEN_TEXT, TOKEN_VAR, TOKEN_BLOCK = \
+        TokenType.TEXT, TokenType.VAR, TokenType.BLOCK
+except ImportError:
+    from django.template.base import TOKEN_TEXT, TOKEN_VAR, TOKEN_BLOCK
 from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
 from django.conf import settings
 
-from ultracache.utils import cache_meta, get_current_site_pk
+from ultracache import adaptive, admission, esi, metrics
+from ultracache.debug import get_collector
+from ultracache.utils import cache_meta, get_current_site_pk, \
+    get_registered_path, get_tracked, make_placeholder, render_placeholders
 
 
 register = template.Library()
@@ -26,6 +38,9 @@ class UltraCacheNode(CacheNode):
         except TypeError:
             super(UltraCacheNode, self).__init__(*args)
 
+        # The fragment name is not a variable but may be quoted
+        self.metric_name = self.fragment_name.strip("\"'")
+
     def render(self, context):
         try:
             expire_time = self.expire_time_var.resolve(context)
@@ -46,14 +61,11 @@ class UltraCacheNode(CacheNode):
         if request.method.lower() not in ("get", "head"):
             return self.nodelist.render(context)
 
-        # Set a list on the request. Django's template rendering is recursive
-        # and single threaded so we can use a list to keep track of contained
-        # objects.
-        if not hasattr(request, "_ultracache"):
-            setattr(request, "_ultracache", [])
-            start_index = 0
-        else:
-            start_index = len(request._ultracache)
+        # Track objects in a list, normally set on the request. Django's
+        # template rendering is recursive and single threaded so we can use a
+        # list to keep track of contained objects.
+        tracked = get_tracked(request, True)
+        start_index = len(tracked)
 
         vary_on = []
         if "django.contrib.sites" in settings.INSTALLED_APPS:
@@ -68,21 +80,97 @@ class UltraCacheNode(CacheNode):
                 r = str(r)
             vary_on.append(r)
 
+        # Fragments for an ESI capable proxy contain esi:include tags for
+        # nested fragments so they are cached separately.
+        use_esi = esi.is_esi(request)
+        if use_esi:
+            vary_on.append("esi")
+
         cache_key = make_template_fragment_key(self.fragment_name, vary_on)
-        value = cache.get(cache_key)
+        esi_src = None
+        if use_esi:
+            esi_src = esi.get_src(cache_key, get_registered_path(request))
+        collector = get_collector(request)
+        if collector is not None:
+            entry = collector.start("fragment", self.metric_name, cache_key)
+
+        # Nested fragments leave ultracache_nocache blocks for the outermost
+        # fragment to render.
+        outermost = not context.get("_ultracache_fragment", False)
+
+        # Fragments that are not worth caching are not looked up. The
+        # fragment view needs every fragment in ESI mode.
+        value = None
+        if use_esi or not admission.is_rejected("fragment", self.metric_name):
+            value = cache.get(cache_key)
         if value is None:
-            value = self.nodelist.render(context)
-            cache.set(cache_key, value, expire_time)
-            cache_meta(request, cache_key, start_index)
+            t0 = time.perf_counter()
+            with context.push(_ultracache_fragment=True):
+                value = self.nodelist.render(context)
+            t1 = time.perf_counter()
+            registry_time = 0
+            stored_bytes = 0
+            if admission.admit("fragment", self.metric_name, t1 - t0, len(value)) \
+                or use_esi:
+                expire_time = adaptive.get_timeout(
+                    "fragment", self.metric_name, cache_key, expire_time
+                )
+                cache.set(cache_key, value, expire_time)
+                stored_bytes = len(value)
+                t2 = time.perf_counter()
+                cache_meta(
+                    request, cache_key, start_index, expire_time, esi_src
+                )
+                registry_time = time.perf_counter() - t2
+            metrics.miss(
+                "fragment", self.metric_name, t1 - t0, stored_bytes,
+                registry_time
+            )
+            if collector is not None:
+                collector.stop(
+                    entry, False, tracked[start_index:], t1 - t0
+                )
+            # The proxy assembles the page so objects in the fragment are
+            # not registered against it.
+            if esi_src is not None:
+                del tracked[start_index:]
         else:
+            metrics.hit("fragment", self.metric_name)
             # A cached result was found. Set tuples in _ultracache manually so
             # outer template tags are aware of contained objects.
-            for tu in cache.get(cache_key + "-objs", []):
-                request._ultracache.append(tu)
-
+            objs = cache.get(cache_key + "-objs", [])
+            if esi_src is None:
+                tracked.extend(objs)
+            if collector is not None:
+                collector.stop(entry, True, objs)
+
+        if esi_src is not None:
+            return esi.include(esi_src)
+        # A cached view or the middleware stores the placeholders and renders
+        # them itself.
+        if outermost \
+            and not getattr(request, "_ultracache_placeholders", False):
+            return render_placeholders(value, context)
         return value
 
 
+class NoCacheNode(template.Node):
+    """Render the template source per request, even inside a cached
+    fragment."""
+
+    def __init__(self, source):
+        # Compile now so syntax errors surface when the template is loaded
+        self.template = template.Template(source)
+        self.placeholder = make_placeholder(source)
+
+    def render(self, context):
+        if context.get("_ultracache_fragment", False) or getattr(
+            context.get("request", None), "_ultracache_placeholders", False
+        ):
+            return self.placeholder
+        return self.template.render(context)
+
+
 @register.tag("ultracache")
 def do_ultracache(parser, token):
     """Based on Django's default cache template tag"""
@@ -95,3 +183,24 @@ def do_ultracache(parser, token):
         parser.compile_filter(tokens[1]),
         tokens[2], # fragment_name can"t be a variable.
         [parser.compile_filter(token) for token in tokens[3:]])
+
+
+@register.tag("ultracache_nocache")
+def do_ultracache_nocache(parser, token):
+    """Store the source of the block in the enclosing fragment. It is
+    compiled on its own so it must load the tag libraries it uses."""
+    bits = []
+    while True:
+        try:
+            token = parser.next_token()
+        except IndexError:
+            raise TemplateSyntaxError("Unclosed tag 'ultracache_nocache'")
+        if token.token_type == TOKEN_BLOCK:
+            if token.contents == "endultracache_nocache":
+                break
+            bits.append("{%% %s %%}" % token.contents)
+        elif token.token_type == TOKEN_VAR:
+            bits.append("{{ %s }}" % token.contents)
+        elif token.token_type == TOKEN_TEXT:
+            bits.append(token.contents)
+    return NoCacheNode("".join(bits))
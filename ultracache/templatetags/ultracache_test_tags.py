@@ -3,7 +3,10 @@
 import re
 
 from django import template
-from django.core.urlresolvers import reverse, get_script_prefix, resolve
+try:
+    from django.urls import reverse, get_script_prefix, resolve
+except ImportError:
+    from django.core.urlresolvers import reverse, get_script_prefix, resolve
 from django.http import HttpResponse
 from django.template.response import TemplateResponse
 from django.conf import settings
@@ -0,0 +1,156 @@
+"""Helpers to lock in cache round trip budgets in tests. Wrap the real
+backend in the test settings
+
+    CACHES = {
+        "default": {
+            "BACKEND": "ultracache.testing.CountingCache",
+            "OPTIONS": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+            }
+        }
+    }
+
+and use CacheCallsMixin.assertNumCacheCalls like assertNumQueries."""
+
+import pickle
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+try:
+    from django.utils.module_loading import import_string as importer
+except ImportError:
+    from django.utils.module_loading import import_by_path as importer
+
+
+def _size(value):
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class CountingCache(BaseCache):
+    """Cache backend that wraps the backend set in OPTIONS["BACKEND"] and
+    records every call as a (method, number of keys, bytes) tuple in calls.
+    Bytes are the pickled size of the values written or read."""
+
+    def __init__(self, location, params):
+        params = dict(params)
+        options = dict(params.get("OPTIONS", {}))
+        backend = options.pop(
+            "BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        )
+        params["OPTIONS"] = options
+        super(CountingCache, self).__init__(params)
+        self.wrapped = importer(backend)(location, params)
+        self.calls = []
+
+    def record(self, method, keys, size=0):
+        self.calls.append((method, keys, size))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.record("add", 1, _size(value))
+        return self.wrapped.add(key, value, timeout, version)
+
+    def get(self, key, default=None, version=None):
+        value = self.wrapped.get(key, default, version)
+        self.record("get", 1, _size(value) if value is not default else 0)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.record("set", 1, _size(value))
+        return self.wrapped.set(key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        self.record("delete", 1)
+        return self.wrapped.delete(key, version)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        di = self.wrapped.get_many(keys, version)
+        self.record("get_many", len(keys), _size(di) if di else 0)
+        return di
+
+    def has_key(self, key, version=None):
+        self.record("has_key", 1)
+        return self.wrapped.has_key(key, version)
+
+    def incr(self, key, delta=1, version=None):
+        self.record("incr", 1)
+        return self.wrapped.incr(key, delta, version)
+
+    def decr(self, key, delta=1, version=None):
+        self.record("decr", 1)
+        return self.wrapped.decr(key, delta, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.record("set_many", len(data), _size(data))
+        return self.wrapped.set_many(data, timeout, version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.record("delete_many", len(keys))
+        return self.wrapped.delete_many(keys, version)
+
+    def clear(self):
+        self.record("clear", 0)
+        return self.wrapped.clear()
+
+    def close(self, **kwargs):
+        return self.wrapped.close(**kwargs)
+
+
+class _AssertNumCacheCallsContext(object):
+
+    def __init__(self, test_case, num, backend, methods):
+        self.test_case = test_case
+        self.num = num
+        self.backend = backend
+        self.methods = methods
+        self.calls = []
+
+    def __enter__(self):
+        if not isinstance(self.backend, CountingCache):
+            raise TypeError(
+                "assertNumCacheCalls requires ultracache.testing.CountingCache"
+            )
+        self.start = len(self.backend.calls)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return
+        self.calls = self.backend.calls[self.start:]
+        captured = "\n".join(
+            "%s keys=%s bytes=%s" % call for call in self.calls
+        )
+        if self.num is not None:
+            self.test_case.assertEqual(
+                len(self.calls), self.num,
+                "%d cache calls made, %d expected\nCaptured calls were:\n%s" % (
+                    len(self.calls), self.num, captured
+                )
+            )
+        for method, num in self.methods.items():
+            made = len([c for c in self.calls if c[0] == method])
+            self.test_case.assertEqual(
+                made, num,
+                "%d %s calls made, %d expected\nCaptured calls were:\n%s" % (
+                    made, method, num, captured
+                )
+            )
+
+    @property
+    def bytes(self):
+        return sum(c[2] for c in self.calls)
+
+
+class CacheCallsMixin(object):
+    """TestCase mixin providing assertNumCacheCalls."""
+
+    def assertNumCacheCalls(self, num, using="default", **methods):
+        """Context manager asserting that num cache calls are made. Pass
+        eg. set_many=1 to also assert the number of calls per method. Use
+        None for num to only check methods."""
+        return _AssertNumCacheCallsContext(self, num, caches[using], methods)
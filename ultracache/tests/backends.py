@@ -0,0 +1,61 @@
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class LatencyCache(LocMemCache):
+    """In-memory stand-in for a networked backend like memcached. Every call,
+    including the *_many calls, costs one simulated round trip. Configure the
+    latency in seconds with OPTIONS = {"latency": 0.0005}."""
+
+    # Django creates a backend instance per thread so count on the class
+    round_trips = 0
+    lock = threading.Lock()
+
+    def __init__(self, name, params):
+        super(LatencyCache, self).__init__(name, params)
+        self.latency = params.get("OPTIONS", {}).get("latency", 0.0005)
+
+    def round_trip(self):
+        with LatencyCache.lock:
+            LatencyCache.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.round_trip()
+        return super(LatencyCache, self).add(key, value, timeout, version)
+
+    def get(self, key, default=None, version=None, acquire_lock=True):
+        self.round_trip()
+        return super(LatencyCache, self).get(key, default, version, acquire_lock)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.round_trip()
+        return super(LatencyCache, self).set(key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        self.round_trip()
+        return super(LatencyCache, self).delete(key, version)
+
+    def get_many(self, keys, version=None):
+        self.round_trip()
+        di = {}
+        for k in keys:
+            v = LocMemCache.get(self, k, version=version)
+            if v is not None:
+                di[k] = v
+        return di
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.round_trip()
+        for k, v in data.items():
+            LocMemCache.set(self, k, v, timeout, version)
+        return []
+
+    def delete_many(self, keys, version=None):
+        self.round_trip()
+        for k in keys:
+            LocMemCache.delete(self, k, version)
@@ -0,0 +1,242 @@
+"""Microbenchmarks for the hot paths of ultracache. Run against the test
+project, eg.
+
+    python manage.py ultracache_benchmark --settings=ultracache.tests.settings.111 \
+        --backend latency --output bench.json
+
+and compare two runs with --compare."""
+
+import json
+import platform
+import sys
+import time
+
+import django
+from django import template
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings, setup_test_environment, \
+    teardown_test_environment
+
+from ultracache import utils
+from ultracache.signals import on_post_save
+from ultracache.tests.models import DummyModel, DummyForeignModel
+
+
+BACKENDS = {
+    "locmem": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "latency": {
+        "BACKEND": "ultracache.tests.backends.LatencyCache",
+    }
+}
+
+
+def measure(func, iterations, setup=None):
+    """Call func iterations times and return timing statistics in
+    microseconds. setup is called before each call and is not timed."""
+    timings = []
+    for i in range(iterations):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t0) * 1000000)
+    timings.sort()
+    n = len(timings)
+    return {
+        "iterations": n,
+        "min_us": timings[0],
+        "median_us": timings[n // 2],
+        "p95_us": timings[min(n - 1, int(n * 0.95))],
+        "mean_us": sum(timings) / n
+    }
+
+
+class Command(BaseCommand):
+    help = "Run the ultracache microbenchmarks and write machine-readable results."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend", default="locmem", choices=sorted(BACKENDS.keys()),
+            help="Cache backend to run against. Defaults to locmem."
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.0005,
+            help="Simulated round trip latency in seconds for the latency backend."
+        )
+        parser.add_argument(
+            "--iterations", type=int, default=100,
+            help="Iterations per benchmark. Defaults to 100."
+        )
+        parser.add_argument(
+            "--output", default=None,
+            help="Write JSON results to this file instead of stdout."
+        )
+        parser.add_argument(
+            "--compare", default=None,
+            help="Earlier JSON results to compare the medians against."
+        )
+
+    def handle(self, *args, **options):
+        backend = dict(BACKENDS[options["backend"]])
+        backend["OPTIONS"] = {"latency": options["latency"]}
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            call_command("loaddata", "sites.json", verbosity=0)
+            with override_settings(
+                CACHES={"default": backend},
+                ROOT_URLCONF="ultracache.tests.urls",
+                ALLOWED_HOSTS=["*"]
+            ):
+                results = self.run_benchmarks(options["iterations"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        data = {
+            "meta": {
+                "backend": options["backend"],
+                "latency": options["latency"] if options["backend"] == "latency" else 0,
+                "iterations": options["iterations"],
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "max_registry_value_size": utils.MAX_SIZE
+            },
+            "results": results
+        }
+        out = json.dumps(data, indent=4, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as fp:
+                fp.write(out)
+        else:
+            self.stdout.write(out)
+
+        if options["compare"]:
+            self.compare(options["compare"], results)
+
+    def compare(self, filename, results):
+        try:
+            with open(filename, "r") as fp:
+                baseline = json.load(fp)["results"]
+        except (IOError, ValueError, KeyError) as e:
+            raise CommandError("Cannot read %s: %s" % (filename, e))
+        self.stderr.write("%-40s %12s %12s %8s" % ("benchmark", "before", "after", "ratio"))
+        for name in sorted(results.keys()):
+            if name not in baseline:
+                continue
+            before = baseline[name]["median_us"]
+            after = results[name]["median_us"]
+            self.stderr.write("%-40s %12.1f %12.1f %8.2f" % (
+                name, before, after, after / before if before else 0
+            ))
+
+    def run_benchmarks(self, iterations):
+        results = {}
+        factory = RequestFactory()
+        objects = [
+            DummyModel.objects.create(title="Title %s" % i, code="code%s" % i)
+            for i in range(1000)
+        ]
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+
+        # Nested fragments
+        nested = template.Template(
+            "{% load ultracache_tags %}"
+            "{% ultracache 1200 'bench_outer' %}"
+            "{% for object in objects %}"
+            "{% ultracache 1200 'bench_inner' object.pk %}{{ object.title }}{% endultracache %}"
+            "{% endfor %}"
+            "{% endultracache %}"
+        )
+
+        def render_nested():
+            request = factory.get("/nested/")
+            nested.render(template.Context({
+                "request": request, "objects": objects[:10]
+            }))
+
+        render_nested()
+        results["fragment_nested_hit"] = measure(render_nested, iterations)
+        results["fragment_nested_miss"] = measure(
+            render_nested, iterations, setup=cache.clear
+        )
+
+        # Fragments with N tracked objects
+        flat = template.Template(
+            "{% load ultracache_tags %}"
+            "{% ultracache 1200 'bench_flat' %}"
+            "{% for object in objects %}{{ object.title }}{% endfor %}"
+            "{% endultracache %}"
+        )
+        for n in (10, 100, 1000):
+            def render_flat():
+                request = factory.get("/flat/%s/" % n)
+                flat.render(template.Context({
+                    "request": request, "objects": objects[:n]
+                }))
+            results["fragment_miss_%s_objects" % n] = measure(
+                render_flat, max(iterations // 10, 1), setup=cache.clear
+            )
+
+        # Registry writes as the registry grows towards MAX_SIZE
+        cache.clear()
+        counter = [0]
+
+        def registry_write():
+            counter[0] += 1
+            request = factory.get("/registry/%s/" % counter[0])
+            request._ultracache = [(ctid, objects[0].pk)]
+            utils.cache_meta(request, "ucache-bench-%s" % counter[0])
+
+        results["registry_write_growing"] = measure(
+            registry_write, iterations * 10
+        )
+        results["registry_write_growing"]["registry_size_bytes"] = \
+            sys.getsizeof(cache.get("ucache-%s-%s" % (ctid, objects[0].pk), []))
+
+        # Invalidation with M dependent keys
+        for m in (10, 100, 1000):
+            obj = objects[1]
+
+            def fill_registry():
+                keys = ["ucache-bench-dep-%s" % i for i in range(m)]
+                cache.set_many(dict((k, "x") for k in keys))
+                cache.set("ucache-%s-%s" % (ctid, obj.pk), keys)
+                cache.set(
+                    "ucache-pth-%s-%s" % (ctid, obj.pk),
+                    ["/path/%s/" % i for i in range(m)]
+                )
+
+            def invalidate():
+                on_post_save(DummyModel, instance=obj, created=False)
+
+            results["invalidation_%s_keys" % m] = measure(
+                invalidate, max(iterations // 10, 1), setup=fill_registry
+            )
+
+        # Cached view and viewset hits
+        client = Client()
+        DummyModel.objects.create(title="One", code="one")
+        DummyModel.objects.create(title="Two", code="two")
+        DummyModel.objects.create(title="Four", code="four")
+        DummyForeignModel.objects.create(
+            title="Three", points_to=objects[0], code="three"
+        )
+        cache.clear()
+        for name, url in (
+            ("cached_get_hit", "/cached-view/"),
+            ("drf_list_hit", "/api/dummies/"),
+            ("drf_retrieve_hit", "/api/dummies/%s/" % objects[0].pk)
+        ):
+            client.get(url)
+            results[name] = measure(lambda: client.get(url), iterations)
+
+        return results
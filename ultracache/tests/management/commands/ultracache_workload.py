@@ -0,0 +1,281 @@
+"""Replay a read/write mix against the views and viewsets of the test project
+from multiple threads and report how the cache behaves over time, eg.
+
+    python manage.py ultracache_workload --settings=ultracache.tests.settings.111 \
+        --requests 5000 --threads 8 --write-ratio 0.05 --zipf 1.1
+"""
+
+import bisect
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+from django.test.client import Client
+from django.test.utils import override_settings, setup_test_environment, \
+    teardown_test_environment
+
+from ultracache import registry
+from ultracache.metrics import aggregator
+from ultracache.signals import invalidated
+from ultracache.tests.backends import LatencyCache
+from ultracache.tests.models import DummyModel, DummyForeignModel
+
+
+def percentiles(timings):
+    """Return p50, p95 and p99 of timings in milliseconds."""
+    if not timings:
+        return {}
+    timings = sorted(timings)
+    n = len(timings)
+    return dict(
+        ("p%s_ms" % p, timings[min(n - 1, int(n * p / 100.0))] * 1000)
+        for p in (50, 95, 99)
+    )
+
+
+class Zipf(object):
+    """Sample indexes 0..n-1 where index i has weight 1 / (i + 1) ** s."""
+
+    def __init__(self, n, s):
+        total = 0.0
+        self.cumulative = []
+        for i in range(n):
+            total += 1.0 / (i + 1) ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def sample(self):
+        return bisect.bisect_left(self.cumulative, random.random() * self.total)
+
+
+class ReadWriteLock(object):
+    """SQLite locks tables while writing so readers and writers must not
+    overlap. Readers may overlap each other."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+
+    def acquire_read(self):
+        with self.condition:
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        self.condition.acquire()
+        while self.readers:
+            self.condition.wait()
+
+    def release_write(self):
+        self.condition.release()
+
+
+class Command(BaseCommand):
+    help = "Replay a configurable read/write workload against the test " \
+        "project and report hit ratio, round trips, registry sizes, purge " \
+        "volume and latency percentiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--objects", type=int, default=100)
+        parser.add_argument(
+            "--write-ratio", type=float, default=0.05,
+            help="Fraction of requests that save an object."
+        )
+        parser.add_argument(
+            "--zipf", type=float, default=1.1,
+            help="Zipf exponent of object popularity."
+        )
+        parser.add_argument(
+            "--windows", type=int, default=10,
+            help="Number of reporting windows."
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.0005,
+            help="Simulated cache round trip latency in seconds."
+        )
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--output", default=None,
+            help="Write JSON results to this file instead of stdout."
+        )
+
+    def handle(self, *args, **options):
+        if options["seed"] is not None:
+            random.seed(options["seed"])
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            call_command("loaddata", "sites.json", verbosity=0)
+            with override_settings(
+                CACHES={"default": {
+                    "BACKEND": "ultracache.tests.backends.LatencyCache",
+                    "OPTIONS": {"latency": options["latency"]}
+                }},
+                ROOT_URLCONF="ultracache.tests.urls",
+                ALLOWED_HOSTS=["*"]
+            ):
+                results = self.run_workload(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        out = json.dumps(results, indent=4, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as fp:
+                fp.write(out)
+        else:
+            self.stdout.write(out)
+
+    def run_workload(self, options):
+        objects = [
+            DummyModel.objects.create(title="Title %s" % i, code="code%s" % i)
+            for i in range(options["objects"])
+        ]
+        # Objects the cached view expects
+        for code in ("one", "two", "four"):
+            DummyModel.objects.create(title=code, code=code)
+        DummyForeignModel.objects.create(
+            title="three", points_to=objects[0], code="three"
+        )
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        cache.clear()
+        aggregator.reset()
+
+        zipf = Zipf(len(objects), options["zipf"])
+        local = threading.local()
+        lock = ReadWriteLock()
+        invalidations = {"events": 0, "keys": 0, "paths": 0}
+        invalidations_lock = threading.Lock()
+
+        def on_invalidated(sender, record, **kwargs):
+            with invalidations_lock:
+                invalidations["events"] += 1
+                invalidations["keys"] += record["keys"]
+                invalidations["paths"] += record["paths"]
+
+        invalidated.connect(on_invalidated, weak=False)
+
+        def one_request(i):
+            if not hasattr(local, "client"):
+                local.client = Client()
+            obj = objects[zipf.sample()]
+            t0 = time.perf_counter()
+            try:
+                if random.random() < options["write_ratio"]:
+                    kind = "write"
+                    lock.acquire_write()
+                    try:
+                        obj.title = "Title %s %s" % (obj.pk, i)
+                        obj.save()
+                    finally:
+                        lock.release_write()
+                else:
+                    r = random.random()
+                    if r < 0.8:
+                        kind, url = "retrieve", "/api/dummies/%s/" % obj.pk
+                    elif r < 0.9:
+                        kind, url = "list", "/api/dummies/"
+                    else:
+                        kind, url = "page", "/cached-view/"
+                    lock.acquire_read()
+                    try:
+                        local.client.get(url)
+                    finally:
+                        lock.release_read()
+            except OperationalError:
+                return kind, None
+            return kind, time.perf_counter() - t0
+
+        def totals():
+            hits = sum(
+                v for (k, n, stat), v in aggregator.counters.items()
+                if stat == "hits"
+            )
+            misses = sum(
+                v for (k, n, stat), v in aggregator.counters.items()
+                if stat == "misses"
+            )
+            return hits, misses, LatencyCache.round_trips, dict(invalidations)
+
+        windows = []
+        timings = {}
+        errors = 0
+        per_window = max(options["requests"] // options["windows"], 1)
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+                for w in range(options["windows"]):
+                    hits0, misses0, trips0, inv0 = totals()
+                    t0 = time.perf_counter()
+                    results = list(executor.map(
+                        one_request, range(w * per_window, (w + 1) * per_window)
+                    ))
+                    elapsed = time.perf_counter() - t0
+                    hits, misses, trips, inv = totals()
+
+                    window_timings = []
+                    for kind, timing in results:
+                        if timing is None:
+                            errors += 1
+                            continue
+                        timings.setdefault(kind, []).append(timing)
+                        window_timings.append(timing)
+
+                    # Count the live members in the heads and their pages
+                    registries, pages = registry.read_registries([
+                        "ucache-%s-%s" % (ctid, o.pk) for o in objects
+                    ])
+                    registry_sizes = [len(v) for v in registries.values()]
+                    lookups = (hits - hits0) + (misses - misses0)
+                    windows.append({
+                        "window": w,
+                        "requests": len(results),
+                        "throughput_rps": len(results) / elapsed if elapsed else 0,
+                        "hit_ratio": float(hits - hits0) / lookups if lookups else None,
+                        "round_trips_per_request": float(trips - trips0) / len(results),
+                        "registry_entries_max": max(registry_sizes or [0]),
+                        "registry_entries_mean": float(sum(registry_sizes)) / len(registry_sizes)
+                            if registry_sizes else 0,
+                        "invalidations": inv["events"] - inv0["events"],
+                        "expired_keys": inv["keys"] - inv0["keys"],
+                        "purged_paths": inv["paths"] - inv0["paths"],
+                        "latency": percentiles(window_timings)
+                    })
+        finally:
+            invalidated.disconnect(on_invalidated)
+
+        hits, misses, trips, inv = totals()
+        return {
+            "config": dict(
+                (k, options[k]) for k in (
+                    "requests", "threads", "objects", "write_ratio", "zipf",
+                    "latency", "seed"
+                )
+            ),
+            "summary": {
+                "seconds": time.perf_counter() - started,
+                "errors": errors,
+                "hit_ratio": float(hits) / (hits + misses) if hits + misses else None,
+                "round_trips": trips,
+                "invalidations": inv,
+                "latency": dict(
+                    (kind, percentiles(li)) for kind, li in timings.items()
+                )
+            },
+            "windows": windows
+        }
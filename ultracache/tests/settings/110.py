@@ -26,7 +26,10 @@ INSTALLED_APPS = (
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "BACKEND": "ultracache.testing.CountingCache",
+        "OPTIONS": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+        }
     }
 }
 
@@ -51,5 +54,6 @@ TEMPLATES = [
 
 ULTRACACHE = {
     "purge": {"method": "ultracache.tests.utils.dummy_purger"},
-    "drf": {"viewsets": {"*": {}}}
+    "drf": {"viewsets": {"*": {}}},
+    "metrics": {"backends": ["ultracache.metrics.aggregator"]}
 }
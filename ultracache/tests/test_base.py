@@ -1,20 +1,51 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import base64
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import skipIf
+
 from django import template
 from django.conf.urls import include, url
 from django.core.urlresolvers import reverse
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client, RequestFactory
+try:
+    from django.test import AsyncClient
+except ImportError:
+    AsyncClient = None
 from django.test.utils import override_settings
 from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse
 from rest_framework.routers import DefaultRouter
 
 from ultracache.tests.models import DummyModel, DummyForeignModel, \
     DummyOtherModel
 from ultracache.tests import views, viewsets
 from ultracache.tests.utils import dummy_proxy
+from ultracache import adaptive, admission, dispatch, refresh, registry, \
+    signals, utils
+from ultracache.debug import Collector
+from ultracache.metrics import aggregator
+from ultracache.middleware import UltraCacheMiddleware
+from ultracache.signals import invalidated
+from ultracache.testing import CacheCallsMixin
+from ultracache.views import esi_fragment, prometheus_metrics
+from ultracache.utils import compile_expression, contextvars
 
 router = DefaultRouter()
 router.register(r"dummies", viewsets.DummyViewSet)
@@ -46,8 +77,60 @@ urlpatterns = [
         views.NonBustableCachedView.as_view(),
         name='non-bustable-cached-view'
     ),
+    url(
+        r'^uncached-view/$',
+        views.UncachedView.as_view(),
+        name='uncached-view'
+    ),
+    url(
+        r'^esi-view/$',
+        views.EsiView.as_view(),
+        name='esi-view'
+    ),
+    url(
+        r'^ultracache-esi/(?P<key>[^/]+)/$',
+        esi_fragment,
+        name='ultracache-esi'
+    ),
+    url(
+        r'^fragment-view/$',
+        views.fragment_view,
+        name='fragment-view'
+    ),
+    url(
+        r'^snapshot-view/$',
+        views.snapshot_view,
+        name='snapshot-view'
+    ),
+    url(
+        r'^nocache-view/$',
+        views.nocache_view,
+        name='nocache-view'
+    ),
+    url(
+        r'^uncached-nocache-view/$',
+        views.uncached_nocache_view,
+        name='uncached-nocache-view'
+    ),
+    url(
+        r'^async-view/$',
+        views.async_cached_view,
+        name='async-view'
+    ),
+    url(
+        r'^long-view/$',
+        views.long_view,
+        name='long-view'
+    ),
 ]
 
+
+def middleware(*classes):
+    """Settings to run the test client with only the middleware classes.
+    Django 1.9 only reads MIDDLEWARE_CLASSES."""
+    return {"MIDDLEWARE": list(classes), "MIDDLEWARE_CLASSES": list(classes)}
+
+
 @override_settings(ROOT_URLCONF=__name__)
 class TemplateTagsTestCase(TestCase):
     fixtures = ["sites.json"]
@@ -131,6 +214,89 @@ class TemplateTagsTestCase(TestCase):
         self.assertEqual(result1, result2)
 
 
+    def test_nocache(self):
+        # The block is rendered per render, also inside nested fragments
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_nocache_outer' %}{{ counter }}\
+            {% ultracache 1200 'test_nocache_inner' %}{{ counter }}\
+            [{% ultracache_nocache %}{% if user %}{{ user }}{% endif %}, {% load i18n %}{% trans 'one' %}{% endultracache_nocache %}]\
+            {% endultracache %}{% endultracache %}"
+        )
+        context = template.Context({'request': self.request, 'counter': 1, 'user': 'anne'})
+        self.assertEqual(t.render(context).split(), ['1', '1', '[anne,', 'one]'])
+        context = template.Context({'request': self.request, 'counter': 2, 'user': 'bob'})
+        self.assertEqual(t.render(context).split(), ['1', '1', '[bob,', 'one]'])
+
+        # The inner fragment stores the block source
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_nocache_inner' %}{% endultracache %}"
+        )
+        context = template.Context({'request': self.request, 'user': 'carol'})
+        self.assertEqual(t.render(context).split(), ['1', '[carol,', 'one]'])
+
+        # Outside a fragment the block is simply rendered
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache_nocache %}{{ user }}{% endultracache_nocache %}"
+        )
+        context = template.Context({'user': 'dave'})
+        self.assertEqual(t.render(context).strip(), 'dave')
+
+        # Placeholders in content are not rendered unless they are signed
+        forged = '<!--ucache-nocache %s 0123abcd-->' % base64.b64encode(
+            b'{{ secret }}'
+        ).decode('ascii')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_nocache_forged' %}{{ comment|safe }}{% endultracache %}"
+        )
+        context = template.Context({
+            'request': self.request, 'comment': forged, 'secret': 'leaked'
+        })
+        self.assertEqual(t.render(context).strip(), forged)
+        self.assertEqual(t.render(context).strip(), forged)
+
+    def test_nocache_cached_view(self):
+        DummyModel.objects.create(title='One', code='one')
+        url = reverse('nocache-view')
+
+        # The view stores the blocks and renders them per request
+        views.COUNTER = 1
+        response = self.client.get(url, HTTP_X_USER='anne')
+        result = response.content.decode()
+        self.assertTrue('user = anne' in result)
+        self.assertTrue('outside = anne' in result)
+        self.assertTrue('private' in response['Cache-Control'])
+        self.assertFalse(response.has_header('ETag'))
+
+        views.COUNTER = 2
+        response = self.client.get(url, HTTP_X_USER='bob')
+        result = response.content.decode()
+        self.assertTrue('counter = 1' in result)
+        self.assertTrue('user = bob' in result)
+        self.assertTrue('outside = bob' in result)
+        self.assertTrue('private' in response['Cache-Control'])
+
+    @override_settings(**middleware(
+        "ultracache.middleware.UltraCacheMiddleware"
+    ))
+    def test_nocache_middleware(self):
+        DummyModel.objects.create(title='One', code='one')
+        for name in ('uncached-nocache-view', 'nocache-view'):
+            cache.clear()
+            url = reverse(name)
+            views.COUNTER = 1
+            response = self.client.get(url, HTTP_X_USER='anne')
+            result = response.content.decode()
+            self.assertTrue('user = anne' in result)
+            self.assertTrue('outside = anne' in result)
+            self.assertTrue('private' in response['Cache-Control'])
+
+            views.COUNTER = 2
+            response = self.client.get(url, HTTP_X_USER='bob')
+            result = response.content.decode()
+            self.assertTrue('counter = 1' in result)
+            self.assertTrue('user = bob' in result)
+            self.assertTrue('outside = bob' in result)
+
     def test_context_without_request(self):
         t = template.Template("{%% load ultracache_tags %%}\
             {%% ultracache 1200 'test_ultracache_undefined' aaa %%}%s{%% endultracache %%}" % self.first_site.id
@@ -443,6 +609,79 @@ class DecoratorTestCase(TestCase):
         self.assertEqual(response._headers['content-type'], ('Content-Type', 'application/json'))
         self.assertEqual(response._headers['foo'], ('foo', 'bar'))
 
+    def test_decorator_conditional_get(self):
+        """Test that cached views answer conditional requests with a 304
+        """
+        url = reverse('cached-header-view')
+
+        # Initial render sets the validators
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Second pass is cached and carries the same validators
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Last-Modified'], last_modified)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:00:00 GMT'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_drf_conditional_get(self):
+        """Test that cached viewsets answer conditional requests with a 304
+        """
+        DummyModel.objects.create(title='One', code='one')
+        url = '/api/dummies/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_drf_renderer(self):
+        """Test that cached viewsets vary on the negotiated renderer
+        """
+        one = DummyModel.objects.create(title='One', code='one')
+        url = '/api/dummies/%s/' % one.pk
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = response.content
+        self.assertTrue(b'"title":"One"' in content)
+
+        # Served from the cache as rendered bytes
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.content, content)
+
+        # A different media type is a different cache entry
+        response = self.client.get(
+            url, HTTP_ACCEPT='application/json; indent=4'
+        )
+        self.assertNotEqual(response.content, content)
+        self.assertTrue(b'    "title": "One"' in response.content)
+
+        # Change object one
+        one.title = 'Onxe'
+        one.save()
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertTrue(b'"title":"Onxe"' in response.content)
+
     def test_decorator_cache_busting(self):
         """Test cache busting with and without random querystring param
         """
@@ -457,3 +696,1395 @@ class DecoratorTestCase(TestCase):
         self.assertTrue('aaa=1' in response.content.decode())
         response = self.client.get(url + '?aaa=2')
         self.assertFalse('aaa=2' in response.content.decode())
+
+
+class ExpressionTestCase(TestCase):
+
+    def test_compile_expression(self):
+        request = RequestFactory().get("/aaa/?bbb=1")
+        self.assertEqual(
+            compile_expression("request.is_secure()")(request=request), False
+        )
+        self.assertEqual(
+            compile_expression("request.GET.get('bbb')")(request=request), "1"
+        )
+        self.assertEqual(compile_expression(456)(request=request), 456)
+        evaluator = compile_expression(
+            "viewset.action", names=("request", "viewset")
+        )
+        self.assertEqual(
+            evaluator(request=request, viewset=type("V", (), {"action": "list"})),
+            "list"
+        )
+
+    def test_compile_expression_restricted(self):
+        for expression in (
+            "__import__('os')",
+            "request.__class__",
+            "request._messages",
+            "request.GET.get(request.path)",
+            "open('/etc/passwd')",
+            "request.path + 'x'",
+            "[request.path]",
+            "viewset.action",
+            "request.path(",
+        ):
+            self.assertRaises(
+                ImproperlyConfigured, compile_expression, expression
+            )
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    ULTRACACHE={
+        "middleware": {
+            "exclude": [r"^/render-view/"],
+            "vary": {"headers": ["Accept-Language"]}
+        }
+    },
+    **middleware("ultracache.middleware.UltraCacheMiddleware")
+)
+class MiddlewareTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(MiddlewareTestCase, self).setUp()
+        cache.clear()
+
+    def test_middleware(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        url = reverse('uncached-view')
+
+        # Initial render
+        views.COUNTER = 1
+        response = self.client.get(url)
+        result = response.content.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('title = One' in result)
+        self.assertTrue('counter = 1' in result)
+
+        # Served from the cache
+        views.COUNTER = 2
+        response = self.client.get(url)
+        result = response.content.decode()
+        self.assertTrue('counter = 1' in result)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Vary on header
+        response = self.client.get(url, HTTP_ACCEPT_LANGUAGE='af')
+        self.assertTrue('counter = 2' in response.content.decode())
+
+        # Requests with a session are not cached
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = 'xxx'
+        response = self.client.get(url)
+        self.assertTrue('counter = 2' in response.content.decode())
+        del self.client.cookies[settings.SESSION_COOKIE_NAME]
+
+        # Change object one
+        views.COUNTER = 3
+        one.title = 'Onxe'
+        one.save()
+        response = self.client.get(url)
+        result = response.content.decode()
+        self.assertTrue('title = Onxe' in result)
+        self.assertTrue('counter = 3' in result)
+
+    def test_middleware_cache_key(self):
+        middleware = UltraCacheMiddleware()
+        factory = RequestFactory()
+        self.assertTrue(middleware.get_cache_key(factory.get('/uncached-view/')))
+        self.assertIsNone(middleware.get_cache_key(factory.get('/render-view/')))
+        self.assertIsNone(middleware.get_cache_key(factory.post('/uncached-view/')))
+
+    @override_settings(**middleware(
+        "ultracache.middleware.UltraCacheMiddleware",
+        "django.middleware.gzip.GZipMiddleware"
+    ))
+    def test_middleware_vary(self):
+        url = reverse('long-view')
+
+        # Compressed
+        views.COUNTER = 1
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response['Vary'])
+
+        # A client that can't decompress does not get the compressed response
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertTrue(response.content.decode().startswith('counter 3 '))
+
+        # Both responses are served from the cache
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.client.get(url)
+        self.assertTrue(response.content.decode().startswith('counter 3 '))
+        self.assertEqual(views.COUNTER, 3)
+
+
+class SerializerTestCase(TestCase):
+
+    def test_list_serializer_tracking(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        foreigns = [
+            DummyForeignModel.objects.create(
+                title='Foreign', points_to=one, code='foreign%s' % i
+            ) for i in range(3)
+        ]
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        foreign_ctid = ContentType.objects.get_for_model(DummyForeignModel).id
+
+        request = RequestFactory().get('/')
+        request._ultracache = []
+        queryset = DummyForeignModel.objects.select_related('points_to')
+        serializer = viewsets.DummyForeignSerializer(
+            queryset, many=True, context={'request': request}
+        )
+
+        # The queryset is evaluated only once
+        with self.assertNumQueries(1):
+            data = serializer.data
+        self.assertEqual(len(data), 3)
+        self.assertEqual(
+            request._ultracache,
+            [(foreign_ctid, f.pk) for f in foreigns] + [(ctid, one.pk)]
+        )
+
+
+class MetricsTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+
+    def test_fragment_metrics(self):
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_metrics' %}12345{% endultracache %}"
+        )
+        request = RequestFactory().get('/')
+        for i in range(3):
+            t.render(template.Context({'request': request}))
+        self.assertEqual(aggregator.get_counter('fragment', 'test_metrics', 'hits'), 2)
+        self.assertEqual(aggregator.get_counter('fragment', 'test_metrics', 'misses'), 1)
+        self.assertEqual(
+            aggregator.get_observation('fragment', 'test_metrics', 'stored_bytes'),
+            (1, 5, 5)
+        )
+        self.assertEqual(aggregator.get_observation(
+            'fragment', 'test_metrics', 'render_seconds'
+        )[0], 1)
+        self.assertAlmostEqual(aggregator.hit_ratio('fragment', 'test_metrics'), 2.0 / 3)
+
+        result = prometheus_metrics(request).content.decode()
+        self.assertTrue('# TYPE ultracache_hits_total counter' in result)
+        self.assertTrue(
+            'ultracache_hits_total{kind="fragment",name="test_metrics"} 2' in result
+        )
+        self.assertTrue(
+            'ultracache_stored_bytes_sum{kind="fragment",name="test_metrics"} 5' in result
+        )
+        self.assertTrue('# TYPE ultracache_stored_bytes summary' in result)
+        self.assertTrue('# TYPE ultracache_stored_bytes_max gauge' in result)
+        self.assertTrue(
+            'ultracache_stored_bytes_max{kind="fragment",name="test_metrics"} 5' in result
+        )
+
+    def test_view_metrics(self):
+        url = reverse('cached-header-view')
+        self.client.get(url)
+        self.client.get(url)
+        name = 'ultracache.tests.views.CachedHeaderView.get'
+        self.assertEqual(aggregator.get_counter('view', name, 'hits'), 1)
+        self.assertEqual(aggregator.get_counter('view', name, 'misses'), 1)
+
+
+class InvalidationProfilerTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(InvalidationProfilerTestCase, self).setUp()
+        cache.clear()
+        self.records = []
+        invalidated.connect(self.receiver)
+
+    def tearDown(self):
+        invalidated.disconnect(self.receiver)
+        super(InvalidationProfilerTestCase, self).tearDown()
+
+    def receiver(self, sender, record, **kwargs):
+        self.records.append(record)
+
+    def test_record(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        self.assertEqual(self.records[-1]['event'], 'create')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_profiler_a' %}{{ one.title }}{% endultracache %}\
+            {% ultracache 1200 'test_profiler_b' %}{{ one.title }}{% endultracache %}"
+        )
+        request = RequestFactory().get('/profiler/')
+        t.render(template.Context({'request': request, 'one': one}))
+
+        one.title = 'Onxe'
+        one.save()
+        record = self.records[-1]
+        self.assertEqual(record['model'], 'tests.dummymodel')
+        self.assertEqual(record['pk'], one.pk)
+        self.assertEqual(record['event'], 'save')
+        self.assertEqual(record['keys'], 2)
+        self.assertEqual(record['paths'], 1)
+        self.assertTrue(record['registry_bytes'] > 0)
+
+        one.delete()
+        self.assertEqual(self.records[-1]['event'], 'delete')
+        self.assertEqual(self.records[-1]['keys'], 0)
+
+        # Paths are counted without a purger too
+        old_purger = signals.purger
+        signals.purger = None
+        try:
+            two = DummyModel.objects.create(title='Two', code='two')
+            t.render(template.Context({'request': request, 'one': two}))
+            two.title = 'Twxo'
+            two.save()
+        finally:
+            signals.purger = old_purger
+        self.assertEqual(self.records[-1]['paths'], 1)
+
+    def test_command(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            for model, keys in (('a.one', 10), ('a.two', 500), ('a.one', 5)):
+                fp.write('INFO %s\n' % json.dumps({
+                    'model': model, 'keys': keys, 'paths': 1,
+                    'delete_seconds': 0.1, 'purge_seconds': 0.0
+                }))
+            fp.write('not a record\n')
+        out = StringIO()
+        try:
+            call_command('ultracache_invalidations', filename, stdout=out)
+        finally:
+            os.remove(filename)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('a.two'))
+        self.assertEqual(lines[2].split()[:3], ['a.one', '2', '15'])
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    DEBUG=True,
+    INTERNAL_IPS=["127.0.0.1"],
+    **middleware("ultracache.debug.UltraCacheDebugMiddleware")
+)
+class DebugTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(DebugTestCase, self).setUp()
+        cache.clear()
+
+    def test_debug_header(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        DummyModel.objects.create(title='Two', code='two')
+        DummyForeignModel.objects.create(title='Three', points_to=one, code='three')
+        DummyModel.objects.create(title='Four', code='four')
+        url = reverse('cached-view')
+
+        # Initial render misses everywhere
+        response = self.client.get(url)
+        data = json.loads(response['X-Ultracache-Debug'])
+        self.assertEqual(data['hits'], 0)
+        self.assertEqual(data['misses'], 7)
+        entries = data['entries']
+        self.assertEqual(
+            [(e['kind'], e['depth']) for e in entries[:3]],
+            [('view', 0), ('fragment', 1), ('fragment', 2)]
+        )
+        self.assertEqual(entries[1]['name'], 'test_ultracache_invalidate_outer')
+        self.assertEqual(len(entries[0]['objects']), 4)
+        self.assertEqual(entries[2]['objects'], [
+            [ContentType.objects.get_for_model(DummyModel).id, one.pk]
+        ])
+
+        # The view is now a hit and contains the same objects
+        response = self.client.get(url)
+        data = json.loads(response['X-Ultracache-Debug'])
+        self.assertEqual((data['hits'], data['misses']), (1, 0))
+        self.assertEqual(len(data['entries'][0]['objects']), 4)
+
+    def test_header_access(self):
+        DummyModel.objects.create(title='One', code='one')
+        url = reverse('fragment-view')
+
+        # Only internal clients of a site in debug mode get the header
+        with override_settings(INTERNAL_IPS=[]):
+            self.assertFalse(self.client.get(url).has_header('X-Ultracache-Debug'))
+        with override_settings(DEBUG=False):
+            self.assertFalse(self.client.get(url).has_header('X-Ultracache-Debug'))
+
+        # A report too large for a header only carries the totals
+        with override_settings(ULTRACACHE={
+            "debug": {"max-header-size": 10},
+            "metrics": {"backends": ["ultracache.metrics.aggregator"]}
+        }):
+            response = Client().get(url)
+        data = json.loads(response['X-Ultracache-Debug'])
+        self.assertEqual((data['hits'], data['truncated']), (1, True))
+        self.assertEqual(data['entries'], [])
+
+    def test_not_found(self):
+        # A view raising Http404 still closes its entry
+        request = RequestFactory().get('/snapshot-view/?status=404')
+        request._ultracache_debug = collector = Collector()
+        self.assertRaises(Http404, views.snapshot_view, request)
+        self.assertEqual(collector.depth, 0)
+        self.assertEqual(collector.entries[0]['hit'], False)
+
+
+class CacheCallsTestCase(CacheCallsMixin, TestCase):
+    """Lock in the number of cache round trips of the hot paths"""
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(CacheCallsTestCase, self).setUp()
+        cache.clear()
+
+    def test_render(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_cache_calls' %}{{ one.title }}{% endultracache %}"
+        )
+
+        # A miss is a get, a set and the registry update. Paths registries
+        # have a timeout of their own so they are written separately.
+        # Creating the registries also updates the key index.
+        with self.assertNumCacheCalls(10, get=1, set=1, get_many=5, set_many=3) as ctx:
+            t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+        self.assertTrue(ctx.bytes > 0)
+
+        # A hit is a get of the fragment and of its objects
+        with self.assertNumCacheCalls(2, get=2):
+            t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+
+        # The registries exist so another miss does not touch the index
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_cache_calls_other' %}{{ one.title }}{% endultracache %}"
+        )
+        with self.assertNumCacheCalls(8, get=1, set=1, get_many=4, set_many=2):
+            t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+
+    def test_on_post_save(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_cache_calls' %}{{ one.title }}{% endultracache %}"
+        )
+        t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+        # The registries are read together and deleted along with the keys
+        with self.assertNumCacheCalls(2, get_many=1, delete_many=1):
+            one.save()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class WarmTestCase(TransactionTestCase):
+    # Worker threads use their own database connections so the fixtures
+    # must be committed
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(WarmTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+
+    def test_warm(self):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('# Comment\n')
+            fp.write('http://testserver/bustable-cached-view/\n')
+            fp.write('/cached-header-view/\n')
+        out = StringIO()
+        err = StringIO()
+        try:
+            call_command(
+                'warm_ultracache', '/cached-header-view/', '/does-not-exist/',
+                file=[filename], host=['testserver'], concurrency=2,
+                stdout=out, stderr=err
+            )
+        finally:
+            os.remove(filename)
+
+        # Each URL is requested once and the views are now cached
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[-1].startswith('Warmed 3 URLs'))
+        self.assertIn('200: 2', lines[-1])
+        self.assertIn('404: 1', lines[-1])
+        self.assertIn('/does-not-exist/', err.getvalue())
+        self.assertEqual(aggregator.get_counter(
+            'view', 'ultracache.tests.views.CachedHeaderView.get', 'misses'
+        ), 1)
+        self.client.get('/cached-header-view/')
+        self.assertEqual(aggregator.get_counter(
+            'view', 'ultracache.tests.views.CachedHeaderView.get', 'hits'
+        ), 1)
+
+    def test_no_urls(self):
+        with self.assertRaises(CommandError):
+            call_command('warm_ultracache', stdout=StringIO())
+
+    def test_hosts(self):
+        # Absolute URLs are requested for their own host
+        out = StringIO()
+        call_command(
+            'warm_ultracache', 'http://testserver/cached-header-view/',
+            stdout=out, stderr=StringIO()
+        )
+        self.assertIn('200: 1', out.getvalue().splitlines()[-1])
+
+        # Paths can not be requested without a host
+        with self.assertRaises(CommandError):
+            call_command(
+                'warm_ultracache', '/cached-header-view/', stdout=StringIO()
+            )
+
+
+class RegistryTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(RegistryTestCase, self).setUp()
+        cache.clear()
+
+    def test_compact(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_compact' path %}{{ one.title }}{% endultracache %}"
+        )
+        for path in ('/a/', '/b/', '/c/'):
+            t.render(template.Context({
+                'request': RequestFactory().get(path), 'one': one, 'path': path
+            }))
+        key = 'ucache-%s-%s' % (ctid, one.pk)
+        self.assertIn(key, registry.get_indexed_keys())
+        self.assertIn('ucache-ct-%s' % ctid, registry.get_indexed_keys())
+        value = registry.get_members(cache.get(key))
+        self.assertEqual(len(value), 3)
+
+        # Expire two of the fragments behind the registry's back
+        cache.delete_many(value[:2] + [v + '-objs' for v in value[:2]])
+        stats = registry.compact(dry_run=True)
+        self.assertEqual(stats['dropped_keys'], 4)
+        self.assertEqual(len(cache.get(key)), 3)
+
+        stats = registry.compact()
+        self.assertEqual(stats['dropped_keys'], 4)
+        self.assertEqual(stats['deleted_registries'], 0)
+        self.assertTrue(stats['bytes_reclaimed'] > 0)
+        self.assertEqual(registry.get_members(cache.get(key)), value[2:])
+        self.assertEqual(len(cache.get('ucache-pth-%s-%s' % (ctid, one.pk))), 3)
+
+        # Without live fragments the registries and the index entries go
+        cache.delete_many([value[2], value[2] + '-objs'])
+        out = StringIO()
+        call_command('ultracache_compact', stdout=out)
+        self.assertIn('2 registries deleted', out.getvalue())
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(registry.get_indexed_keys(), [])
+
+        # The proxy may still cache the paths so a save still purges them
+        self.assertEqual(len(cache.get('ucache-pth-%s-%s' % (ctid, one.pk))), 3)
+        dummy_proxy.clear()
+        dummy_proxy.cache('/a/', 'One')
+        one.save()
+        self.assertFalse(dummy_proxy.is_cached('/a/'))
+
+    def test_index(self):
+        old_max_size = registry.MAX_SIZE
+        # Room for four entries per shard value
+        registry.MAX_SIZE = sys.getsizeof([1] * 5)
+        try:
+            keys = ['ucache-test-%s' % n for n in range(200)]
+            registry.add_to_index(keys[:100])
+            registry.add_to_index(keys)
+            self.assertEqual(sorted(registry.get_indexed_keys()), sorted(keys))
+
+            # Shards are paged and their entries expire
+            head = cache.get(registry.get_shard_key(keys[0]))
+            self.assertTrue(len(head['entries']) <= 4)
+            self.assertTrue(head['pages'])
+            now = time.time()
+            for member, expiry in head['entries']:
+                self.assertTrue(expiry <= now + registry.INDEX_TIMEOUT)
+        finally:
+            registry.MAX_SIZE = old_max_size
+
+        # Shards written by earlier versions are plain lists
+        cache.clear()
+        cache.set(registry.get_shard_key('ucache-1-1'), ['ucache-1-1'])
+        self.assertEqual(registry.get_indexed_keys(), ['ucache-1-1'])
+        registry.add_to_index(['ucache-1-1'])
+        self.assertEqual(registry.get_indexed_keys(), ['ucache-1-1'])
+
+    def test_expiry(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        key = 'ucache-%s-%s' % (ctid, one.pk)
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 300 'test_expiry' %}{{ one.title }}{% endultracache %}"
+        )
+        now = time.time()
+        t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+
+        # Members carry the expiry of their fragment
+        (member, expiry), = cache.get(key)
+        self.assertTrue(now + 299 <= expiry <= time.time() + 300)
+        self.assertTrue(
+            registry.get_timeout(cache.get(key), now) in (300, 301)
+        )
+
+        # Paths outlive the fragment because the proxy caches the page
+        (path, path_expiry), = cache.get('ucache-pth-%s-%s' % (ctid, one.pk))
+        self.assertEqual(path, '/')
+        self.assertTrue(
+            now + registry.PATH_TIMEOUT - 1 <= path_expiry
+            <= time.time() + registry.PATH_TIMEOUT
+        )
+
+        # Expired members and members written by earlier versions
+        cache.set(key, [('expired', now - 1), 'legacy', (member, expiry)])
+        self.assertEqual(registry.get_members(cache.get(key)), ['legacy', member])
+
+        # Expired members are dropped when the registry is modified
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 600 'test_expiry_other' %}{{ one.title }}{% endultracache %}"
+        )
+        t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+        entries = cache.get(key)
+        self.assertEqual(
+            [m for m, e in entries][:2], ['legacy', member]
+        )
+        self.assertEqual(len(entries), 3)
+
+        # Registries live as long as their longest lived member
+        self.assertEqual(registry.get_timeout([('a', now + 10), ('b', now + 100)], now), 100)
+        self.assertIsNone(registry.get_timeout([('a', now + 10), ('b', None)], now))
+
+    def test_pages(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        key = 'ucache-%s-%s' % (ctid, one.pk)
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_pages' n %}{{ one.title }}{% endultracache %}"
+        )
+
+        def render(n):
+            t.render(template.Context({
+                'request': RequestFactory().get('/'), 'one': one, 'n': n
+            }))
+
+        old_max_size, old_max_pages = registry.MAX_SIZE, registry.MAX_PAGES
+        # Room for four entries per value and two pages
+        registry.MAX_SIZE = sys.getsizeof([1] * 5)
+        registry.MAX_PAGES = 2
+        try:
+            # A head that outgrows MAX_SIZE moves its oldest three entries to
+            # a page and keeps the newest two
+            for n in range(8):
+                render(n)
+            head = cache.get(key)
+            self.assertEqual([p for p, e in head['pages']], [1, 2])
+            self.assertEqual(len(head['entries']), 2)
+            registries, pages = registry.read_registries([key])
+            members = [m for m, e in registries[key]]
+            self.assertEqual(sorted(pages.keys()), [key + '-p1', key + '-p2'])
+            self.assertEqual(len(members), 8)
+            for member in members:
+                self.assertIsNotNone(cache.get(member))
+
+            # A third page evicts the first page and its fragments
+            for n in range(8, 11):
+                render(n)
+            head = cache.get(key)
+            self.assertEqual([p for p, e in head['pages']], [2, 3])
+            self.assertIsNone(cache.get(key + '-p1'))
+            for member in members[:3]:
+                self.assertIsNone(cache.get(member))
+            registries, pages = registry.read_registries([key])
+            live = [m for m, e in registries[key]]
+            self.assertEqual(live[:5], members[3:])
+            self.assertEqual(len(live), 8)
+
+            # Compaction repacks the pages
+            cache.delete_many([live[0], live[0] + '-objs'])
+            self.assertEqual(registry.compact()['dropped_keys'], 2)
+            registries, pages = registry.read_registries([key])
+            self.assertEqual([m for m, e in registries[key]], live[1:])
+            live = live[1:]
+
+            # Invalidation deletes the fragments in all pages
+            one.save()
+            for member in live:
+                self.assertIsNone(cache.get(member))
+            self.assertIsNone(cache.get(key))
+            self.assertIsNone(cache.get(key + '-p2'))
+        finally:
+            registry.MAX_SIZE, registry.MAX_PAGES = old_max_size, old_max_pages
+
+
+class AsyncTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(AsyncTestCase, self).tearDown()
+
+    def test_cached_get(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        self.assertTrue(asyncio.iscoroutinefunction(views.async_cached_view))
+        name = 'ultracache.tests.views.async_cached_view'
+
+        response = self.loop.run_until_complete(
+            views.async_cached_view(RequestFactory().get('/async/'))
+        )
+        self.assertEqual(response.content.decode().strip(), 'title = One')
+        self.assertEqual(aggregator.get_counter('view', name, 'misses'), 1)
+        members = registry.get_members(cache.get('ucache-%s-%s' % (ctid, one.pk)))
+        self.assertEqual(len(members), 1)
+        self.assertTrue(members[0].startswith('ucache-get-'))
+
+        # A hit makes an outer caller aware of the contained objects
+        request = RequestFactory().get('/async/')
+        request._ultracache = []
+        response = self.loop.run_until_complete(views.async_cached_view(request))
+        self.assertEqual(response.content.decode().strip(), 'title = One')
+        self.assertEqual(aggregator.get_counter('view', name, 'hits'), 1)
+        self.assertEqual(request._ultracache, [(ctid, one.pk)])
+
+        # Conditional request
+        request = RequestFactory().get('/async/', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = self.loop.run_until_complete(views.async_cached_view(request))
+        self.assertEqual(response.status_code, 304)
+
+        # Invalidation
+        one.title = 'Onxe'
+        one.save()
+        response = self.loop.run_until_complete(
+            views.async_cached_view(RequestFactory().get('/async/'))
+        )
+        self.assertEqual(response.content.decode().strip(), 'title = Onxe')
+        self.assertEqual(aggregator.get_counter('view', name, 'misses'), 2)
+
+    @skipIf(AsyncClient is None, "Django can't serve async views")
+    @override_settings(ROOT_URLCONF=__name__)
+    def test_asgi(self):
+        DummyModel.objects.create(title='One', code='one')
+        name = 'ultracache.tests.views.async_cached_view'
+        client = AsyncClient()
+        for i in range(2):
+            response = self.loop.run_until_complete(client.get('/async-view/'))
+            self.assertEqual(response.content.decode().strip(), 'title = One')
+        self.assertEqual(aggregator.get_counter('view', name, 'misses'), 1)
+        self.assertEqual(aggregator.get_counter('view', name, 'hits'), 1)
+
+    def test_concurrent(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        two = DummyModel.objects.create(title='Two', code='two')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+
+        # Two views share a request and run concurrently on one loop
+        request = RequestFactory().get('/async/')
+        request._ultracache = []
+        responses = self.loop.run_until_complete(asyncio.gather(
+            views.async_cached_view(request, code='one'),
+            views.async_cached_view(request, code='two')
+        ))
+        self.assertEqual(
+            [r.content.decode().strip() for r in responses],
+            ['title = One', 'title = Two']
+        )
+        self.assertEqual(
+            sorted(request._ultracache), sorted([(ctid, one.pk), (ctid, two.pk)])
+        )
+
+        # Each view invalidates when its own object changes
+        two.title = 'Twxo'
+        two.save()
+        responses = self.loop.run_until_complete(asyncio.gather(
+            views.async_cached_view(RequestFactory().get('/async/'), code='one'),
+            views.async_cached_view(RequestFactory().get('/async/'), code='two')
+        ))
+        self.assertEqual(
+            [r.content.decode().strip() for r in responses],
+            ['title = One', 'title = Twxo']
+        )
+
+    @skipIf(contextvars is None, "contextvars is not available")
+    def test_scope(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        two = DummyModel.objects.create(title='Two', code='two')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        request = RequestFactory().get('/async/')
+        self.loop.run_until_complete(asyncio.gather(
+            views.async_cached_view(request, code='one'),
+            views.async_cached_view(request, code='two')
+        ))
+
+        # Each view only registered its own object
+        keys = []
+        for obj in (one, two):
+            members = registry.get_members(
+                cache.get('ucache-%s-%s' % (ctid, obj.pk))
+            )
+            self.assertEqual(len(members), 1)
+            self.assertEqual(cache.get(members[0] + '-objs'), [(ctid, obj.pk)])
+            keys.append(members[0])
+        self.assertNotEqual(keys[0], keys[1])
+
+        # The request still knows both objects
+        self.assertEqual(
+            sorted(request._ultracache), sorted([(ctid, one.pk), (ctid, two.pk)])
+        )
+
+
+class DispatchTestCase(TransactionTestCase):
+    # Asynchronous dispatchers wait for the transaction to commit
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(DispatchTestCase, self).setUp()
+        cache.clear()
+        self.records = []
+        invalidated.connect(self.receiver)
+        self.old_dispatcher = dispatch._dispatcher
+
+    def tearDown(self):
+        dispatch._dispatcher = self.old_dispatcher
+        invalidated.disconnect(self.receiver)
+        super(DispatchTestCase, self).tearDown()
+
+    def receiver(self, sender, record, **kwargs):
+        self.records.append(record)
+
+    def check(self, dispatcher):
+        dispatch._dispatcher = dispatcher
+        one = DummyModel.objects.create(title='One', code='one')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 1200 'test_dispatch' %}{{ one.title }}{% endultracache %}"
+        )
+        t.render(template.Context({'request': RequestFactory().get('/'), 'one': one}))
+        dispatcher.join()
+        self.records = []
+
+        # Events for one object are processed in order
+        for n in range(20):
+            one.title = 'One %s' % n
+            one.save()
+        one.delete()
+        dispatcher.join()
+        self.assertEqual(
+            [r['event'] for r in self.records], ['save'] * 20 + ['delete']
+        )
+        self.assertEqual(self.records[0]['keys'], 1)
+        self.assertTrue(all(r['queued_seconds'] >= 0 for r in self.records))
+
+    def test_thread_pool(self):
+        with override_settings(ULTRACACHE={"invalidation": {"workers": 2, "queue-size": 2}}):
+            self.check(dispatch.ThreadPoolDispatcher())
+
+    def test_thread_pool_overflow(self):
+        with override_settings(ULTRACACHE={
+            "invalidation": {"workers": 1, "queue-size": 1, "overflow": "sync"}
+        }):
+            dispatcher = dispatch.ThreadPoolDispatcher()
+        dispatch._dispatcher = dispatcher
+        one = DummyModel.objects.create(title='One', code='one')
+        for n in range(10):
+            one.save()
+        dispatcher.join()
+        self.assertEqual(len(self.records), 11)
+
+    def test_asyncio(self):
+        self.check(dispatch.AsyncioDispatcher())
+
+    def test_asyncio_overflow(self):
+        # A full queue blocks the save instead of invalidating in it, which
+        # could overtake pending events.
+        with override_settings(ULTRACACHE={"invalidation": {"queue-size": 1}}):
+            dispatcher = dispatch.AsyncioDispatcher()
+        dispatch._dispatcher = dispatcher
+        threads = []
+        receiver = lambda sender, record, **kwargs: threads.append(
+            threading.current_thread()
+        )
+        invalidated.connect(receiver)
+        try:
+            one = DummyModel.objects.create(title='One', code='one')
+            for n in range(10):
+                one.save()
+            dispatcher.join()
+        finally:
+            invalidated.disconnect(receiver)
+        self.assertEqual(len(threads), 11)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_on_commit(self):
+        dispatcher = dispatch.ThreadPoolDispatcher()
+        dispatch._dispatcher = dispatcher
+        with transaction.atomic():
+            one = DummyModel.objects.create(title='One', code='one')
+            dispatcher.join()
+            self.assertEqual(self.records, [])
+        dispatcher.join()
+        self.assertEqual([r['event'] for r in self.records], ['create'])
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    ULTRACACHE={
+        "purge": {"method": "ultracache.tests.utils.dummy_purger"},
+        "esi": {"enabled": True}
+    }
+)
+class EsiTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(EsiTestCase, self).setUp()
+        cache.clear()
+        dummy_proxy.clear()
+
+    def test_esi(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        url = reverse('esi-view')
+
+        # Without ESI support the fragment is rendered inline
+        views.COUNTER = 1
+        response = self.client.get(url)
+        self.assertTrue('title = One' in response.content.decode())
+
+        # The proxy gets an include tag and the fragment by key
+        response = self.client.get(url, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        result = response.content.decode()
+        self.assertFalse('title = One' in result)
+        src = re.search(r'<esi:include src="([^"]+)" />', result).group(1)
+        src = src.replace('&amp;', '&')
+        self.assertTrue(src.startswith('/ultracache-esi/'))
+        self.assertTrue(src.endswith('&path=/esi-view/'))
+        response = self.client.get(src, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        self.assertEqual(response.content.decode(), 'title = One')
+
+        # Objects in the fragment are registered against the fragment URL
+        self.assertEqual(
+            registry.get_members(cache.get('ucache-pth-%s-%s' % (ctid, one.pk))),
+            ['/esi-view/', src]
+        )
+        dummy_proxy.cache(src, 'title = One')
+
+        # Only the fragment is purged and the fragment view renders the page
+        # to refill it.
+        one.title = 'Onxe'
+        one.save()
+        self.assertFalse(dummy_proxy.is_cached(src))
+        response = self.client.get(src)
+        self.assertEqual(response.content.decode(), 'title = Onxe')
+
+        # The refill registers the same fragment URL so the next save purges
+        # it again.
+        self.assertEqual(
+            registry.get_members(cache.get('ucache-pth-%s-%s' % (ctid, one.pk))),
+            [src]
+        )
+        dummy_proxy.cache(src, 'title = Onxe')
+        one.title = 'One'
+        one.save()
+        self.assertFalse(dummy_proxy.is_cached(src))
+
+        # Only template fragments are served
+        response = self.client.get(
+            reverse('ultracache-esi', kwargs={'key': 'ucache-ct-%s' % ctid})
+        )
+        self.assertEqual(response.status_code, 404)
+
+        # Unsigned and tampered URLs are rejected
+        response = self.client.get(src.split('?')[0] + '?path=/esi-view/')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(src.replace('/esi-view/', '/render-view/'))
+        self.assertEqual(response.status_code, 403)
+        key = re.search(r'/ultracache-esi/([^/]+)/', src).group(1)
+        response = self.client.get(src.replace(key, key[:-1] + 'x'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_esi_quoted_name(self):
+        DummyModel.objects.create(title='One', code='one')
+        t = template.Template("{% load ultracache_tags %}"
+            "{% ultracache 300 'it\\'s#1' %}{{ one.title }}{% endultracache %}"
+        )
+        request = RequestFactory().get(
+            '/esi-view/', HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0'
+        )
+        result = t.render(template.Context({
+            'request': request, 'one': DummyModel.objects.get(code='one')
+        }))
+        src = re.search(r'<esi:include src="([^"]+)" />', result).group(1)
+        self.assertFalse('&#' in src)
+        self.assertFalse('#' in src.split('?')[0])
+        response = self.client.get(src.replace('&amp;', '&'))
+        self.assertEqual(response.content.decode(), 'One')
+
+    @override_settings(**middleware(
+        "ultracache.middleware.UltraCacheMiddleware"
+    ))
+    def test_esi_middleware(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        response = self.client.get(
+            reverse('esi-view'), HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0'
+        )
+        result = response.content.decode()
+        src = re.search(r'<esi:include src="([^"]+)" />', result).group(1)
+        src = src.replace('&amp;', '&')
+
+        # The fragment response is cached by the middleware
+        response = self.client.get(src, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        self.assertEqual(response.content.decode(), 'title = One')
+        cache.delete(re.search(r'/ultracache-esi/([^/]+)/', src).group(1))
+        response = self.client.get(src, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        self.assertEqual(response.content.decode(), 'title = One')
+
+        # and invalidated along with the fragment
+        one.title = 'Onxe'
+        one.save()
+        response = self.client.get(src, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        self.assertEqual(response.content.decode(), 'title = Onxe')
+
+        # A refill renders the page without disturbing the fragment response
+        one.title = 'One'
+        one.save()
+        response = self.client.get(src, HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0')
+        self.assertEqual(response.content.decode(), 'title = One')
+        response = self.client.get(
+            reverse('esi-view'), HTTP_SURROGATE_CAPABILITY='varnish=ESI/1.0'
+        )
+        self.assertTrue('<esi:include' in response.content.decode())
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    ULTRACACHE={
+        "purge": {"method": "ultracache.tests.utils.dummy_purger"},
+        "metrics": {"backends": ["ultracache.metrics.aggregator"]},
+        "refresh": {
+            "enabled": True, "hosts": ["testserver"], "workers": 2, "rate": 0
+        }
+    }
+)
+class RefreshTestCase(TransactionTestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(RefreshTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+        refresh._refresher = None
+
+    def tearDown(self):
+        refresh._refresher = None
+        super(RefreshTestCase, self).tearDown()
+
+    def test_refresh(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        paths_key = 'ucache-pth-%s-%s' % (ctid, one.pk)
+        self.client.get(reverse('esi-view'))
+        self.assertEqual(registry.get_members(cache.get(paths_key)), ['/esi-view/'])
+
+        # The page is rendered again after the save and registered again
+        one.title = 'Onxe'
+        one.save()
+        refresh.get_refresher().join()
+        self.assertEqual(registry.get_members(cache.get(paths_key)), ['/esi-view/'])
+        self.assertEqual(aggregator.get_counter('fragment', 'esi-one', 'misses'), 2)
+        response = self.client.get(reverse('esi-view'))
+        self.assertTrue('title = Onxe' in response.content.decode())
+        self.assertEqual(aggregator.get_counter('fragment', 'esi-one', 'hits'), 1)
+
+    def test_dedupe(self):
+        refresher = refresh.Refresher()
+        refresher.workers = 0
+        refresher.refresh(['/esi-view/', '/esi-view/', '/uncached-view/'])
+        self.assertEqual(refresher.queue.qsize(), 2)
+        refresher.refresh(['/esi-view/'])
+        self.assertEqual(refresher.queue.qsize(), 2)
+
+    def test_hosts(self):
+        # Hosts default to the domains of the sites
+        with override_settings(ULTRACACHE={"refresh": {"enabled": True}}):
+            self.assertEqual(
+                sorted(refresh.get_hosts()), ['testserver', 'testserverb']
+            )
+            refresh.check()
+            with self.modify_settings(INSTALLED_APPS={
+                'remove': 'django.contrib.sites'
+            }):
+                self.assertRaises(ImproperlyConfigured, refresh.check)
+                self.assertRaises(ImproperlyConfigured, refresh.get_hosts)
+
+
+@override_settings(ULTRACACHE={
+    "metrics": {"backends": ["ultracache.metrics.aggregator"]},
+    "adaptive-timeouts": {"enabled": True, "min": 10, "max": 1000, "min-samples": 2}
+})
+class AdaptiveTimeoutsTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(AdaptiveTimeoutsTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+        adaptive._policy = None
+
+    def tearDown(self):
+        adaptive._policy = None
+        super(AdaptiveTimeoutsTestCase, self).tearDown()
+
+    def test_volatile(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 300 'adaptive' %}{{ one.title }}{% endultracache %}"
+        )
+        context = template.Context({'request': RequestFactory().get('/'), 'one': one})
+
+        # Entries that are invalidated right away get the minimum timeout
+        for n in range(3):
+            t.render(context)
+            one.save()
+        self.assertEqual(aggregator.get_counter('fragment', 'adaptive', 'invalidations'), 2)
+        self.assertEqual(
+            aggregator.get_observation('fragment', 'adaptive', 'timeout_seconds'),
+            (3, 610, 300)
+        )
+        t.render(context)
+        self.assertEqual(adaptive.get_policy().keys.popitem()[1][1], 10)
+
+    def test_expired(self):
+        policy = adaptive.get_policy()
+        self.assertEqual(adaptive.get_timeout('view', 'v', 'k', 100), 100)
+
+        # Entries that live out their timeout get a longer one up to max
+        timeouts = []
+        for n in range(20):
+            set_time, previous = policy.keys['k']
+            timeouts.append(previous)
+            policy.keys['k'] = (set_time - previous, previous)
+            adaptive.get_timeout('view', 'v', 'k', 100)
+        self.assertEqual(timeouts[:3], [100, 100, 200])
+        self.assertEqual(timeouts, sorted(timeouts))
+        self.assertEqual(timeouts[-1], 1000)
+        self.assertEqual(aggregator.get_counter('view', 'v', 'expiries'), 20)
+
+        # Timeouts of None are never adapted
+        self.assertEqual(adaptive.get_timeout('view', 'v', 'k', None), None)
+
+
+@override_settings(ULTRACACHE={
+    "metrics": {"backends": ["ultracache.metrics.aggregator"]},
+    "admission": {
+        "enabled": True, "min-cost": 1000000, "min-samples": 1,
+        "names": {"admitted": {"admit": True}}
+    }
+})
+class AdmissionTestCase(CacheCallsMixin, TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(AdmissionTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+        admission._policy = None
+
+    def tearDown(self):
+        admission._policy = None
+        super(AdmissionTestCase, self).tearDown()
+
+    def test_fragment(self):
+        one = DummyModel.objects.create(title='One', code='one')
+        context = template.Context({'request': RequestFactory().get('/'), 'one': one})
+
+        # A cheap fragment is neither stored nor looked up once rejected
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 300 'cheap' %}{{ one.title }}{% endultracache %}"
+        )
+        with self.assertNumCacheCalls(1, get=1):
+            self.assertEqual(t.render(context).strip(), 'One')
+        with self.assertNumCacheCalls(0):
+            self.assertEqual(t.render(context).strip(), 'One')
+        self.assertEqual(aggregator.get_counter('fragment', 'cheap', 'rejected'), 2)
+        self.assertEqual(aggregator.get_counter('fragment', 'cheap', 'misses'), 2)
+        self.assertEqual(
+            aggregator.get_observation('fragment', 'cheap', 'stored_bytes')[1], 0
+        )
+        self.assertTrue(admission.get_policy().get_cost('fragment', 'cheap') < 1000000)
+
+        # Overrides always admit
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 300 'admitted' %}{{ one.title }}{% endultracache %}"
+        )
+        t.render(context)
+        t.render(context)
+        self.assertEqual(aggregator.get_counter('fragment', 'admitted', 'admitted'), 1)
+        self.assertEqual(aggregator.get_counter('fragment', 'admitted', 'hits'), 1)
+
+    def test_view(self):
+        DummyModel.objects.create(title='One', code='one')
+        name = 'ultracache.tests.views.async_cached_view'
+        loop = asyncio.new_event_loop()
+        try:
+            for n in range(2):
+                response = loop.run_until_complete(
+                    views.async_cached_view(RequestFactory().get('/async/'))
+                )
+                self.assertEqual(response.content.decode().strip(), 'title = One')
+        finally:
+            loop.close()
+        self.assertEqual(aggregator.get_counter('view', name, 'rejected'), 2)
+        self.assertEqual(aggregator.get_counter('view', name, 'hits'), 0)
+
+
+class BoundedTrackingTestCase(CacheCallsMixin, TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(BoundedTrackingTestCase, self).setUp()
+        cache.clear()
+        self.old_max_tracked = utils.MAX_TRACKED
+        utils.MAX_TRACKED = 3
+
+    def tearDown(self):
+        utils.MAX_TRACKED = self.old_max_tracked
+        super(BoundedTrackingTestCase, self).tearDown()
+
+    def test_fragment(self):
+        for n in range(5):
+            DummyModel.objects.create(title='T%s' % n, code='c%s' % n)
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        t = template.Template("{% load ultracache_tags %}\
+            {% ultracache 300 'bounded-outer' %}{{ one.title }}\
+            {% ultracache 300 'bounded-inner' %}{% for obj in objs %}{{ obj.title }}{% endfor %}{% endultracache %}\
+            {% endultracache %}"
+        )
+
+        def render():
+            request = RequestFactory().get('/bounded/')
+            context = template.Context({
+                'request': request, 'one': one,
+                'objs': DummyModel.objects.exclude(pk=one.pk)
+            })
+            return t.render(context).split()
+
+        self.assertEqual(render(), ['One', 'T0T1T2T3T4'])
+
+        # The inner fragment is tracked per content type and so is the outer
+        # one on its behalf. Object one is still tracked by the outer one.
+        members = registry.get_members(cache.get('ucache-any-%s' % ctid))
+        self.assertEqual(len(members), 2)
+        self.assertEqual(
+            registry.get_members(cache.get('ucache-pth-any-%s' % ctid)),
+            ['/bounded/']
+        )
+        self.assertEqual(cache.get(members[0] + '-objs'), [(ctid, None)])
+        self.assertEqual(
+            len(registry.get_members(cache.get('ucache-%s-%s' % (ctid, one.pk)))), 1
+        )
+        obj = DummyModel.objects.get(code='c1')
+        self.assertEqual(cache.get('ucache-%s-%s' % (ctid, obj.pk)), None)
+
+        # Any change to an object of the content type expires both
+        obj.title = 'X'
+        obj.save()
+        self.assertEqual(render(), ['One', 'T0XT2T3T4'])
+
+    def test_cache_calls(self):
+        # Registry writes do not grow with the number of tracked objects
+        request = RequestFactory().get('/')
+        request._ultracache = [(1, n) for n in range(5000)] + [(2, 1)] * 5000
+        with self.assertNumCacheCalls(8, get_many=5, set_many=3):
+            utils.cache_meta(request, 'bounded', 0, 300)
+        self.assertEqual(request._ultracache, [(1, None), (2, None)])
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    ULTRACACHE={
+        "metrics": {"backends": ["ultracache.metrics.aggregator"]},
+        "querystring": {
+            "deny": ["utm_*"],
+            "views": {
+                "ultracache.tests.views.BustableCachedView.get": {"allow": ["a"]},
+                "ultracache.tests.views.fragment_view": {"allow": ["a"]}
+            }
+        }
+    }
+)
+class QueryStringTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(QueryStringTestCase, self).setUp()
+        cache.clear()
+        aggregator.reset()
+
+    def test_canonical_path(self):
+        request = RequestFactory().get('/x/?b=2&a=1&utm_source=x&e=&a=0&c=%C3%A9')
+        self.assertEqual(utils.canonical_path(request), '/x/?a=1&a=0&b=2&c=%C3%A9')
+        self.assertEqual(
+            utils.canonical_path(request, 'ultracache.tests.views.BustableCachedView.get'),
+            '/x/?a=1&a=0'
+        )
+        request = RequestFactory().get('/x/?utm_source=x')
+        self.assertEqual(utils.canonical_path(request), '/x/')
+        with override_settings(ULTRACACHE={}):
+            self.assertEqual(utils.canonical_path(request), '/x/?utm_source=x')
+
+    def test_cached_get(self):
+        name = 'ultracache.tests.views.BustableCachedView.get'
+        self.client.get('/bustable-cached-view/?b=1&a=2&utm_source=x')
+        self.client.get('/bustable-cached-view/?a=2')
+        self.assertEqual(aggregator.get_counter('view', name, 'misses'), 1)
+        self.assertEqual(aggregator.get_counter('view', name, 'hits'), 1)
+
+    def test_fragments(self):
+        # Fragments in a view register the path in the view's canonical form
+        one = DummyModel.objects.create(title='One', code='one')
+        ctid = ContentType.objects.get_for_model(DummyModel).id
+        self.client.get('/fragment-view/?b=2&a=1')
+        self.assertEqual(
+            registry.get_members(cache.get('ucache-pth-%s-%s' % (ctid, one.pk))),
+            ['/fragment-view/?a=1']
+        )
+
+    def test_registry(self):
+        # Paths are registered and so purged in canonical form
+        request = RequestFactory().get('/x/?b=2&a=1&utm_source=x')
+        request._ultracache = [(1, 1)]
+        utils.cache_meta(request, 'canonical', 0, 300)
+        self.assertEqual(
+            registry.get_members(cache.get('ucache-pth-1-1')), ['/x/?a=1&b=2']
+        )
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    ULTRACACHE={
+        "metrics": {"backends": ["ultracache.metrics.aggregator"]},
+        "status-timeouts": {404: 60, "301": 3600}
+    }
+)
+class ResponseSnapshotTestCase(TestCase):
+    fixtures = ["sites.json"]
+
+    def setUp(self):
+        super(ResponseSnapshotTestCase, self).setUp()
+        cache.clear()
+
+    def get_twice(self, path):
+        counter = views.COUNTER
+        first = self.client.get(path)
+        second = self.client.get(path)
+        return first, second, views.COUNTER - counter
+
+    def test_ok(self):
+        first, second, renders = self.get_twice('/snapshot-view/')
+        self.assertEqual(renders, 1)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.content, b"status 200")
+        self.assertEqual(second["Content-Type"], "text/plain")
+        self.assertEqual(second["X-Custom"], "yes")
+        self.assertEqual(second["ETag"], first["ETag"])
+
+    def test_redirect(self):
+        first, second, renders = self.get_twice('/snapshot-view/?status=301')
+        self.assertEqual(renders, 1)
+        self.assertEqual(second.status_code, 301)
+        self.assertEqual(second["Location"], "/elsewhere/")
+        self.assertFalse(second.has_header("ETag"))
+
+    def test_not_found(self):
+        first, second, renders = self.get_twice('/snapshot-view/?status=404')
+        self.assertEqual(renders, 1)
+        self.assertEqual(second.status_code, 404)
+        with override_settings(ULTRACACHE={
+            "metrics": {"backends": ["ultracache.metrics.aggregator"]}
+        }):
+            first, second, renders = self.get_twice(
+                '/snapshot-view/?status=404&uncached'
+            )
+        self.assertEqual(renders, 2)
+
+        # Objects tracked before the view gave up invalidate the entry
+        one = DummyModel.objects.create(title='One', code='one')
+        first, second, renders = self.get_twice(
+            '/snapshot-view/?status=404&code=one'
+        )
+        self.assertEqual(renders, 1)
+        one.save()
+        first, second, renders = self.get_twice(
+            '/snapshot-view/?status=404&code=one'
+        )
+        self.assertEqual(renders, 1)
+
+        # Without tracked objects the entry is only bounded by its timeout
+        first, second, renders = self.get_twice('/snapshot-view/?status=404')
+        self.assertEqual(renders, 0)
+
+    def test_uncached(self):
+        # Statuses without a timeout, responses setting cookies and
+        # responses varying on headers the key is not made of
+        for path in (
+            '/snapshot-view/?status=500', '/snapshot-view/?cookie',
+            '/snapshot-view/?vary'
+        ):
+            first, second, renders = self.get_twice(path)
+            self.assertEqual(renders, 2)
+
+    def test_snapshot(self):
+        request = RequestFactory().get('/')
+        response = HttpResponse("x", status=410, reason="Gone away")
+        response["Vary"] = "Cookie"
+        response["X-Ultracache-Debug"] = "{}"
+        snapshot = utils.make_snapshot(response, response.content)
+        self.assertEqual(snapshot["headers"], [
+            ("Content-Type", "text/html; charset=utf-8"), ("Vary", "Cookie")
+        ])
+        restored = utils.restore_snapshot(request, snapshot)
+        self.assertEqual(restored.status_code, 410)
+        self.assertEqual(restored.reason_phrase, "Gone away")
+        self.assertEqual(restored["Vary"], "Cookie")
+
+        # Entries cached by earlier versions hold the private header format
+        restored = utils.restore_snapshot(request, {
+            "content": b"x",
+            "headers": {"x-custom": ("X-Custom", "yes")},
+            "etag": None,
+            "last_modified": None
+        })
+        self.assertEqual(restored.status_code, 200)
+        self.assertEqual(restored["X-Custom"], "yes")
+
+        # Only headers covered by the cache key may be varied on
+        self.assertFalse(utils.is_cacheable(response))
+        self.assertTrue(utils.is_cacheable(response, ("cookie",)))
+        self.assertTrue(utils.is_cacheable(response, None))
+        response["Vary"] = "Accept, *"
+        self.assertFalse(utils.is_cacheable(response, None))
@@ -35,4 +35,9 @@ urlpatterns = [
         views.NonBustableCachedView.as_view(),
         name='non-bustable-cached-view'
     ),
+    url(
+        r'^uncached-view/$',
+        views.UncachedView.as_view(),
+        name='uncached-view'
+    ),
 ]
@@ -1,5 +1,9 @@
+from django.http import Http404, HttpResponse, HttpResponsePermanentRedirect
+from django.template import Context, Template
+from django.template.response import TemplateResponse
 from django.views.generic.base import TemplateView
 
+from ultracache import aio
 from ultracache.decorators import cached_get
 from ultracache.tests.models import DummyModel, DummyForeignModel, \
     DummyOtherModel
@@ -73,3 +77,105 @@ class NonBustableCachedView(TemplateView):
     @cached_get(300, "request.path_info")
     def get(self, *args, **kwargs):
         return super(NonBustableCachedView, self).get(*args, **kwargs)
+
+
+class UncachedView(TemplateView):
+    """View that is only cached by the middleware.
+    """
+    template_name = "tests/uncached_view.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(UncachedView, self).get_context_data(**kwargs)
+        context["one"] = DummyModel.objects.get(code="one")
+        context["counter"] = COUNTER
+        return context
+
+
+class EsiView(TemplateView):
+    """View with a fragment that is served separately to an ESI capable
+    proxy.
+    """
+    template_name = "tests/esi_view.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(EsiView, self).get_context_data(**kwargs)
+        context["one"] = DummyModel.objects.get(code="one")
+        context["counter"] = COUNTER
+        return context
+
+
+@cached_get(300)
+async def async_cached_view(request, code="one"):
+    """Coroutine view. Django versions that can't serve it are tested by
+    awaiting it directly.
+    """
+    one = await aio.sync(DummyModel.objects.get, code=code)
+    return TemplateResponse(
+        request, "tests/async_cached_view.html", {"one": one}
+    )
+
+
+@cached_get(300)
+def fragment_view(request):
+    """Function view with a cached fragment."""
+    return TemplateResponse(
+        request, "tests/esi_view.html",
+        {"one": DummyModel.objects.get(code="one"), "counter": COUNTER}
+    )
+
+
+@cached_get(300)
+def snapshot_view(request):
+    """View answering with the status asked for in the query string. Every
+    render bumps COUNTER.
+    """
+    global COUNTER
+    COUNTER += 1
+    status = int(request.GET.get("status", 200))
+    if status == 404:
+        # A lookup may render objects before it gives up
+        if "code" in request.GET:
+            Template("{{ obj.title }}").render(Context({
+                "request": request,
+                "obj": DummyModel.objects.get(code=request.GET["code"])
+            }))
+        raise Http404
+    if status == 301:
+        return HttpResponsePermanentRedirect("/elsewhere/")
+    response = HttpResponse(
+        "status %s" % status, status=status, content_type="text/plain"
+    )
+    response["X-Custom"] = "yes"
+    if "cookie" in request.GET:
+        response.set_cookie("session", "secret")
+    if "vary" in request.GET:
+        response["Vary"] = "Accept-Language"
+    return response
+
+
+def long_view(request):
+    """Uncached view with a body long enough for GZipMiddleware to compress.
+    Every render bumps COUNTER.
+    """
+    global COUNTER
+    COUNTER += 1
+    return HttpResponse(
+        "counter %s %s" % (COUNTER, "x" * 300), content_type="text/plain"
+    )
+
+
+@cached_get(300)
+def nocache_view(request):
+    """Function view with ultracache_nocache blocks inside and outside a
+    cached fragment."""
+    return TemplateResponse(
+        request, "tests/nocache_view.html",
+        {"one": DummyModel.objects.get(code="one"), "counter": COUNTER}
+    )
+
+
+def uncached_nocache_view(request):
+    return TemplateResponse(
+        request, "tests/nocache_view.html",
+        {"one": DummyModel.objects.get(code="one"), "counter": COUNTER}
+    )
@@ -2,7 +2,7 @@ import django
 
 from rest_framework import viewsets, serializers
 
-from ultracache.tests.models import DummyModel
+from ultracache.tests.models import DummyModel, DummyForeignModel
 
 
 class DummySerializer(serializers.ModelSerializer):
@@ -13,6 +13,15 @@ class DummySerializer(serializers.ModelSerializer):
             fields = "__all__"
 
 
+class DummyForeignSerializer(serializers.ModelSerializer):
+    points_to = DummySerializer()
+
+    class Meta:
+        model = DummyForeignModel
+        if not django.get_version().startswith("1.6"):
+            fields = "__all__"
+
+
 class DummyViewSet(viewsets.ModelViewSet):
     queryset = DummyModel.objects.all()
     serializer_class = DummySerializer
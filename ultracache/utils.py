@@ -1,6 +1,24 @@
-import sys
+import ast
+import base64
+import fnmatch
+import functools
+import hashlib
+import re
+import time
+from urllib.parse import parse_qsl, urlencode
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
 
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseNotModified
+from django.template import RequestContext, Template
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import http_date, parse_http_date_safe
 from django.contrib.sites.models import Site
 try:
     from django.contrib.sites.shortcuts import get_current_site
@@ -8,39 +26,146 @@ except ImportError:
     from django.contrib.sites.models import get_current_site
 from django.conf import settings
 
+# MAX_SIZE and reduce_list_size are imported for backwards compatibility
+from ultracache.registry import MAX_SIZE, PATH_TIMEOUT, REGISTRY_TIMEOUT, \
+    add_entry, add_to_index, get_expiry, get_timeout, head_timeout, \
+    paginate, reduce_list_size, split_head
 
-# The metadata itself can"t be allowed to grow endlessly. This value is the
-# maximum size in bytes of a metadata list. If your caching backend supports
-# compression set a larger value.
+
+# Fragments that track more distinct objects are tracked per content type
 try:
-    MAX_SIZE = settings.ULTRACACHE["max-registry-value-size"]
+    MAX_TRACKED = settings.ULTRACACHE["max-tracked-objects"]
 except (AttributeError, KeyError):
-    MAX_SIZE = 25000
+    MAX_TRACKED = None
+
+
+# Objects are tracked in request._ultracache. Async views track the objects of
+# each cached scope in a context variable so concurrent renders on one event
+# loop do not interleave their objects.
+if contextvars is not None:
+    tracked = contextvars.ContextVar("ultracache_tracked", default=None)
+else:
+    tracked = None
+
+
+def get_tracked(request, create=False):
+    """Return the list objects are currently tracked in, or None if no
+    caching scope is active and create is false."""
+    if tracked is not None:
+        li = tracked.get()
+        if li is not None:
+            return li
+    li = getattr(request, "_ultracache", None)
+    if (li is None) and create:
+        li = request._ultracache = []
+    return li
+
+
+class TrackingScope(object):
+    """Context manager that tracks the objects of a cached async view in a
+    list of its own and adds them to the enclosing list on exit. objects and
+    start_index, the position of the objects in the enclosing list, are set
+    on exit.
+
+    Without context variables the scope shares the enclosing list, so
+    concurrent scopes may track each other's objects. That only leads to
+    extra invalidation."""
+
+    def __init__(self, request):
+        self.request = request
+
+    def __enter__(self):
+        self.parent = get_tracked(self.request, True)
+        if tracked is None:
+            self.start_index = len(self.parent)
+        else:
+            self.token = tracked.set([])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if tracked is not None:
+            objects = tracked.get()
+            tracked.reset(self.token)
+            self.start_index = len(self.parent)
+            self.parent.extend(objects)
+        self.objects = self.parent[self.start_index:]
+
+
+def _querystring_conf(name):
+    try:
+        conf = settings.ULTRACACHE["querystring"]
+    except (AttributeError, KeyError):
+        return None
+    overrides = conf.get("views", {}).get(name, None)
+    if overrides:
+        conf = dict(conf)
+        conf.update(overrides)
+    return conf
+
+
+def _matches(key, patterns):
+    return any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns)
+
+
+def canonical_path(request, name=None):
+    """Return the full path of request with a canonical query string.
+    Parameters are filtered by the allow and deny lists of glob patterns,
+    empty values are dropped and parameters are sorted by name. name is the
+    dotted name of a view or viewset with settings of its own. Without the
+    querystring setting the full path is returned unchanged."""
+    full_path = request.get_full_path()
+    conf = _querystring_conf(name)
+    if conf is None:
+        return full_path
+    path, sep, query = full_path.partition("?")
+    if not query:
+        return path
+    allow = conf.get("allow", None)
+    deny = conf.get("deny", [])
+    drop_empty = conf.get("drop-empty", True)
+    params = []
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if drop_empty and not value:
+            continue
+        if (allow is not None) and not _matches(key, allow):
+            continue
+        if _matches(key, deny):
+            continue
+        params.append((key, value))
+    if conf.get("sort", True):
+        # Sorting is stable so repeated parameters keep their order
+        params.sort(key=lambda param: param[0])
+    if not params:
+        return path
+    return path + "?" + urlencode(params)
 
 
-def reduce_list_size(li):
-    """Return two lists
-        - the last N items of li whose total size is less than MAX_SIZE
-        - the rest of the original list li
-    """
-    size = sys.getsizeof(li)
-    keep = li
-    toss = []
-    n = len(li)
-    decrement_by = max(n / 10, 10)
-    while (size >= MAX_SIZE) and (n > 0):
-        n -= decrement_by
-        toss = li[:-n]
-        keep = li[-n:]
-        size = sys.getsizeof(keep)
-    return keep, toss
+def get_registered_path(request):
+    """Return the path registered for content rendered for request. Views
+    cached with cached_get and cached viewsets set their own canonical path
+    so the fragments they contain register the same URL."""
+    path = getattr(request, "_ultracache_path", None)
+    if path is None:
+        path = canonical_path(request)
+    return path
 
 
-def cache_meta(request, cache_key, start_index=0):
-    """Inspect request for objects in _ultracache and set appropriate entries
-    in Django's cache."""
+def cache_meta(request, cache_key, start_index=0, timeout=REGISTRY_TIMEOUT,
+        path=None, objects=None):
+    """Inspect the objects tracked for request and set appropriate entries
+    in Django's cache. timeout is the timeout cache_key was set with and
+    cache key registry members are stored with that expiry. None means
+    forever. path is the URL registered for purging and defaults to the
+    canonical request path. It is stored with PATH_TIMEOUT because the proxy
+    may cache it for longer. objects are the objects tracked for cache_key at start_index and
+    default to all objects tracked from start_index on. Pass them when other
+    scopes may have tracked objects after them."""
 
-    path = request.get_full_path()
+    if path is None:
+        path = get_registered_path(request)
+    now = time.time()
+    expiry = get_expiry(timeout, now)
+    path_expiry = get_expiry(PATH_TIMEOUT, now)
 
     # Lists needed for cache.get_many
     to_set_get_keys = []
@@ -48,108 +173,104 @@ def cache_meta(request, cache_key, start_index=0):
     to_set_content_types_get_keys = []
     to_set_content_types_paths_get_keys = []
 
-    # Dictionaries needed for cache.set_many
-    to_set = {}
-    to_set_paths = {}
-    to_set_content_types = {}
-    to_set_content_types_paths = {}
-
     to_delete = []
+
+    # Registries that do not exist yet must be added to the key index
+    to_index = []
+
+    # A list of objects that contribute to a cache entry. Sets keep the
+    # deduplication linear in the number of tracked objects.
+    tracked = get_tracked(request, True)
+    if objects is None:
+        objects = tracked[start_index:]
     to_set_objects = []
+    seen = set()
+    for tu in objects:
+        if tu not in seen:
+            seen.add(tu)
+            to_set_objects.append(tu)
 
-    for ctid, obj_pk in request._ultracache[start_index:]:
-        # The object appears in these cache entries. If the object is modified
-        # then these cache entries are deleted.
-        key = "ucache-%s-%s" % (ctid, obj_pk)
-        if key not in to_set_get_keys:
-            to_set_get_keys.append(key)
+    # Too many objects are tracked per content type instead. Outer callers
+    # see the content types too so their registries stay bounded.
+    if (MAX_TRACKED is not None) and (len(to_set_objects) > MAX_TRACKED):
+        ctids = []
+        for ctid, obj_pk in to_set_objects:
+            if ctid not in ctids:
+                ctids.append(ctid)
+        to_set_objects = [(ctid, None) for ctid in ctids]
+        end_index = start_index + len(objects)
+        if tracked[start_index:end_index] == objects:
+            tracked[start_index:end_index] = to_set_objects
 
-        # The object appears in these paths. If the object is modified then any
-        # caches that are read from when browsing to this path are cleared.
-        key = "ucache-pth-%s-%s" % (ctid, obj_pk)
-        if key not in to_set_paths_get_keys:
-            to_set_paths_get_keys.append(key)
+    seen = set()
+    for ctid, obj_pk in to_set_objects:
+        if obj_pk is None:
+            # Any object of the content type appears in these cache entries
+            # and paths. If any object of this content type is created,
+            # modified or deleted then these are cleared.
+            to_set_get_keys.append("ucache-any-%s" % ctid)
+            to_set_paths_get_keys.append("ucache-pth-any-%s" % ctid)
+        else:
+            # The object appears in these cache entries. If the object is
+            # modified then these cache entries are deleted.
+            to_set_get_keys.append("ucache-%s-%s" % (ctid, obj_pk))
+
+            # The object appears in these paths. If the object is modified
+            # then any caches that are read from when browsing to this path
+            # are cleared.
+            to_set_paths_get_keys.append("ucache-pth-%s-%s" % (ctid, obj_pk))
+
+        if ctid in seen:
+            continue
+        seen.add(ctid)
 
         # The content type appears in these cache entries. If an object of this
         # content type is created then these cache entries are cleared.
-        key = "ucache-ct-%s" % ctid
-        if key not in to_set_content_types_get_keys:
-            to_set_content_types_get_keys.append(key)
+        to_set_content_types_get_keys.append("ucache-ct-%s" % ctid)
 
         # The content type appears in these paths. If an object of this content
         # type is created then any caches that are read from when browsing to
         # this path are cleared.
-        key = "ucache-ct-pth-%s" % ctid
-        if key not in to_set_content_types_paths_get_keys:
-            to_set_content_types_paths_get_keys.append(key)
+        to_set_content_types_paths_get_keys.append("ucache-ct-pth-%s" % ctid)
 
-        # A list of objects that contribute to a cache entry
-        tu = (ctid, obj_pk)
-        if tu not in to_set_objects:
-            to_set_objects.append(tu)
+    # Registries are read and modified in this order. Only the heads are
+    # read. A head that outgrows MAX_SIZE moves its oldest members to a new
+    # page. Cache keys in pages evicted from a registry with too many pages
+    # are deleted, paths are simply forgotten.
+    to_set = {}
+    to_set_pages = {}
+    evicted = []
+    evicted_keys = []
+    for get_keys, member, member_expiry, is_keys in (
+        (to_set_get_keys, cache_key, expiry, True),
+        (to_set_paths_get_keys, path, path_expiry, False),
+        (to_set_content_types_get_keys, cache_key, expiry, True),
+        (to_set_content_types_paths_get_keys, path, path_expiry, False)
+    ):
+        # todo: rewrite to handle absence of get_many
+        di = cache.get_many(get_keys)
+        for key in get_keys:
+            v = di.get(key, None)
+            if (v is None) and is_keys:
+                to_index.append(key)
+            # Expired members and pages are dropped on every read
+            entries, pages = split_head(v, now)
+            entries = add_entry(entries, member, member_expiry)
+            head, new_pages, li, evicted_entries = paginate(key, entries, pages)
+            if head != v:
+                to_set[key] = head
+            to_set_pages.update(new_pages)
+            evicted.extend(li)
+            if is_keys:
+                evicted_keys.extend(li)
+                to_delete.extend([m for m, e in evicted_entries])
 
-    # todo: rewrite to handle absence of get_many
-    di = cache.get_many(to_set_get_keys)
-    for key in to_set_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set[key] = keep
-                to_delete.extend(toss)
-        if cache_key not in keep:
-            if key not in to_set:
-                to_set[key] = keep
-            to_set[key] = to_set[key] + [cache_key]
-    if to_set == di:
-        to_set = {}
-
-    di = cache.get_many(to_set_paths_get_keys)
-    for key in to_set_paths_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_paths[key] = keep
-        if path not in keep:
-            if key not in to_set_paths:
-                to_set_paths[key] = keep
-            to_set_paths[key] = to_set_paths[key] + [path]
-    if to_set_paths == di:
-        to_set_paths = {}
-
-    di = cache.get_many(to_set_content_types_get_keys)
-    for key in to_set_content_types_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_content_types[key] = keep
-                to_delete.extend(toss)
-        if cache_key not in keep:
-            if key not in to_set_content_types:
-                to_set_content_types[key] = keep
-            to_set_content_types[key] = to_set_content_types[key] + [cache_key]
-    if to_set_content_types == di:
-        to_set_content_types = {}
-
-    di = cache.get_many(to_set_content_types_paths_get_keys)
-    for key in to_set_content_types_paths_get_keys:
-        v = di.get(key, None)
-        keep = []
-        if v is not None:
-            keep, toss = reduce_list_size(v)
-            if toss:
-                to_set_content_types_paths[key] = keep
-        if path not in keep:
-            if key not in to_set_content_types_paths:
-                to_set_content_types_paths[key] = keep
-            to_set_content_types_paths[key] = to_set_content_types_paths[key] + [path]
-    if to_set_content_types_paths == di:
-        to_set_content_types_paths = {}
+    # Last resort eviction
+    if evicted:
+        di = cache.get_many(evicted_keys)
+        for page in di.values():
+            to_delete.extend([m for m, e in split_head(page, now)[0]])
+        to_delete.extend(evicted)
 
     # Deletion must happen first because set may set some of these keys
     if to_delete:
@@ -159,29 +280,326 @@ def cache_meta(request, cache_key, start_index=0):
             for k in to_delete:
                 cache.delete(k)
 
-    # Do one set_many
-    di = {}
-    di.update(to_set)
+    # Registries are written with the expiry of their longest lived member.
+    # Group them by timeout so the common case is one set_many.
+    by_timeout = {}
+    for key, head in to_set.items():
+        by_timeout.setdefault(head_timeout(head, now), {})[key] = head
     del to_set
-    di.update(to_set_paths)
-    del to_set_paths
-    di.update(to_set_content_types)
-    del to_set_content_types
-    di.update(to_set_content_types_paths)
-    del to_set_content_types_paths
+    for key, page in to_set_pages.items():
+        by_timeout.setdefault(get_timeout(page, now), {})[key] = page
+    del to_set_pages
 
     if to_set_objects:
-        di[cache_key + "-objs"] = to_set_objects
+        by_timeout.setdefault(timeout, {})[cache_key + "-objs"] = \
+            to_set_objects
 
-    if di:
+    for registry_timeout, di in by_timeout.items():
         try:
-            cache.set_many(di, 86400)
+            cache.set_many(di, registry_timeout)
         except NotImplementedError:
             for k, v in di.items():
-                cache.set(k, v, 86400)
+                cache.set(k, v, registry_timeout)
+
+    add_to_index(to_index)
+
+
+# Literal node types differ between Python versions
+_LITERAL_NODES = tuple(
+    getattr(ast, name) for name in ("Constant", "Str", "Bytes", "Num", "NameConstant")
+    if hasattr(ast, name)
+)
+
+
+def _validate_expression(node, names, expression):
+    """Walk the parsed expression and allow only names from names, attribute
+    access and calls with literal arguments."""
+    if isinstance(node, _LITERAL_NODES):
+        return
+    if isinstance(node, ast.Name):
+        if node.id not in names:
+            raise ImproperlyConfigured(
+                "Name %r not allowed in expression %r" % (node.id, expression)
+            )
+        return
+    if isinstance(node, ast.Attribute):
+        if node.attr.startswith("_"):
+            raise ImproperlyConfigured(
+                "Private attribute %r not allowed in expression %r" \
+                    % (node.attr, expression)
+            )
+        _validate_expression(node.value, names, expression)
+        return
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Attribute):
+            raise ImproperlyConfigured(
+                "Only method calls are allowed in expression %r" % expression
+            )
+        for arg in node.args:
+            if not isinstance(arg, _LITERAL_NODES):
+                raise ImproperlyConfigured(
+                    "Only literal arguments are allowed in expression %r" \
+                        % expression
+                )
+        for keyword in node.keywords:
+            if (keyword.arg is None) \
+                or not isinstance(keyword.value, _LITERAL_NODES):
+                raise ImproperlyConfigured(
+                    "Only literal arguments are allowed in expression %r" \
+                        % expression
+                )
+        _validate_expression(node.func, names, expression)
+        return
+    raise ImproperlyConfigured(
+        "Unsupported construct %s in expression %r" \
+            % (node.__class__.__name__, expression)
+    )
+
+
+def compile_expression(expression, names=("request",)):
+    """Compile a vary on expression like "request.is_secure()" once and return
+    a callable that evaluates it given keyword arguments for names. Only
+    attribute access and method calls on names are allowed. Non-string
+    expressions are returned as constants."""
+    if isinstance(expression, bytes):
+        expression = expression.decode("utf-8")
+    if not isinstance(expression, str):
+        return lambda **kwargs: expression
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        raise ImproperlyConfigured("Invalid expression %r" % expression)
+    _validate_expression(tree.body, names, expression)
+    code = compile(tree, "<ultracache>", "eval")
+    globs = {"__builtins__": {}}
+    return lambda **kwargs: eval(code, globs, kwargs)
+
+
+# Headers that must be repeated on a 304 response
+NOT_MODIFIED_HEADERS = ("cache-control", "content-location", "expires", "vary")
+
+
+def get_etag(content):
+    """Return a strong ETag for the given content."""
+    if not isinstance(content, bytes):
+        content = str(content).encode("utf-8")
+    return '"%s"' % hashlib.md5(content).hexdigest()
+
+
+def set_conditional_headers(response, content):
+    """Set ETag and Last-Modified headers on response unless the view already
+    provided them and return the (etag, last_modified) tuple to be stored
+    with the cache entry."""
+    if not response.has_header("ETag"):
+        response["ETag"] = get_etag(content)
+    last_modified = parse_http_date_safe(response.get("Last-Modified", ""))
+    if last_modified is None:
+        last_modified = int(time.time())
+        response["Last-Modified"] = http_date(last_modified)
+    return response["ETag"], last_modified
+
+
+def not_modified(request, etag, last_modified, headers=None):
+    """Return an HttpResponseNotModified if the conditional headers of request
+    match etag or last_modified, else None. If-None-Match takes precedence
+    over If-Modified-Since."""
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH", None)
+    if if_none_match is not None:
+        etags = [e.strip() for e in if_none_match.split(",")]
+        match = (etag is not None) and (
+            ("*" in etags) or (etag in etags) or (("W/" + etag) in etags)
+        )
+    else:
+        if_modified_since = parse_http_date_safe(
+            request.META.get("HTTP_IF_MODIFIED_SINCE", "")
+        )
+        match = (if_modified_since is not None) \
+            and (last_modified is not None) \
+            and (last_modified <= if_modified_since)
+    if not match:
+        return None
+
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    for k, v in get_header_items(headers):
+        if k.lower() in NOT_MODIFIED_HEADERS:
+            response[k] = v
+    return response
+
+
+# Headers that are never stored with a cached response. Cookies and debug
+# output belong to one client, the others are computed per response or
+# hop-by-hop.
+UNCACHED_HEADERS = (
+    "set-cookie", "x-ultracache-debug", "content-length", "date",
+    "connection", "keep-alive", "transfer-encoding"
+)
+
+
+def get_header_items(headers):
+    """Return the (name, value) tuples of cached headers. Entries cached by
+    earlier versions hold the private _headers dictionary of lowercased name
+    to (name, value) tuple."""
+    if isinstance(headers, dict):
+        return list(headers.values())
+    return headers or []
+
+
+def get_status_timeout(status_code, timeout):
+    """Return the timeout to cache a response with status_code with, or
+    False if it must not be cached. timeout applies to 200 responses. Other
+    statuses, typically 404 and 301, are only cached with the timeout set for
+    them in the status-timeouts setting."""
+    if status_code == 200:
+        return timeout
+    try:
+        timeouts = settings.ULTRACACHE["status-timeouts"]
+    except (AttributeError, KeyError):
+        return False
+    return timeouts.get(status_code, timeouts.get(str(status_code), False))
+
+
+def get_vary_headers(response):
+    """Return the lowercased header names in the Vary header of response."""
+    return [
+        h.strip().lower() for h in response.get("Vary", "").split(",")
+        if h.strip()
+    ]
+
+
+def get_header_meta_key(header):
+    """Return the request.META key of a request header."""
+    return "HTTP_" + header.upper().replace("-", "_")
+
+
+def is_cacheable(response, covered=()):
+    """Streaming responses, responses that set cookies and responses that
+    vary on everything are never cached. covered are the lowercased request
+    headers the cache key is made of, or None if the key is made of every
+    header the response varies on. A response that varies on any other
+    header is not cached since it would be served to clients sending other
+    values."""
+    if getattr(response, "streaming", False) or response.cookies:
+        return False
+    vary = get_vary_headers(response)
+    if "*" in vary:
+        return False
+    return (covered is None) or not set(vary).difference(covered)
+
+
+def make_snapshot(response, content):
+    """Return the value to cache for response. Successful responses get ETag
+    and Last-Modified headers."""
+    etag = last_modified = None
+    # Content with ultracache_nocache blocks differs per request
+    if (response.status_code == 200) and (PLACEHOLDER_MARK not in content):
+        etag, last_modified = set_conditional_headers(response, content)
+    return {
+        "content": content,
+        "status": response.status_code,
+        "reason": response.reason_phrase,
+        "charset": response.charset,
+        "headers": [
+            (k, v) for k, v in response.items()
+            if k.lower() not in UNCACHED_HEADERS
+        ],
+        "etag": etag,
+        "last_modified": last_modified
+    }
+
+
+def restore_snapshot(request, snapshot):
+    """Return the response for a cached snapshot, or a 304 if the conditional
+    headers of request match it."""
+    # Answer a conditional request before building the body
+    response = not_modified(
+        request,
+        snapshot.get("etag", None),
+        snapshot.get("last_modified", None),
+        snapshot["headers"]
+    )
+    if response is not None:
+        return response
+    response = HttpResponse(
+        snapshot["content"],
+        status=snapshot.get("status", 200),
+        reason=snapshot.get("reason", None),
+        charset=snapshot.get("charset", None)
+    )
+    for k, v in get_header_items(snapshot["headers"]):
+        response[k] = v
+    if getattr(request, "_ultracache_placeholders", False):
+        return response
+    return render_response_placeholders(request, response)
 
 
 def get_current_site_pk(request):
     """Seemingly pointless function is so calling code doesn't have to worry
     about the import issues between Django 1.6 and later."""
     return get_current_site(request).pk
+
+
+# Template source of ultracache_nocache blocks is stored base64 encoded in
+# cached fragments so it can not be confused with content. Placeholders carry
+# an HMAC of the source so source injected into cached content, eg. by user
+# supplied HTML, is never compiled.
+PLACEHOLDER_MARK = b"<!--ucache-nocache "
+NOCACHE_RE = re.compile(r"<!--ucache-nocache ([A-Za-z0-9+/=]*) ([0-9a-f]+)-->")
+
+
+def sign_placeholder(encoded):
+    return salted_hmac("ultracache.nocache", encoded).hexdigest()
+
+
+def make_placeholder(source):
+    encoded = base64.b64encode(source.encode("utf-8")).decode("ascii")
+    return "<!--ucache-nocache %s %s-->" % (encoded, sign_placeholder(encoded))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_placeholder(encoded):
+    return Template(base64.b64decode(encoded).decode("utf-8"))
+
+
+def _render_placeholder(match, context):
+    encoded, signature = match.groups()
+    # Placeholders that were not made by make_placeholder are left as they
+    # are
+    if not constant_time_compare(signature, sign_placeholder(encoded)):
+        return match.group(0)
+    return compile_placeholder(encoded).render(context)
+
+
+def render_placeholders(value, context):
+    """Render the ultracache_nocache blocks in value with context."""
+    if "<!--ucache-nocache " not in value:
+        return value
+    return NOCACHE_RE.sub(
+        lambda match: _render_placeholder(match, context), value
+    )
+
+
+def defer_placeholders(request):
+    """Make ultracache_nocache blocks rendered for request leave their
+    placeholders so a cached view or the middleware can store the content
+    and render them afterwards. Return true if the caller is the outermost
+    cache and must render them with render_response_placeholders."""
+    if getattr(request, "_ultracache_placeholders", False):
+        return False
+    request._ultracache_placeholders = True
+    return True
+
+
+def render_response_placeholders(request, response):
+    """Render the ultracache_nocache blocks in the content of response with a
+    request context. A response with per request content is marked
+    private."""
+    if getattr(response, "streaming", False) \
+        or (PLACEHOLDER_MARK not in response.content):
+        return response
+    content = response.content.decode(response.charset)
+    response.content = render_placeholders(content, RequestContext(request))
+    patch_cache_control(response, private=True)
+    return response
@@ -0,0 +1,85 @@
+import asyncio
+import copy
+from urllib.parse import urlparse
+
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, QueryDict
+try:
+    from django.urls import Resolver404, resolve
+except ImportError:
+    from django.core.urlresolvers import Resolver404, resolve
+
+from ultracache.esi import KEY_PREFIX, decode_key, is_valid
+from ultracache.metrics import aggregator
+from ultracache.utils import get_tracked, render_response_placeholders
+
+
+def prometheus_metrics(request):
+    """Expose the in-process aggregator in the Prometheus text format. Restrict
+    access to this view in your URL configuration or proxy."""
+    return HttpResponse(
+        aggregator.as_prometheus(),
+        content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def _render_page(request, path):
+    """Render the page at path with request so the fragments it contains
+    are cached again."""
+    parsed = urlparse(path)
+    if parsed.scheme or parsed.netloc or not parsed.path.startswith("/"):
+        return
+    try:
+        match = resolve(parsed.path)
+    except Resolver404:
+        return
+    if asyncio.iscoroutinefunction(match.func):
+        return
+    # Render on a copy so the caller, and middleware caching the fragment
+    # response, still see the fragment URL. Objects the page tracks are
+    # registered by the page itself.
+    request = copy.copy(request)
+    request.META = request.META.copy()
+    request._ultracache = []
+    # get_full_path reads the query string from META, so rewrite both for
+    # the fragments to register the page path.
+    request.path = request.path_info = parsed.path
+    request.META["PATH_INFO"] = parsed.path
+    request.META["QUERY_STRING"] = parsed.query
+    request.GET = QueryDict(parsed.query)
+    request._ultracache_esi = True
+    response = match.func(request, *match.args, **match.kwargs)
+    if hasattr(response, "render") \
+        and not getattr(response, "is_rendered", True):
+        response.render()
+
+
+def esi_fragment(request, key):
+    """Serve the cached fragment encoded in key to a proxy processing an
+    esi:include tag. If the fragment is not in the cache the page in the path
+    parameter is rendered to refill it. ultracache_nocache blocks are rendered
+    with a request context. Only URLs signed by esi.get_src are served."""
+    key = decode_key(key)
+    if (key is None) or not key.startswith(KEY_PREFIX):
+        raise Http404
+    path = request.GET.get("path", "")
+    if not is_valid(key, path, request.GET.get("sig", "")):
+        raise PermissionDenied
+    value = cache.get(key)
+    if value is None:
+        _render_page(request, path)
+        value = cache.get(key)
+    if not isinstance(value, str):
+        raise Http404
+    # Make a caching scope around this view, eg. UltraCacheMiddleware, aware
+    # of the objects in the fragment.
+    tracked = get_tracked(request)
+    if tracked is not None:
+        tracked.extend(cache.get(key + "-objs", []))
+    response = HttpResponse(value)
+    # The proxy must not share a fragment with a per request block. A
+    # caching middleware renders the blocks after storing the response.
+    if getattr(request, "_ultracache_placeholders", False):
+        return response
+    return render_response_placeholders(request, response)